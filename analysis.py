@@ -4,8 +4,9 @@ import os
 
 import numpy as np
 import pandas
-import seaborn as sns
 
+from mutation_store import load_mutations
+from pathway_library import PathwayLibrary
 from pathways import *
 
 
@@ -54,13 +55,12 @@ def process_patients(patients, mutations_data, pathways):
 
 
 if __name__ == "__main__":
-    pathways = []
-    for pw in os.listdir("./pathways"):
-        pathway = parse_pathway("./pathways/" + pw)
-        pathways.append(pathway)
-    pathways.sort()
+    # Only needed for the plots, and slow to import
+    import seaborn as sns
 
-    mutations_data = pandas.read_csv("TRIBE2_seq_res.csv")
+    pathways = PathwayLibrary("./pathways").legacy_pathways()
+
+    mutations_data = load_mutations("TRIBE2_seq_res.csv").data
     patients_log = pandas.read_csv("TRIBE2_db.csv")
     columns = ["PatientFirstName"] + [pw[0] for pw in pathways]
 
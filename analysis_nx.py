@@ -1,22 +1,15 @@
 import numpy as np
 import pandas
-import analysis as lan
-from collections import namedtuple
-
-PathwayConfig = namedtuple("PathwayConfig", ["measure", "hierarchy"])
+from mutation_store import MutationStore, relevant_mutations
+from scoring import BASELINE, PathwayConfig
 
 
 def retrieve_mutations(pid, seq_data):
-    patient_data = seq_data[
-        (seq_data["PatientFirstName"] == pid)
-        & (seq_data["Technology"] == "NGS Q3")
-        # We only care about variants and pathogenic mutations
-        & (seq_data["TestResult"].isin(["variantdetected", "Mutated, Pathogenic"]))
-    ]
-
-    patient_data = patient_data[["Biomarker", "NGS_PercentMutated"]]
+    if isinstance(seq_data, MutationStore):
+        return seq_data.retrieve_mutations(pid)
 
-    return patient_data
+    patient_data = relevant_mutations(seq_data[seq_data["PatientFirstName"] == pid])
+    return patient_data[["Biomarker", "NGS_PercentMutated"]]
 
 
 def util_unweight(g):
@@ -25,14 +18,7 @@ def util_unweight(g):
 
 
 def calculate_patient_mutations_with_f(pid, seq_data, pathways, f, factor_famcom=False):
-    patient_data = seq_data[
-        (seq_data["PatientFirstName"] == pid)
-        & (seq_data["Technology"] == "NGS Q3")
-        # We only care about variants and pathogenic mutations
-        & (seq_data["TestResult"].isin(["variantdetected", "Mutated, Pathogenic"]))
-    ]
-
-    patient_data = patient_data[["Biomarker", "NGS_PercentMutated"]]
+    patient_data = retrieve_mutations(pid, seq_data)
 
     # Realistically, should never happen
     if patient_data.empty:
@@ -62,41 +48,32 @@ def calculate_patient_mutations_with_f(pid, seq_data, pathways, f, factor_famcom
     return results
 
 
-def calculate_patient_mutations_with_config(
-    pid, seq_data, pathways, legacy_pathways, config
-):
-    patient_data = seq_data[
-        (seq_data["PatientFirstName"] == pid)
-        & (seq_data["Technology"] == "NGS Q3")
-        # We only care about variants and pathogenic mutations
-        & (seq_data["TestResult"].isin(["variantdetected", "Mutated, Pathogenic"]))
-    ]
-
-    patient_data = patient_data[["Biomarker", "NGS_PercentMutated"]]
+def calculate_patient_mutations_with_config(pid, seq_data, pathways, config):
+    patient_data = retrieve_mutations(pid, seq_data)
 
     # Realistically, should never happen
     if patient_data.empty:
         return {}
 
     results = {}
-    legacy_to_compute = []
     for pw in pathways:
         pathway_mutations = patient_data[patient_data["Biomarker"].isin(pw.get_genes())]
         if pathway_mutations.empty:
             results[pw.name] = np.float64(0.0)
             continue
 
-        if config[pw.name].measure == "baseline":
-            legacy_to_compute.append(pw.name)
-            continue
-
-        weights = pw.calculate_measure(
-            config[pw.name].measure, config[pw.name].hierarchy
-        )
         patient_mutations = pathway_mutations.groupby("Biomarker").max()[
             "NGS_PercentMutated"
         ]
-        total_weights = weights.sum()
+        if config[pw.name].measure == BASELINE:
+            # Already normalized by the number of top-level groups
+            weights = pw.baseline_weights()
+            total_weights = 1
+        else:
+            weights = pw.calculate_measure(
+                config[pw.name].measure, config[pw.name].hierarchy
+            )
+            total_weights = weights.sum()
         if total_weights != 0:
             perc_mutation = (
                 weights.mul(patient_mutations, fill_value=np.float64(0.0)).sum()
@@ -106,10 +83,6 @@ def calculate_patient_mutations_with_config(
             perc_mutation = 0
         results[pw.name] = perc_mutation
 
-    legacy_results = lan.calculate_patient_mutations(
-        pid, seq_data, [pw for pw in legacy_pathways if pw[0] in legacy_to_compute]
-    )
-    results = {**results, **legacy_results}
     return results
 
 
@@ -127,13 +100,11 @@ def process_patients_with_f(patients, f, pathways, mutations_data, complexes=Fal
     )
 
 
-def process_patients_with_config(
-    patients, pathways, legacy_pathways, mutations_data, config
-):
+def process_patients_with_config(patients, pathways, mutations_data, config):
     results = {}
     for patient in patients:
         results[patient] = calculate_patient_mutations_with_config(
-            patient, mutations_data, pathways, legacy_pathways, config
+            patient, mutations_data, pathways, config
         )
 
     return (
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging as log
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import networkx as nx
+import pandas as pd
+
+import analysis_nx
+import pathways as lpw
+import pathways_nx as pnx
+import scoring
+import synthetic_data
+from coexpression import coexpression_matrix
+from measures import CSR_MEASURES, MEASURES
+from mutation_store import load_mutations
+from network_builder import (
+    make_pathway_from_thres,
+    make_pathway_topk,
+    pathway_from_edges,
+)
+from network_export import load_network, save_network, write_gexf, write_graphml
+from pathway_library import PathwayLibrary
+from pathway_parser import read_pathway
+from sparse_coexpression import coexpression_edges
+
+# Tracked baseline, measured with the default parameters
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark-baseline.json"
+)
+# Slowdowns above this ratio of the baseline are reported as regressions
+REGRESSION_RATIO = 1.25
+# Patients scored by the reference per-patient loop, which is much slower
+REFERENCE_PATIENTS = 200
+# Cold start budgets (seconds): going over them counts as a regression
+STARTUP_BUDGETS = {
+    "startup/import_analysis_nx": 1.0,
+    "startup/viewer": 1.5,
+}
+# Time until the viewer window is up, without the data loading behind it
+VIEWER_STARTUP = """
+import os
+from PyQt5.QtCore import QCoreApplication, Qt
+from PyQt5.QtWidgets import QApplication
+QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+app = QApplication([])
+import pathway_viewer
+window = pathway_viewer.Viewer()
+window.show()
+app.processEvents()
+os._exit(0)
+"""
+
+# setup() prepares what run() needs, without being timed
+Case = namedtuple("Case", ["name", "run", "setup"])
+Timing = namedtuple("Timing", ["best", "median", "repeats"])
+
+
+def time_case(case: Case, repeats) -> Timing:
+    timings = []
+    for _ in range(repeats):
+        state = case.setup() if case.setup else None
+        start = time.perf_counter()
+        case.run(state)
+        timings.append(time.perf_counter() - start)
+
+    return Timing(min(timings), statistics.median(timings), repeats)
+
+
+def cold_start(code, cwd):
+    """Runs code in a fresh interpreter, with the modules of this folder"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return lambda _: subprocess.run(
+        [sys.executable, "-c", code], cwd=cwd, env=env, check=True
+    )
+
+
+def build_cases(paths, work_dir):
+    """Benchmarks over a synthetic dataset, named stage/operation"""
+    pathway_files = [
+        os.path.join(paths["pathways"], filename)
+        for filename in sorted(os.listdir(paths["pathways"]))
+    ]
+    pathways = [pnx.pathway_to_nx(path) for path in pathway_files]
+    genes = sorted({gene for pw in pathways for gene in pw.get_genes()})
+    patients_log = pd.read_csv(paths["patients_log"])
+    mutations = load_mutations(paths["sequencing"])
+    patients = patients_log["PatientFirstName"]
+    bundle_path = os.path.join(work_dir, "bundle.pickle")
+    coexpression_cache = os.path.join(work_dir, "coexpression")
+
+    def fresh_pathways():
+        # Measures computed by earlier runs are not reused
+        return [pnx.Pathway(pw.name, pw.graph, groups=pw.groups) for pw in pathways]
+
+    def cold_library():
+        if os.path.exists(bundle_path):
+            os.remove(bundle_path)
+
+    def cold_coexpression():
+        shutil.rmtree(coexpression_cache, ignore_errors=True)
+
+    cases = [
+        Case(
+            "startup/import_analysis_nx",
+            cold_start("import analysis_nx", work_dir),
+            None,
+        ),
+        Case(
+            "parse/read_pathway",
+            lambda _: [read_pathway(p) for p in pathway_files],
+            None,
+        ),
+        Case(
+            "parse/legacy_tree",
+            lambda _: [lpw.parse_pathway(p) for p in pathway_files],
+            None,
+        ),
+        Case(
+            "graph/pathway_to_nx",
+            lambda _: [pnx.pathway_to_nx(p) for p in pathway_files],
+            None,
+        ),
+        Case(
+            "graph/library_cold",
+            lambda _: PathwayLibrary(paths["pathways"], bundle_path).pathways(),
+            cold_library,
+        ),
+        Case(
+            "graph/library_warm",
+            lambda _: PathwayLibrary(paths["pathways"], bundle_path).pathways(),
+            None,
+        ),
+    ]
+
+    for name, function in MEASURES.items():
+        cases.append(
+            Case(
+                f"centrality/{name}",
+                lambda _, f=function: [f(pw.graph) for pw in pathways],
+                None,
+            )
+        )
+    for name, function in CSR_MEASURES.items():
+        cases.append(
+            Case(
+                f"centrality_csr/{name}",
+                lambda _, f=function: [f(pw.graph) for pw in pathways],
+                None,
+            )
+        )
+
+    cases += [
+        Case(
+            "scoring/load_mutations",
+            lambda _: load_mutations(paths["sequencing"]),
+            None,
+        ),
+        Case(
+            "scoring/score_patients_with_f",
+            lambda pws: scoring.score_patients_with_f(
+                patients, nx.in_degree_centrality, pws, mutations
+            ),
+            fresh_pathways,
+        ),
+        Case(
+            f"scoring/reference_loop_{REFERENCE_PATIENTS}",
+            lambda pws: analysis_nx.process_patients_with_f(
+                patients[:REFERENCE_PATIENTS], nx.in_degree_centrality, pws, mutations
+            ),
+            fresh_pathways,
+        ),
+        Case(
+            "scoring/evaluate_measures",
+            lambda pws: scoring.evaluate_measures(
+                patients_log,
+                mutations,
+                pws,
+                {"indegree": nx.in_degree_centrality, "degree": nx.degree_centrality},
+            ),
+            fresh_pathways,
+        ),
+        Case(
+            "coexpression/build",
+            lambda _: coexpression_matrix(
+                paths["expression"],
+                paths["platform"],
+                genes,
+                cache_dir=coexpression_cache,
+            ),
+            cold_coexpression,
+        ),
+        Case(
+            "coexpression/threshold",
+            lambda coexpression: make_pathway_from_thres(0.5, coexpression),
+            lambda: coexpression_matrix(
+                paths["expression"],
+                paths["platform"],
+                genes,
+                cache_dir=coexpression_cache,
+            ),
+        ),
+        Case(
+            "coexpression/sparse_edges",
+            lambda _: coexpression_edges(
+                paths["expression"],
+                paths["platform"],
+                genes,
+                0.5,
+                cache_dir=coexpression_cache,
+            ),
+            cold_coexpression,
+        ),
+        Case(
+            "coexpression/topk",
+            lambda coexpression: make_pathway_topk(10, coexpression),
+            lambda: coexpression_matrix(
+                paths["expression"],
+                paths["platform"],
+                genes,
+                cache_dir=coexpression_cache,
+            ),
+        ),
+    ]
+
+    network_path = os.path.join(work_dir, "network")
+
+    def network_edges():
+        return make_pathway_from_thres(
+            0.3,
+            coexpression_matrix(
+                paths["expression"],
+                paths["platform"],
+                genes,
+                cache_dir=coexpression_cache,
+            ),
+            edges_only=True,
+        )
+
+    cases += [
+        Case(
+            "export/gexf_networkx",
+            lambda edges: nx.write_gexf(
+                pathway_from_edges("network", edges).graph, network_path + ".gexf"
+            ),
+            network_edges,
+        ),
+        Case(
+            "export/gexf_stream",
+            lambda edges: write_gexf(network_path + ".gexf", edges),
+            network_edges,
+        ),
+        Case(
+            "export/graphml_stream",
+            lambda edges: write_graphml(network_path + ".graphml", edges),
+            network_edges,
+        ),
+        Case(
+            "export/save_network",
+            lambda edges: save_network(network_path + ".npz", edges),
+            network_edges,
+        ),
+        Case(
+            "export/load_network",
+            lambda _: load_network(network_path + ".npz"),
+            lambda: save_network(network_path + ".npz", network_edges()),
+        ),
+    ]
+
+    try:
+        from mutation_colors import node_colors
+        from pathway_viewer import annotate_pathway, style_pathway
+        from graph_renderer import GraphPage
+        from render_cache import SvgTemplate
+        from viewer_tasks import render_svg
+    except ImportError as e:
+        log.warning(f"Skipping the viewer benchmarks: {e}")
+    else:
+        coexpression = coexpression_matrix(
+            paths["expression"], paths["platform"], genes, cache_dir=coexpression_cache
+        )
+        patient_mutations = analysis_nx.retrieve_mutations(
+            mutations.patients[0], mutations
+        )
+        cases += [
+            Case(
+                "startup/viewer",
+                cold_start(VIEWER_STARTUP, os.path.dirname(paths["sequencing"])),
+                None,
+            ),
+            Case(
+                "viewer/annotate",
+                lambda pathway: annotate_pathway(pathway, patient_mutations),
+                lambda: make_pathway_from_thres(0.5, coexpression),
+            ),
+            Case(
+                "viewer/layout",
+                lambda pathway: render_svg(pathway.graph),
+                lambda: style_pathway(make_pathway_from_thres(0.5, coexpression)),
+            ),
+            Case(
+                "viewer/recolor",
+                lambda template: template.render(node_colors(patient_mutations)),
+                lambda: SvgTemplate(
+                    render_svg(
+                        style_pathway(make_pathway_from_thres(0.5, coexpression)).graph
+                    )
+                ),
+            ),
+            Case(
+                "viewer/graph_page",
+                lambda edges: GraphPage(edges).render(node_colors(patient_mutations)),
+                network_edges,
+            ),
+        ]
+
+    return cases
+
+
+def selected(name, only):
+    return not only or any(pattern in name for pattern in only)
+
+
+def run_benchmarks(cases, repeats, only=None):
+    """Times the cases, by name. Failed cases are kept with their error"""
+    results = {}
+    for case in cases:
+        if not selected(case.name, only):
+            continue
+        try:
+            timing = time_case(case, repeats)
+        except Exception as e:
+            log.warning(f"{case.name} failed: {e!r}")
+            results[case.name] = {"error": repr(e)}
+            continue
+        results[case.name] = timing._asdict()
+        log.info(f"{case.name}: {timing.median * 1000:.2f} ms")
+
+    return results
+
+
+def compare(results, baseline):
+    """Prints every benchmark next to its baseline. Returns the names of the
+    ones that got slower, went over budget, failed or are missing, unless
+    they already failed in the baseline"""
+    regressions = []
+    print(f"{'benchmark':40} {'median':>12} {'baseline':>12} {'ratio':>7}")
+    names = list(results) + [name for name in baseline if name not in results]
+    for name in names:
+        timing = results.get(name)
+        reference = baseline.get(name)
+        known_failure = reference is not None and "error" in reference
+        if reference is None or known_failure:
+            columns = f"{'-':>12} {'-':>7}"
+        else:
+            columns = f"{reference['median'] * 1000:10.2f}ms"
+
+        if timing is None or "error" in timing:
+            flag = "  MISSING" if timing is None else "  FAILED"
+            if known_failure:
+                flag += " (as in the baseline)"
+            else:
+                regressions.append(name)
+            print(f"{name:40} {'-':>12} {columns:20}{flag}")
+            continue
+
+        flag = ""
+        if reference is not None and not known_failure:
+            ratio = timing["median"] / reference["median"]
+            columns += f" {ratio:7.2f}"
+            if ratio > REGRESSION_RATIO:
+                flag = "  REGRESSION"
+            elif ratio < 1 / REGRESSION_RATIO:
+                flag = "  faster"
+
+        budget = STARTUP_BUDGETS.get(name)
+        if budget is not None and timing["median"] > budget:
+            flag += f"  OVER BUDGET ({budget:.1f}s)"
+        if "REGRESSION" in flag or "BUDGET" in flag:
+            regressions.append(name)
+        print(f"{name:40} {timing['median'] * 1000:10.2f}ms {columns}{flag}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis stages on synthetic data"
+    )
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--pathways", type=int, default=10)
+    parser.add_argument("--genes-per-pathway", type=int, default=30)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--data", help="reuse (or generate once) the synthetic dataset in this folder"
+    )
+    parser.add_argument(
+        "--only", nargs="+", help="only run the benchmarks containing these names"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store these results as the new baseline",
+    )
+    parser.add_argument("--output", help="also save the results to this JSON file")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    work_dir = tempfile.mkdtemp(prefix="cancol-benchmark-")
+    data_dir = args.data or os.path.join(work_dir, "data")
+    if not os.path.exists(os.path.join(data_dir, "TRIBE2_seq_res.csv")):
+        synthetic_data.generate_dataset(
+            data_dir,
+            args.patients,
+            args.pathways,
+            args.genes_per_pathway,
+            args.samples,
+            args.seed,
+        )
+    paths = {
+        "patients_log": os.path.join(data_dir, "TRIBE2_db.csv"),
+        "sequencing": os.path.join(data_dir, "TRIBE2_seq_res.csv"),
+        "expression": os.path.join(data_dir, "GSE_series_matrix.txt"),
+        "platform": os.path.join(data_dir, "GPL570.txt"),
+        "pathways": os.path.join(data_dir, "pathways"),
+    }
+
+    try:
+        results = run_benchmarks(build_cases(paths, work_dir), args.repeats, args.only)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": {
+            "patients": args.patients,
+            "pathways": args.pathways,
+            "genes_per_pathway": args.genes_per_pathway,
+            "samples": args.samples,
+            "seed": args.seed,
+            "repeats": args.repeats,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["parameters"] != report["parameters"]:
+            log.warning("The baseline was measured with different parameters")
+        # Benchmarks left out with --only are not missing
+        reference = {
+            name: timing
+            for name, timing in baseline["results"].items()
+            if selected(name, args.only)
+        }
+        regressions = compare(results, reference)
+    else:
+        log.warning(f"No baseline at {args.baseline}, nothing to compare with")
+        compare(results, {})
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        log.info(f"Saved baseline to {args.baseline}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+
+CACHE_DIRECTORY = ".cache"
+
+
+def cache_path_for(path: str, extension: str) -> str:
+    """Returns the cache file used for a source file,
+    stored in a cache folder next to it"""
+    directory, filename = os.path.split(os.path.abspath(path))
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, CACHE_DIRECTORY, stem + extension)
+
+
+def file_signature(path: str) -> dict:
+    """Cheap file identity: size and modification time"""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def file_digest(path: str, block_size=1 << 20) -> str:
+    """SHA-1 of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cached_digest(path: str) -> str:
+    """file_digest, kept in a stamp in the cache folder next to the file
+    and only recomputed when the size or mtime of the file changed"""
+    stamp_path = cache_path_for(path, ".digest")
+    stamp = read_stamp(stamp_path)
+    signature = file_signature(path)
+    if stamp and all(stamp.get(key) == value for key, value in signature.items()):
+        return stamp["sha1"]
+
+    stamp = make_stamp(path)
+    try:
+        write_stamp(stamp_path, stamp)
+    except OSError:
+        pass
+    return stamp["sha1"]
+
+
+def read_stamp(path: str):
+    """Loads the JSON stamp stored next to a cache file, if any"""
+    try:
+        with open(path + ".json") as stamp:
+            return json.load(stamp)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(path: str, stamp: dict):
+    replace_atomically(path + ".json", json.dumps(stamp).encode())
+
+
+def cache_is_fresh(cache_path: str, source: str, **extra) -> bool:
+    """Checks if a cache file still describes its source file.
+    The contents are hashed only when size or mtime changed; if they are
+    still the same, the stamp is refreshed to skip hashing next time"""
+    stamp = read_stamp(cache_path)
+    if not stamp or not os.path.exists(cache_path):
+        return False
+    if any(stamp.get(key) != value for key, value in extra.items()):
+        return False
+    if not source_unchanged(stamp, source):
+        return False
+
+    signature = file_signature(source)
+    if signature["mtime"] != stamp.get("mtime"):
+        write_stamp(cache_path, {**stamp, **signature})
+    return True
+
+
+def source_unchanged(stamp: dict, source: str) -> bool:
+    """Compares a source file with a stamp made by make_stamp().
+    The contents are hashed only when size and mtime don't settle it"""
+    signature = file_signature(source)
+    if signature["size"] != stamp.get("size"):
+        return False
+    if signature["mtime"] == stamp.get("mtime"):
+        return True
+    return file_digest(source) == stamp.get("sha1")
+
+
+def make_stamp(source: str, **extra) -> dict:
+    return {**file_signature(source), "sha1": file_digest(source), **extra}
+
+
+def write_atomically(path: str, write):
+    """Calls write(tmp_path) to write a temporary file, then moves it in
+    place, as replace_atomically. A failed write leaves path untouched"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def replace_atomically(path: str, data: bytes):
+    """Writes data to a temporary file, then moves it in place.
+    Readers never see half-written files, concurrent writers just race
+    on which complete file ends up being kept"""
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as tmp:
+            tmp.write(data)
+
+    write_atomically(path, write)
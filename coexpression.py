@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging as log
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache_utils
+
+COEXPRESSION_VERSION = 2
+DEFAULT_CHUNKSIZE = 10000
+
+
+def probe_symbols(gene_db, genes, chunksize=DEFAULT_CHUNKSIZE):
+    """Maps the platform probes to their gene symbol,
+    keeping only the probes of the requested genes (None for all of them)"""
+    chunks = pd.read_csv(
+        gene_db,
+        sep="\t",
+        usecols=["ID", "Gene Symbol"],
+        dtype={"ID": str, "Gene Symbol": str},
+        chunksize=chunksize,
+    )
+    if genes is None:
+        probes = pd.concat(chunk.dropna(subset=["Gene Symbol"]) for chunk in chunks)
+    else:
+        genes = set(genes)
+        probes = pd.concat(chunk[chunk["Gene Symbol"].isin(genes)] for chunk in chunks)
+    probes = probes.drop_duplicates("ID")
+    return probes.set_index("ID")["Gene Symbol"]
+
+
+def gene_expression(expression_db, probes, chunksize=DEFAULT_CHUNKSIZE):
+    """Streams an expression table, averaging the probes of each gene.
+    Only a chunk of rows and the per-gene sums are kept in memory"""
+    symbols = pd.Index(np.sort(probes.unique()))
+    sums = counts = None
+
+    chunks = pd.read_csv(
+        expression_db, sep="\t", dtype={"ID_REF": str}, chunksize=chunksize
+    )
+    for chunk in chunks:
+        chunk = chunk[chunk["ID_REF"].isin(probes.index)]
+        if sums is None:
+            samples = chunk.columns.drop("ID_REF")
+            sums = np.zeros((len(symbols), len(samples)))
+            counts = np.zeros((len(symbols), len(samples)))
+        if chunk.empty:
+            continue
+
+        rows = symbols.get_indexer(chunk["ID_REF"].map(probes))
+        values = chunk[samples].to_numpy(dtype=np.float64)
+        present = ~np.isnan(values)
+        np.add.at(sums, rows, np.where(present, values, 0.0))
+        np.add.at(counts, rows, present)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    return pd.DataFrame(means, index=symbols, columns=samples)
+
+
+def standardize(expression, method="pearson", dtype=np.float32):
+    """Centers every gene of a gene × sample table and scales it to unit norm,
+    so that correlations are dot products. Returns the values, and which genes
+    have a defined correlation (not constant, not unmeasured). Missing values
+    are replaced by the mean of their gene (after ranking for Spearman), in
+    both correlate and sparse_coexpression"""
+    if method not in ["pearson", "spearman"]:
+        raise ValueError(f"Unsupported correlation method {method}")
+    if method == "spearman":
+        expression = expression.rank(axis=1)
+
+    # A copy: it is standardized in place
+    values = np.array(expression, dtype=np.float64)
+    del expression
+    missing = np.isnan(values)
+    partial = missing.any(axis=1) & ~missing.all(axis=1)
+    if partial.any():
+        log.warning(f"Imputing the mean of {partial.sum()} genes with missing values")
+
+    values[missing] = 0.0
+    present = np.maximum((~missing).sum(axis=1, keepdims=True), 1)
+    values -= values.sum(axis=1, keepdims=True) / present
+    values[missing] = 0.0
+    norms = np.linalg.norm(values, axis=1)
+    valid = norms > 0
+    values /= np.where(valid, norms, 1.0)[:, None]
+    return values.astype(dtype), valid
+
+
+def correlate(expression, method="pearson", dtype=np.float32):
+    """Gene × gene correlation of a gene × sample expression table, through
+    a single matrix product in the requested precision. Missing values are
+    imputed as in standardize; genes without a defined correlation are NaN"""
+    values, valid = standardize(expression, method, dtype)
+    corr = values @ values.T
+    np.clip(corr, -1, 1, out=corr)
+    # Constant genes have no correlation, not even with themselves
+    corr[~valid] = np.nan
+    corr[:, ~valid] = np.nan
+    np.fill_diagonal(corr, np.where(valid, 1, np.nan))
+    return pd.DataFrame(corr, index=expression.index, columns=expression.index)
+
+
+def coexpression_key(expression_db, gene_db, genes, method, dtype):
+    key = json.dumps(
+        [
+            COEXPRESSION_VERSION,
+            cache_utils.cached_digest(expression_db),
+            cache_utils.cached_digest(gene_db),
+            sorted(set(genes)) if genes is not None else None,
+            method,
+            np.dtype(dtype).name,
+        ]
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def coexpression_matrix(
+    expression_db,
+    gene_db,
+    genes,
+    method="pearson",
+    dtype=np.float32,
+    chunksize=DEFAULT_CHUNKSIZE,
+    cache_dir=cache_utils.CACHE_DIRECTORY,
+):
+    """Builds the coexpression matrix of the given genes, or loads it
+    memory-mapped if the same inputs were already processed"""
+    key = coexpression_key(expression_db, gene_db, genes, method, dtype)
+    matrix_path = os.path.join(cache_dir, "coexpression", key + ".npy")
+    genes_path = os.path.join(cache_dir, "coexpression", key + ".genes.json")
+
+    if os.path.exists(matrix_path) and os.path.exists(genes_path):
+        log.debug(f"Loading cached coexpression matrix {matrix_path}")
+        with open(genes_path) as genes_file:
+            symbols = pd.Index(json.load(genes_file))
+        corr = np.load(matrix_path, mmap_mode="r")
+        return pd.DataFrame(corr, index=symbols, columns=symbols)
+
+    log.info(f"Building coexpression matrix for {expression_db}, {gene_db}")
+    probes = probe_symbols(gene_db, genes, chunksize)
+    expression = gene_expression(expression_db, probes, chunksize)
+    coexpression = correlate(expression, method, dtype)
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as tmp:
+            np.save(tmp, coexpression.to_numpy())
+
+    cache_utils.write_atomically(matrix_path, write)
+    cache_utils.replace_atomically(
+        genes_path, json.dumps(coexpression.index.tolist()).encode()
+    )
+
+    return coexpression
@@ -0,0 +1,54 @@
+import base64
+import json
+import os
+
+import numpy as np
+
+from network_export import color_columns
+
+# Page drawing the graph, with @GRAPH_DATA@ replaced by its arrays
+PAGE_TEMPLATE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "graph_renderer.html"
+)
+GRAPH_PLACEHOLDER = "@GRAPH_DATA@"
+# Links drawn with the whole graph in view, the strongest first
+DEFAULT_EDGE_BUDGET = 20000
+
+
+def _encode(array, dtype):
+    """Little-endian bytes of an array, in base64, for the typed arrays of the page"""
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode()
+
+
+class GraphPage:
+    """Standalone page drawing a large pathway with WebGL, with a force
+    layout running in the page. As with SvgTemplate, the topology is
+    prepared once and colored for every patient"""
+
+    content_type = "text/html"
+
+    def __init__(self, edges, edge_budget=DEFAULT_EDGE_BUDGET):
+        linked = np.unique(np.concatenate([edges.sources, edges.targets]))
+        positions = np.zeros(len(edges.genes), dtype=np.int64)
+        positions[linked] = np.arange(len(linked))
+        # Strongest links first: the page only draws a prefix when zoomed out
+        order = np.argsort(-np.abs(edges.weights), kind="stable")
+
+        self.names = [str(gene) for gene in edges.genes[linked]]
+        self.topology = {
+            "names": self.names,
+            "sources": _encode(positions[edges.sources[order]], "<i4"),
+            "targets": _encode(positions[edges.targets[order]], "<i4"),
+            "weights": _encode(edges.weights[order], "<f4"),
+            "edgeBudget": edge_budget,
+        }
+        with open(PAGE_TEMPLATE, encoding="utf-8") as template:
+            self.template = template.read()
+
+    def render(self, colors) -> bytes:
+        """Page with nodes filled with colors[name], or white"""
+        fills = color_columns(self.names, {None: colors})[:, 0]
+        data = json.dumps({**self.topology, "colors": _encode(fills, "<u4")})
+        # Gene names can't end the script holding the data
+        data = data.replace("</", "<\\/")
+        return self.template.replace(GRAPH_PLACEHOLDER, data).encode()
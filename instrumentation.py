@@ -0,0 +1,184 @@
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+_tracer = None
+# Returned by span() when tracing is off: entering it does nothing
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    """Collects timed spans and counters, exported as a Chrome trace
+    (chrome://tracing, Perfetto). With memory, spans also record the
+    peak of Python allocations above their start, through tracemalloc.
+    That peak is process-wide, so only spans of the main thread record it:
+    spans of other threads would reset each other's peaks"""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.events = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        # Open spans of the current thread, with the peak of their children
+        self._stack = threading.local()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _open_spans(self):
+        if not hasattr(self._stack, "spans"):
+            self._stack.spans = []
+        return self._stack.spans
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        spans = self._open_spans()
+        memory = self.memory and threading.current_thread() is threading.main_thread()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if spans:
+                spans[-1][1] = max(spans[-1][1], peak)
+            tracemalloc.reset_peak()
+            spans.append([current, 0])
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            if memory:
+                start_memory, children_peak = spans.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], children_peak)
+                if spans:
+                    spans[-1][1] = max(spans[-1][1], peak)
+                args["peak_memory"] = peak - start_memory
+
+            event = {
+                "name": name,
+                "ph": "X",
+                # The monotonic clock is shared by the processes of a run,
+                # so spans recorded by workers line up with the parent's
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def merge(self, recorded):
+        """Adds the spans and counters recorded by another tracer,
+        as returned by recorded(), typically in a worker process"""
+        with self._lock:
+            self.events.extend(recorded["events"])
+            self.counters.update(recorded["counters"])
+
+    def recorded(self):
+        return {"events": list(self.events), "counters": dict(self.counters)}
+
+    def summary(self):
+        """Total time (seconds), calls and peak memory of every span name"""
+        spans = {}
+        for event in self.events:
+            stats = spans.setdefault(
+                event["name"], {"calls": 0, "seconds": 0.0, "peak_memory": 0}
+            )
+            stats["calls"] += 1
+            stats["seconds"] += event["dur"] / 1e6
+            stats["peak_memory"] = max(
+                stats["peak_memory"], event["args"].get("peak_memory", 0)
+            )
+
+        return {"spans": spans, "counters": dict(self.counters)}
+
+    def chrome_trace(self):
+        now = time.perf_counter_ns() / 1000
+        counters = [
+            {
+                "name": name,
+                "ph": "C",
+                "ts": now,
+                "pid": os.getpid(),
+                "args": {"value": value},
+            }
+            for name, value in self.counters.items()
+        ]
+        return {
+            "traceEvents": self.events + counters,
+            "displayTimeUnit": "ms",
+            "otherData": self.summary(),
+        }
+
+    def save(self, path):
+        with open(path, "w") as trace:
+            json.dump(self.chrome_trace(), trace)
+
+
+def enable_tracing(memory=False) -> Tracer:
+    """Starts collecting spans and counters, replacing any earlier tracer"""
+    global _tracer
+    _tracer = Tracer(memory)
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    if _tracer is not None and _tracer.memory:
+        tracemalloc.stop()
+    _tracer = None
+
+
+def active_tracer():
+    return _tracer
+
+
+def span(name, **args):
+    """Times the enclosed block when tracing is on:
+    with span("load", path=path): ..."""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **args)
+
+
+def traced(name=None):
+    """Decorator timing every call of a function when tracing is on"""
+
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, amount=1):
+    if _tracer is not None:
+        _tracer.count(name, amount)
+
+
+def _save_at_exit(path):
+    if _tracer is not None:
+        _tracer.save(path)
+
+
+# Tracing can be switched on for any script: CANCOL_TRACE=trace.json
+if os.environ.get("CANCOL_TRACE"):
+    enable_tracing(memory=bool(os.environ.get("CANCOL_TRACE_MEMORY")))
+    atexit.register(_save_at_exit, os.environ["CANCOL_TRACE"])
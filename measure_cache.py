@@ -0,0 +1,220 @@
+import functools
+import hashlib
+import inspect
+import json
+import logging as log
+import os
+import types
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import cache_utils
+
+MEASURE_CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_active_cache = None
+
+
+def _code_digest(code: types.CodeType, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        # Nested code objects (lambdas, comprehensions) have their address in repr()
+        if isinstance(const, types.CodeType):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+def _global_names(code: types.CodeType) -> set:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _value_repr(value, seen) -> str:
+    """repr() of a value read by a measure, without the memory addresses
+    that functions and modules have in theirs"""
+    if isinstance(value, types.ModuleType):
+        return f"<module {value.__name__}>"
+    if isinstance(value, (types.FunctionType, functools.partial)):
+        return _measure_name(value, seen)
+    return repr(value)
+
+
+def measure_name(function) -> str:
+    """Canonical name of a measure: qualified name, arguments bound with
+    functools.partial, and a digest of the bytecode, closure and module
+    globals it reads, so that equivalent lambdas share their entries and
+    edited functions don't"""
+    return _measure_name(function, set())
+
+
+def _measure_name(function, seen) -> str:
+    if isinstance(function, functools.partial):
+        arguments = [_value_repr(arg, seen) for arg in function.args]
+        arguments += [
+            f"{k}={_value_repr(v, seen)}" for k, v in sorted(function.keywords.items())
+        ]
+        return f"{_measure_name(function.func, seen)}({', '.join(arguments)})"
+
+    name = "{}.{}".format(
+        getattr(function, "__module__", None),
+        getattr(function, "__qualname__", type(function).__qualname__),
+    )
+    # Decorators may compile their wrapper lazily, on the first call:
+    # only the decorated function is stable
+    function = inspect.unwrap(function)
+    code = getattr(function, "__code__", None)
+    # Recursive functions are only digested once
+    if code is None or id(function) in seen:
+        return name
+    seen.add(id(function))
+
+    digest = hashlib.sha1()
+    _code_digest(code, digest)
+    for cell in function.__closure__ or []:
+        digest.update(_value_repr(cell.cell_contents, seen).encode())
+    namespace = getattr(function, "__globals__", {})
+    for global_name in sorted(_global_names(code) & namespace.keys()):
+        value = _value_repr(namespace[global_name], seen)
+        digest.update(f"{global_name}={value}".encode())
+    return f"{name}#{digest.hexdigest()[:16]}"
+
+
+def graph_fingerprint(graph) -> str:
+    """Digest of the structure of a pathway graph:
+    node IDs with their label and famcom weight, plus the edges"""
+    nodes = sorted(
+        (str(node), str(data.get("label")), repr(data.get("famcomw")))
+        for node, data in graph.nodes(data=True)
+    )
+    edges = sorted((str(u), str(v)) for u, v in graph.edges())
+    if not graph.is_directed():
+        edges = sorted(tuple(sorted(edge)) for edge in edges)
+
+    digest = hashlib.sha1()
+    digest.update(type(graph).__name__.encode())
+    digest.update(json.dumps(nodes).encode())
+    digest.update(json.dumps(edges).encode())
+    return digest.hexdigest()
+
+
+class MeasureCache:
+    """On-disk cache of Pathway.calculate_measure results, shared between
+    processes. Entries are small .npz files named after a digest of
+    (graph, measure, hierarchy flag); the least recently used ones are
+    evicted once the cache grows above max_bytes"""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.path.join(
+            cache_utils.CACHE_DIRECTORY, "measures"
+        )
+        self.max_bytes = max_bytes
+        # Fingerprints are remembered as long as the graph object is alive
+        self._fingerprints = weakref.WeakKeyDictionary()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _fingerprint(self, graph):
+        if graph not in self._fingerprints:
+            self._fingerprints[graph] = graph_fingerprint(graph)
+        return self._fingerprints[graph]
+
+    def entry_path(self, graph, function, with_complexes):
+        key = json.dumps(
+            [
+                MEASURE_CACHE_VERSION,
+                self._fingerprint(graph),
+                measure_name(function),
+                bool(with_complexes),
+            ]
+        )
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode()).hexdigest() + ".npz"
+        )
+
+    def get(self, graph, function, with_complexes=False):
+        path = self.entry_path(graph, function, with_complexes)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                weights = pd.Series(entry["values"], index=entry["labels"].tolist())
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return weights
+
+    def put(self, graph, function, with_complexes, weights: pd.Series):
+        path = self.entry_path(graph, function, with_complexes)
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as tmp:
+                np.savez(
+                    tmp,
+                    # Fixed-width strings, object arrays can't be loaded back
+                    labels=weights.index.astype(str).to_numpy(dtype=str),
+                    values=weights.to_numpy(),
+                )
+
+        try:
+            cache_utils.write_atomically(path, write)
+        except ValueError:
+            # Values that can't be stored without pickling are just not cached
+            log.debug(f"Not caching {measure_name(function)}: unsupported values")
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits max_bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".npz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process got there first
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                os.remove(entry.path)
+
+
+def enable_measure_cache(directory=None, max_bytes=DEFAULT_MAX_BYTES) -> MeasureCache:
+    """Makes every Pathway.calculate_measure go through an on-disk cache"""
+    global _active_cache
+    _active_cache = MeasureCache(directory, max_bytes)
+    return _active_cache
+
+
+def disable_measure_cache():
+    global _active_cache
+    _active_cache = None
+
+
+def active_cache():
+    return _active_cache
+
+
+if os.environ.get("CANCOL_MEASURE_CACHE"):
+    enable_measure_cache(os.environ["CANCOL_MEASURE_CACHE"])
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import argparse
+import logging as log
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+import pathway_csr
+from pathway_library import PathwayLibrary
+
+# Measures used throughout the notebooks, by the name used in their results
+MEASURES = {
+    "indegree": nx.in_degree_centrality,
+    "outdegree": nx.out_degree_centrality,
+    "degree": nx.degree_centrality,
+    "betweenness": nx.betweenness_centrality,
+    "closeness": nx.closeness_centrality,
+    "eigenvector": nx.eigenvector_centrality_numpy,
+}
+
+# Array-based versions of the same measures, for large coexpression graphs
+CSR_MEASURES = {
+    "indegree": pathway_csr.in_degree_centrality,
+    "outdegree": pathway_csr.out_degree_centrality,
+    "degree": pathway_csr.degree_centrality,
+    "betweenness": pathway_csr.betweenness_centrality,
+    "closeness": pathway_csr.closeness_centrality,
+    "eigenvector": pathway_csr.eigenvector_centrality,
+}
+
+# Graph structure, with the numeric attributes measures may read: nodes are
+# positions in the node list, node_data and edge_data map attribute names
+# to arrays, NaN where a node or edge doesn't have the attribute
+CompactGraph = namedtuple(
+    "CompactGraph",
+    ["nodes", "sources", "targets", "directed", "node_data", "edge_data"],
+)
+# Attributes kept by compact_graph: famcom weights, and |r| of coexpression
+# graphs. Measures reading any other attribute can't run in worker processes
+NODE_ATTRIBUTES = ["famcomw"]
+EDGE_ATTRIBUTES = ["weight"]
+
+
+def _attribute_columns(items, names):
+    """Arrays of the attributes of the items (data dicts) that any has"""
+    columns = {}
+    for name in names:
+        values = [data.get(name) for data in items]
+        if any(value is not None for value in values):
+            columns[name] = np.array(
+                [np.nan if value is None else value for value in values],
+                dtype=np.float64,
+            )
+
+    return columns
+
+
+def _attribute_dicts(count, columns):
+    """Data dicts of count items from _attribute_columns"""
+    dicts = [{} for _ in range(count)]
+    for name, values in columns.items():
+        for data, value in zip(dicts, values.tolist()):
+            if not np.isnan(value):
+                data[name] = value
+
+    return dicts
+
+
+def compact_graph(graph) -> CompactGraph:
+    nodes = list(graph.nodes)
+    position = {node: i for i, node in enumerate(nodes)}
+    edge_list = list(graph.edges(data=True))
+    edges = np.array(
+        [(position[u], position[v]) for u, v, _ in edge_list], dtype=np.int32
+    ).reshape(-1, 2)
+    return CompactGraph(
+        nodes,
+        edges[:, 0],
+        edges[:, 1],
+        graph.is_directed(),
+        _attribute_columns(
+            [data for _, data in graph.nodes(data=True)], NODE_ATTRIBUTES
+        ),
+        _attribute_columns([data for _, _, data in edge_list], EDGE_ATTRIBUTES),
+    )
+
+
+def expand_graph(compact: CompactGraph):
+    graph = nx.DiGraph() if compact.directed else nx.Graph()
+    # Same insertion order as the source graph, for reproducible results
+    graph.add_nodes_from(
+        enumerate(_attribute_dicts(len(compact.nodes), compact.node_data))
+    )
+    graph.add_edges_from(
+        zip(
+            compact.sources.tolist(),
+            compact.targets.tolist(),
+            _attribute_dicts(len(compact.sources), compact.edge_data),
+        )
+    )
+    return graph
+
+
+def _run_measure(compact: CompactGraph, function):
+    weights = function(expand_graph(compact))
+    return np.array([weights[i] for i in range(len(compact.nodes))])
+
+
+def resolve_measures(measures, csr=False):
+    """Turns measure names or functions into a {name: function} dict"""
+    registry = CSR_MEASURES if csr else MEASURES
+    resolved = {}
+    for measure in measures:
+        if isinstance(measure, str):
+            resolved[measure] = registry[measure]
+        else:
+            resolved[getattr(measure, "__name__", repr(measure))] = measure
+
+    return resolved
+
+
+def precompute_measures(
+    pathways, measures, hierarchy=(False, True), jobs=None, csr=False
+):
+    """Computes every measure on every pathway, fanning the missing
+    ones out to a process pool, and fills each Pathway.measures.
+    Returns a tidy (pathway, measure, hierarchy, gene, weight) table.
+    With csr, measure names refer to the array-based implementations"""
+    measures = resolve_measures(measures, csr)
+    hierarchy = [hierarchy] if isinstance(hierarchy, bool) else list(hierarchy)
+
+    missing = [
+        (pw, function)
+        for pw in pathways
+        for function in measures.values()
+        if any(pw.cached_measure(function, flag) is None for flag in hierarchy)
+    ]
+    log.info(f"Computing {len(missing)} measures with {jobs or os.cpu_count()} jobs")
+
+    compacts = {id(pw): compact_graph(pw.graph) for pw, _ in missing}
+    jobs_args = ([compacts[id(pw)] for pw, _ in missing], [f for _, f in missing])
+    if jobs == 1:
+        results = map(_run_measure, *jobs_args)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # map() keeps the order of the jobs, whatever the worker count
+            results = list(pool.map(_run_measure, *jobs_args))
+
+    for (pw, function), values in zip(missing, results):
+        node_weights = dict(zip(compacts[id(pw)].nodes, values))
+        for flag in hierarchy:
+            if pw.cached_measure(function, flag) is None:
+                pw.store_measure(function, node_weights, flag)
+
+    return measure_table(pathways, measures, hierarchy)
+
+
+def measure_table(pathways, measures, hierarchy=(False, True)):
+    """Tidy table of the weights already computed for the pathways"""
+    tables = []
+    for pw in pathways:
+        for name, function in measures.items():
+            for flag in hierarchy:
+                weights = pw.calculate_measure(function, flag)
+                tables.append(
+                    pd.DataFrame(
+                        {
+                            "pathway": pw.name,
+                            "measure": name,
+                            "hierarchy": flag,
+                            "gene": weights.index,
+                            "weight": weights.to_numpy(),
+                        }
+                    )
+                )
+
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute centrality measures for all the pathways"
+    )
+    parser.add_argument("--pathways", default="./pathways/")
+    parser.add_argument("--measures", nargs="+", default=list(MEASURES))
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument(
+        "--csr", action="store_true", help="use the array-based implementations"
+    )
+    parser.add_argument("--output", default="pathway_measures.csv")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    pathways = PathwayLibrary(args.pathways).pathways()
+
+    table = precompute_measures(pathways, args.measures, jobs=args.jobs, csr=args.csr)
+    table.to_csv(args.output, index=False)
+    log.info(f"Saved {len(table)} weights to {args.output}")
@@ -0,0 +1,73 @@
+import math
+
+WHITE = 0xFFFFFF
+RED = 0xFF0000
+
+
+def lerp(a, b, t):
+    return a * (1 - t) + b * t
+
+
+def _round(x):
+    return math.floor(x + 0.5)
+
+
+def _to_8bit(x):
+    """0-255 value of a 0-1 component, stored on 16 bits as in QColor"""
+    return _round(_round(x * 0xFFFF) / 0x101)
+
+
+def rgb_to_hsv(color):
+    """Hue (degrees, -1 for greys), saturation and value (0-255) of a
+    0xRRGGBB color, rounded as QColor.toHsv"""
+    r, g, b = ((color >> shift & 0xFF) / 255 for shift in (16, 8, 0))
+    high = max(r, g, b)
+    delta = high - min(r, g, b)
+    value = _to_8bit(high)
+    if delta == 0:
+        return -1, 0, value
+
+    if r == high:
+        hue = (g - b) / delta
+    elif g == high:
+        hue = 2 + (b - r) / delta
+    else:
+        hue = 4 + (r - g) / delta
+    hue = hue * 60 % 360
+    return _round(hue * 100) // 100, _to_8bit(delta / high), value
+
+
+def hsv_to_rgb(hue, saturation, value):
+    """0xRRGGBB color of a hue, saturation and value, as QColor.fromHsv"""
+    v = value / 255
+    if hue == -1:
+        r = g = b = v
+    else:
+        s = saturation / 255
+        h = hue % 360 / 60
+        i = int(h)
+        f = h - i
+        p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+        r, g, b = [(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)][i]
+
+    return _to_8bit(r) << 16 | _to_8bit(g) << 8 | _to_8bit(b)
+
+
+def percentage_to_rgb(percentage, base_color=WHITE, target_color=RED):
+    """Color between base_color and target_color, interpolated in HSV"""
+    start = rgb_to_hsv(base_color)
+    end = rgb_to_hsv(target_color)
+    h, s, v = (int(lerp(a, b, percentage / 100)) for a, b in zip(start, end))
+    return "#%06x" % hsv_to_rgb(h, s, v)
+
+
+def node_colors(mutations):
+    """Fill color of the mutated genes of a patient, by mutation percentage"""
+    if "NGS_PercentMutated" not in mutations:
+        return {}
+
+    # Mutations without a known percentage are left uncolored
+    known = mutations.dropna(subset=["NGS_PercentMutated"])
+    return dict(
+        zip(known["Biomarker"], known["NGS_PercentMutated"].map(percentage_to_rgb))
+    )
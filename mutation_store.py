@@ -0,0 +1,103 @@
+import logging as log
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+import cache_utils
+from instrumentation import count, traced
+
+STORE_VERSION = 1
+STORE_COLUMNS = [
+    "PatientFirstName",
+    "Biomarker",
+    "Technology",
+    "TestResult",
+    "NGS_PercentMutated",
+]
+CATEGORICAL_COLUMNS = ["PatientFirstName", "Biomarker", "Technology", "TestResult"]
+
+
+def relevant_mutations(seq_data):
+    """Keeps only NGS results with variants or pathogenic mutations"""
+    if isinstance(seq_data, MutationStore):
+        return seq_data.data
+
+    return seq_data[
+        (seq_data["Technology"] == "NGS Q3")
+        # We only care about variants and pathogenic mutations
+        & (seq_data["TestResult"].isin(["variantdetected", "Mutated, Pathogenic"]))
+    ]
+
+
+class MutationStore:
+    """Filtered sequencing results, sorted by patient.
+    Rows of a patient are a contiguous slice of the data"""
+
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+        self._patients = data["PatientFirstName"].cat.categories
+        codes = data["PatientFirstName"].cat.codes.to_numpy()
+        # Row range of the i-th patient is offsets[i]:offsets[i + 1]
+        self._offsets = np.searchsorted(codes, np.arange(len(self._patients) + 1))
+
+    @property
+    def patients(self):
+        """Patients with at least one relevant mutation"""
+        return self._patients[np.diff(self._offsets) > 0].tolist()
+
+    @property
+    def biomarkers(self):
+        """All the biomarkers found in the source file, including
+        the ones without any relevant mutation"""
+        return self.data["Biomarker"].cat.categories
+
+    def retrieve_mutations(self, pid):
+        if pid in self._patients:
+            idx = self._patients.get_loc(pid)
+            start, stop = self._offsets[idx], self._offsets[idx + 1]
+        else:
+            start = stop = 0
+
+        patient_data = self.data.iloc[start:stop][["Biomarker", "NGS_PercentMutated"]]
+        return patient_data.astype({"Biomarker": object})
+
+
+def build_store(path: str) -> pd.DataFrame:
+    """Converts a sequencing results CSV to the store layout"""
+    seq_data = pd.read_csv(path, usecols=STORE_COLUMNS)
+    # Categories are assigned before filtering,
+    # so that every biomarker of the source file is kept
+    seq_data = seq_data.astype({column: "category" for column in CATEGORICAL_COLUMNS})
+    seq_data = relevant_mutations(seq_data)
+
+    order = np.argsort(seq_data["PatientFirstName"].cat.codes.to_numpy(), kind="stable")
+    return seq_data.iloc[order].reset_index(drop=True)
+
+
+@traced("load.mutations")
+def load_mutations(path: str, cache_path=None) -> MutationStore:
+    """Loads sequencing results, going through a Feather cache that is
+    rebuilt whenever the source CSV changes"""
+    cache_path = cache_path or cache_utils.cache_path_for(path, ".feather")
+
+    if cache_utils.cache_is_fresh(cache_path, path, version=STORE_VERSION):
+        log.debug(f"Loading cached mutations from {cache_path}")
+        count("mutations.cache_hit")
+        data = feather.read_table(cache_path, memory_map=True).to_pandas()
+        return MutationStore(data)
+
+    log.info(f"Building mutations cache for {path}")
+    count("mutations.cache_miss")
+    # Stamp the source before reading it, a concurrent change will
+    # then just trigger another rebuild
+    stamp = cache_utils.make_stamp(path, version=STORE_VERSION)
+    data = build_store(path)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    cache_utils.write_atomically(
+        cache_path, lambda tmp_path: feather.write_feather(table, tmp_path)
+    )
+    cache_utils.write_stamp(cache_path, stamp)
+
+    return MutationStore(data)
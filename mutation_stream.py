@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import argparse
+import logging as log
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet
+from scipy import sparse
+
+import scoring
+from instrumentation import traced
+from measures import MEASURES
+from mutation_store import relevant_mutations
+from pathway_library import PathwayLibrary
+
+DEFAULT_CHUNKSIZE = 100000
+# Sequencing results not sorted by patient are split by patient on disk
+# into partitions of about this size, aggregated one at a time
+DEFAULT_PARTITION_BYTES = 256 * 2**20
+STREAM_COLUMNS = [
+    "PatientFirstName",
+    "Biomarker",
+    "Technology",
+    "TestResult",
+    "NGS_PercentMutated",
+]
+SPILL_SCHEMA = pa.schema(
+    [
+        ("PatientFirstName", pa.string()),
+        ("Biomarker", pa.string()),
+        ("NGS_PercentMutated", pa.float64()),
+    ]
+)
+
+
+def read_relevant_chunks(path, genes, chunksize=DEFAULT_CHUNKSIZE):
+    """Streams the relevant mutations from a sequencing results CSV, one
+    chunk of rows at a time. Mutations of other genes than the given ones
+    have no Biomarker: they only tell that their patient is scored"""
+    genes = set(genes)
+    chunks = pd.read_csv(
+        path,
+        usecols=STREAM_COLUMNS,
+        dtype={"PatientFirstName": str, "Biomarker": str},
+        chunksize=chunksize,
+    )
+    for chunk in chunks:
+        chunk = relevant_mutations(chunk).dropna(subset=["PatientFirstName"])
+        in_genes = chunk["Biomarker"].isin(genes)
+        yield pd.DataFrame(
+            {
+                "PatientFirstName": chunk["PatientFirstName"],
+                "Biomarker": chunk["Biomarker"].where(in_genes),
+                "NGS_PercentMutated": chunk["NGS_PercentMutated"].where(in_genes),
+            }
+        )
+
+
+def _chunk_maxima(chunk, patients):
+    if patients is not None:
+        chunk = chunk[chunk["PatientFirstName"].isin(patients)]
+    return chunk.groupby(["PatientFirstName", "Biomarker"], sort=False, dropna=False)[
+        "NGS_PercentMutated"
+    ].max()
+
+
+def _merge_maxima(maxima):
+    # max() skips missing percentages, like the in-memory scoring
+    return pd.concat(maxima).groupby(level=[0, 1], sort=False, dropna=False).max()
+
+
+def sorted_maxima(chunks, patients=None):
+    """Aggregates the highest NGS_PercentMutated of every (patient, gene)
+    pair of results sorted by patient, yielding the pairs of the patients
+    that are done. A patient is done as soon as the next one starts, so
+    only one patient is kept pending"""
+    patients = None if patients is None else set(patients)
+    pending = None
+    last = None
+
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+
+        names = chunk["PatientFirstName"].to_numpy()
+        if (last is not None and names[0] < last) or (names[1:] < names[:-1]).any():
+            raise ValueError(
+                "Sequencing results are not sorted by patient, "
+                "stream them with sorted_by_patient=False"
+            )
+        last = names[-1]
+
+        maxima = _chunk_maxima(chunk, patients)
+        if pending is not None:
+            maxima = _merge_maxima([pending, maxima])
+        chunk_patients = maxima.index.get_level_values(0)
+        finished = maxima[chunk_patients != last]
+        pending = maxima[chunk_patients == last]
+        if not finished.empty:
+            yield finished
+
+    if pending is not None and not pending.empty:
+        yield pending
+
+
+def partitioned_maxima(chunks, patients=None, partitions=1, spill_dir=None):
+    """Aggregates the (patient, gene) maxima of results in any order.
+    The maxima of every chunk are first split by patient into partitions
+    on disk, then each partition is aggregated and yielded on its own:
+    memory depends on the size of a partition, not of the whole file"""
+    patients = None if patients is None else set(patients)
+    if partitions == 1:
+        maxima = [_chunk_maxima(chunk, patients) for chunk in chunks]
+        if maxima:
+            maxima = _merge_maxima(maxima)
+            if not maxima.empty:
+                yield maxima
+        return
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as spill:
+        paths = [os.path.join(spill, f"{i}.arrow") for i in range(partitions)]
+        writers = [pa.ipc.new_file(path, SPILL_SCHEMA) for path in paths]
+        try:
+            for chunk in chunks:
+                maxima = _chunk_maxima(chunk, patients).reset_index()
+                partition = (
+                    pd.util.hash_array(maxima["PatientFirstName"].to_numpy())
+                    % partitions
+                )
+                for i, rows in maxima.groupby(partition):
+                    writers[i].write_table(
+                        pa.Table.from_pandas(
+                            rows, schema=SPILL_SCHEMA, preserve_index=False
+                        )
+                    )
+        finally:
+            for writer in writers:
+                writer.close()
+
+        for path in paths:
+            with pa.memory_map(path) as source:
+                rows = pa.ipc.open_file(source).read_all().to_pandas()
+            if rows.empty:
+                continue
+            rows = rows.set_index(["PatientFirstName", "Biomarker"])
+            yield _merge_maxima([rows["NGS_PercentMutated"]])
+
+
+def score_maxima(maxima, genes, weights, names):
+    """Scores a batch of (patient, gene) maxima against a gene × pathway
+    matrix of normalized weights"""
+    patients = maxima.index.get_level_values(0).unique()
+    columns = genes.get_indexer(maxima.index.get_level_values(1))
+    # Patients whose mutations are all outside of the pathways score 0
+    in_genes = columns >= 0
+    values = sparse.csr_matrix(
+        (
+            # Missing percentages don't contribute to the score
+            maxima.fillna(0.0).to_numpy(dtype=np.float64)[in_genes],
+            (
+                patients.get_indexer(maxima.index.get_level_values(0))[in_genes],
+                columns[in_genes],
+            ),
+        ),
+        shape=(len(patients), len(genes)),
+    )
+
+    return (
+        pd.DataFrame(values @ weights, index=patients, columns=names)
+        .rename_axis("PatientFirstName")
+        .reset_index()
+    )
+
+
+def stream_scores(
+    path,
+    pathways,
+    config,
+    patients=None,
+    chunksize=DEFAULT_CHUNKSIZE,
+    sorted_by_patient=False,
+    partition_bytes=DEFAULT_PARTITION_BYTES,
+    spill_dir=None,
+):
+    """Scores the patients of a sequencing results CSV without loading it,
+    yielding a frame of scores whenever some patients are done.
+    config maps every pathway name to a scoring.PathwayConfig.
+    Results sorted by patient are scored as they are read, others are
+    first split by patient into partitions of about partition_bytes,
+    written to spill_dir. Scores are always floats, unlike
+    scoring.score_patients_with_config"""
+    genes = pd.Index(
+        [gene for pw in pathways for gene in pw.get_genes()]
+    ).drop_duplicates()
+    weights, _ = scoring.configured_weight_matrix(
+        pathways, genes, [config[pw.name] for pw in pathways]
+    )
+    names = [pw.name for pw in pathways]
+
+    chunks = read_relevant_chunks(path, genes, chunksize)
+    if sorted_by_patient:
+        batches = sorted_maxima(chunks, patients)
+    else:
+        partitions = max(1, -(-os.path.getsize(path) // partition_bytes))
+        batches = partitioned_maxima(chunks, patients, partitions, spill_dir)
+    for maxima in batches:
+        yield score_maxima(maxima, genes, weights, names)
+
+
+@traced("export.parquet")
+def write_scores(batches, output) -> int:
+    """Appends score frames to a Parquet file as they come,
+    one row group per frame. Returns the number of patients written"""
+    writer = None
+    written = 0
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    try:
+        for batch in batches:
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                writer = parquet.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+            written += len(batch)
+            log.debug(f"{written} patients scored")
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+
+    if writer is None:
+        log.warning(f"No patient to score, {output} was not written")
+        return 0
+
+    writer.close()
+    os.replace(tmp_path, output)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score sequencing results too large to fit in memory"
+    )
+    parser.add_argument("sequencing", help="sequencing results CSV")
+    parser.add_argument("output", help="Parquet file receiving the scores")
+    parser.add_argument("--pathways", default="./pathways/")
+    parser.add_argument(
+        "--measure", default="indegree", choices=list(MEASURES) + [scoring.BASELINE]
+    )
+    parser.add_argument("--complexes", action="store_true")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="rows are sorted by patient, scores are written as patients are done",
+    )
+    parser.add_argument(
+        "--partition-mb",
+        type=int,
+        default=DEFAULT_PARTITION_BYTES // 2**20,
+        help="without --sorted, results are split by patient into partitions "
+        "of about this size, next to the output",
+    )
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    pathways = PathwayLibrary(args.pathways).pathways()
+    measure = MEASURES.get(args.measure, args.measure)
+    config = {
+        pw.name: scoring.PathwayConfig(measure, args.complexes) for pw in pathways
+    }
+
+    written = write_scores(
+        stream_scores(
+            args.sequencing,
+            pathways,
+            config,
+            chunksize=args.chunksize,
+            sorted_by_patient=args.sorted,
+            partition_bytes=args.partition_mb * 2**20,
+            spill_dir=os.path.dirname(os.path.abspath(args.output)),
+        ),
+        args.output,
+    )
+    log.info(f"Saved the scores of {written} patients to {args.output}")
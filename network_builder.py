@@ -1,59 +1,289 @@
 #!/usr/bin/env python
-from dataclasses import dataclass, field
+from collections import namedtuple
 
 import networkx as nx
 import numpy as np
 import pandas as pd
 
+from pathways_nx import Pathway
 
-@dataclass
-class Pathway:
-    name: str
-    graph: nx.Graph
-    measures: dict = field(default_factory=dict)
-
-    def calculate_measure(self, function, with_complexes=False):
-        """Returns a series with weights for a specific function.
-        Indexed by biomarker (*not* ID)"""
-        # Cache results
-        if function in self.measures and with_complexes in self.measures[function]:
-            return self.measures[function][with_complexes]
-
-        gene_names = nx.get_node_attributes(self.graph, "label")
-        weights = function(self.graph)
-        # Index by biomarker
-        weights = {gene_names[k]: weights[k] for k, _ in weights.items()}
-
-        # Separate paths as optimization
-        self.measures[function] = {}
-        if not with_complexes:
-            self.measures[function][with_complexes] = pd.Series(weights)
-            return self.measures[function][with_complexes]
-        else:
-            gene_weights = nx.get_node_attributes(self.graph, "famcomw")
-            self.measures[function][with_complexes] = pd.Series(weights).mul(
-                pd.Series(
-                    {gene_names[k]: gene_weights[k] for k, v in gene_weights.items()}
-                )
-            )
-            return self.measures[function][with_complexes]
+# Edges are positions in genes, weights are the signed correlations
+EdgeList = namedtuple("EdgeList", ["genes", "sources", "targets", "weights"])
+
+# Memory (bytes) for the block of coexpression rows ranked at once by
+# topk_edges
+DEFAULT_BLOCK_MEMORY = 64 * 2**20
+# Bytes per correlation ranked by topk_pairs: r, |r| and argpartition positions
+TOPK_BYTES = 4 + 4 + 8
+# Bytes per gene picked by topk_pairs: its position and r, then the pairs
+# and their sort by np.unique
+TOPK_PICK_BYTES = 8 + 4 + 36
+
+
+def threshold_edges(threshold, coexpression) -> EdgeList:
+    """Returns the pairs of genes whose |r| is above the threshold.
+    Every pair is listed once, with source < target. The coexpression
+    is a matrix, or the EdgeList of a lower threshold (see
+    sparse_coexpression)"""
+    if isinstance(coexpression, EdgeList):
+        weights = coexpression.weights
+        linked = (weights > threshold) | (weights < -threshold)
+        return EdgeList(
+            coexpression.genes,
+            coexpression.sources[linked],
+            coexpression.targets[linked],
+            weights[linked],
+        )
+
+    genes = coexpression.columns
+    if not coexpression.index.equals(genes):
+        coexpression = coexpression.reindex(index=genes)
+    values = coexpression.to_numpy()
 
-    def get_genes(self):
-        return nx.get_node_attributes(self.graph, "label").values()
+    linked = (values > threshold) | (values < -threshold)
+    # Self loops are ignored, and an edge counts if either half of the matrix has it
+    linked = np.triu(linked | linked.T, k=1)
+    sources, targets = np.nonzero(linked)
 
+    return EdgeList(genes.to_numpy(), sources, targets, values[sources, targets])
 
-def make_pathway_from_thres(threshold, coexpression):
-    coexpression = coexpression.applymap(lambda x: 1 if abs(x) > threshold else 0)
-    np.fill_diagonal(coexpression.values, 0)
+
+def pathway_from_edges(name, edges: EdgeList, weighted=False) -> Pathway:
+    """Builds an undirected pathway containing only the linked genes.
+    With weighted, edges get a "weight" attribute of |r|"""
     graph = nx.Graph()
-    for gene in coexpression:
-        for other in coexpression.columns:
-            if coexpression[gene][other] == 1:
-                if gene not in graph:
-                    graph.add_node(gene, label=gene)
-                if other not in graph:
-                    graph.add_node(other, label=other)
+    # Genes in order of first appearance, as the original pairwise loop
+    # added them: layouts and tie-breaks depend on it
+    ends = np.column_stack([edges.sources, edges.targets]).ravel()
+    linked, first = np.unique(ends, return_index=True)
+    linked = linked[np.argsort(first)]
+    graph.add_nodes_from((gene, {"label": gene}) for gene in edges.genes[linked])
+    pairs = zip(
+        edges.genes[edges.sources].tolist(), edges.genes[edges.targets].tolist()
+    )
+    if weighted:
+        graph.add_weighted_edges_from(
+            (source, target, weight)
+            for (source, target), weight in zip(pairs, np.abs(edges.weights).tolist())
+        )
+    else:
+        graph.add_edges_from(pairs)
+
+    return Pathway(name, graph)
+
+
+def make_pathway_from_thres(threshold, coexpression, edges_only=False):
+    """Links every pair of genes with |r| above the threshold.
+    With edges_only, the EdgeList is returned without building a graph"""
+    edges = threshold_edges(threshold, coexpression)
+    if edges_only:
+        return edges
+
+    return pathway_from_edges("GPL570-{}".format(threshold), edges)
+
+
+def topk_pairs(k, count, block_correlations, block_rows, mutual=False):
+    """Links each of count genes to the k genes with the strongest |r| with
+    it, as topk_edges. block_correlations(rows) returns the float32
+    correlations of a slice of rows with every gene, NaN where undefined.
+    Returns the sources, targets and correlations of the pairs"""
+    k = min(k, count - 1)
+    if k <= 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float32)
+
+    partners = np.empty((count, k), dtype=np.int64)
+    weights = np.empty((count, k), dtype=np.float32)
+    for start in range(0, count, block_rows):
+        stop = min(start + block_rows, count)
+        corr = block_correlations(slice(start, stop))
+        strengths = np.abs(corr)
+        # Undefined correlations and self loops are never picked first
+        np.nan_to_num(strengths, copy=False, nan=-1.0)
+        strengths[np.arange(stop - start), np.arange(start, stop)] = -1.0
+        picks = np.argpartition(strengths, count - k, axis=1)[:, count - k :]
+        partners[start:stop] = picks
+        weights[start:stop] = np.take_along_axis(corr, picks, axis=1)
+
+    rows = np.repeat(np.arange(count), k)
+    columns = partners.ravel()
+    weights = weights.ravel()
+    # Genes with fewer than k defined correlations picked some undefined ones
+    picked = (rows != columns) & ~np.isnan(weights)
+    rows, columns, weights = rows[picked], columns[picked], weights[picked]
+
+    # A pair picked by both of its genes appears twice
+    pairs, first, picks = np.unique(
+        np.minimum(rows, columns) * count + np.maximum(rows, columns),
+        return_index=True,
+        return_counts=True,
+    )
+    weights = weights[first]
+    if mutual:
+        pairs, weights = pairs[picks == 2], weights[picks == 2]
+    sources, targets = np.divmod(pairs, count)
+    return sources, targets, weights
+
+
+def topk_edges(
+    k, coexpression, mutual=False, block_memory=DEFAULT_BLOCK_MEMORY
+) -> EdgeList:
+    """Links every gene to the k genes with the strongest |r| with it.
+    A pair is an edge if either gene picked the other, or both with mutual.
+    Rows are ranked a block at a time with argpartition, so memory is O(n·k)
+    and a block of rows, besides the O(n²) coexpression matrix itself: gene
+    sets too large for the matrix go through
+    sparse_coexpression.topk_correlation_edges instead. Every pair is listed
+    once, with source < target, ordered as threshold_edges"""
+    genes = coexpression.columns
+    if not coexpression.index.equals(genes):
+        coexpression = coexpression.reindex(index=genes)
+    values = coexpression.to_numpy()
+    block_rows = max(1, block_memory // (TOPK_BYTES * max(len(genes), 1)))
+    sources, targets, weights = topk_pairs(
+        k,
+        len(genes),
+        lambda rows: np.asarray(values[rows], dtype=np.float32),
+        block_rows,
+        mutual,
+    )
+    return EdgeList(genes.to_numpy(), sources, targets, weights)
+
+
+def make_pathway_topk(k, coexpression, mutual=False, edges_only=False):
+    """Links every gene to its k most correlated genes (by |r|), which
+    keeps graph sizes predictable, unlike thresholds. Edges are weighted
+    by |r|. With edges_only, the EdgeList is returned without building a
+    graph"""
+    edges = topk_edges(k, coexpression, mutual)
+    if edges_only:
+        return edges
+
+    kind = "mutual" if mutual else "top"
+    return pathway_from_edges(f"GPL570-{kind}{k}", edges, weighted=True)
+
+
+def threshold_grid(start, stop, step):
+    """Thresholds from start to stop (included), rounded to avoid
+    floating point noise in the pathway names"""
+    count = int(round((stop - start) / step)) + 1
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+class ThresholdSweep:
+    """Edges of a coexpression matrix sorted by decreasing |r|.
+    The graph at any threshold t is the prefix of edges with |r| > t,
+    so all the thresholds above min_threshold share a single edge scan"""
+
+    def __init__(self, coexpression, min_threshold):
+        edges = threshold_edges(min_threshold, coexpression)
+        order = np.argsort(-np.abs(edges.weights), kind="stable")
+        self.edges = EdgeList(
+            edges.genes,
+            edges.sources[order],
+            edges.targets[order],
+            edges.weights[order],
+        )
+        self.min_threshold = min_threshold
+        self._strengths = -np.abs(self.edges.weights)
+
+    def edge_count(self, threshold):
+        """Number of edges with |r| > threshold"""
+        if threshold < self.min_threshold:
+            raise ValueError(
+                f"Threshold {threshold} is below the sweep minimum {self.min_threshold}"
+            )
+        return int(np.searchsorted(self._strengths, -threshold, side="left"))
+
+    def edges_at(self, threshold) -> EdgeList:
+        """Edges of the graph at a threshold, as views on the sorted edges"""
+        count = self.edge_count(threshold)
+        return EdgeList(
+            self.edges.genes,
+            self.edges.sources[:count],
+            self.edges.targets[:count],
+            self.edges.weights[:count],
+        )
+
+    def degrees(self, threshold):
+        """Degree of every gene at a threshold, indexed by gene"""
+        edges = self.edges_at(threshold)
+        degrees = np.bincount(edges.sources, minlength=len(edges.genes))
+        degrees += np.bincount(edges.targets, minlength=len(edges.genes))
+        return pd.Series(degrees, index=edges.genes)
+
+    def pathway(self, threshold) -> Pathway:
+        edges = self.edges_at(threshold)
+        # Same edge order as a direct make_pathway_from_thres build
+        order = np.lexsort((edges.targets, edges.sources))
+        return pathway_from_edges(
+            "GPL570-{}".format(threshold),
+            EdgeList(
+                edges.genes,
+                edges.sources[order],
+                edges.targets[order],
+                edges.weights[order],
+            ),
+        )
+
+    def pathways(self, thresholds):
+        """Materializes one Pathway per threshold"""
+        return {threshold: self.pathway(threshold) for threshold in thresholds}
+
+    def summary(self, thresholds):
+        """Size and connectivity of the graph at every threshold.
+        Computed in one pass from the highest threshold down,
+        growing a union-find over the sorted edges"""
+        thresholds = sorted(thresholds, reverse=True)
+        genes_count = len(self.edges.genes)
+        parent = list(range(genes_count))
+        size = [1] * genes_count
+        first_seen = np.full(genes_count, len(self._strengths))
+        np.minimum.at(first_seen, self.edges.sources, np.arange(len(self._strengths)))
+        np.minimum.at(first_seen, self.edges.targets, np.arange(len(self._strengths)))
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        sources = self.edges.sources.tolist()
+        targets = self.edges.targets.tolist()
+        rows = []
+        done = 0
+        merges = 0
+        largest = 0
+        for threshold in thresholds:
+            count = self.edge_count(threshold)
+            for source, target in zip(sources[done:count], targets[done:count]):
+                source, target = find(source), find(target)
+                if source == target:
+                    continue
+                if size[source] < size[target]:
+                    source, target = target, source
+                parent[target] = source
+                size[source] += size[target]
+                largest = max(largest, size[source])
+                merges += 1
+            done = count
+
+            nodes = int(np.count_nonzero(first_seen < count))
+            rows.append(
+                {
+                    "threshold": threshold,
+                    "nodes": nodes,
+                    "edges": count,
+                    "components": nodes - merges,
+                    "largest_component": largest,
+                }
+            )
+
+        return pd.DataFrame(rows).set_index("threshold").sort_index()
 
-                graph.add_edge(gene, other)
 
-    return Pathway("GPL570-{}".format(threshold), graph)
+def sweep_thresholds(thresholds, coexpression):
+    """Builds a GPL570-{t} pathway for every threshold with a single
+    scan of the coexpression matrix"""
+    sweep = ThresholdSweep(coexpression, min(thresholds))
+    return sweep.pathways(thresholds)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import argparse
+import logging as log
+import os
+from collections import namedtuple
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+import cache_utils
+from network_builder import EdgeList
+
+NETWORK_VERSION = 1
+# Edges formatted and written at once
+EDGES_BLOCK = 100000
+WHITE = 0xFFFFFF
+
+# Edge list of a network, with the fill color (0xRRGGBB) of every gene
+# for every patient: colors is a gene × patient matrix
+Network = namedtuple("Network", ["edges", "patients", "colors"])
+
+
+def edge_list(graph) -> EdgeList:
+    """Edge arrays of a networkx graph, weighted by its "weight" attribute
+    (1 when missing). Nodes are named by their label"""
+    labels = {node: data.get("label", node) for node, data in graph.nodes(data=True)}
+    genes = np.array([str(label) for label in labels.values()])
+    index = {node: i for i, node in enumerate(labels)}
+    sources, targets, weights = [], [], []
+    for source, target, data in graph.edges(data=True):
+        sources.append(index[source])
+        targets.append(index[target])
+        weights.append(data.get("weight", 1.0))
+
+    return EdgeList(
+        genes,
+        np.array(sources, dtype=np.int64),
+        np.array(targets, dtype=np.int64),
+        np.array(weights, dtype=np.float64),
+    )
+
+
+def color_columns(genes, patient_colors) -> np.ndarray:
+    """Gene × patient matrix of colors from {patient: {gene: "#rrggbb"}}.
+    Genes without a color are white"""
+    colors = np.full((len(genes), len(patient_colors)), WHITE, dtype=np.uint32)
+    rows = {gene: i for i, gene in enumerate(genes)}
+    for j, gene_colors in enumerate(patient_colors.values()):
+        for gene, color in gene_colors.items():
+            if gene in rows:
+                colors[rows[gene], j] = int(color.lstrip("#"), 16)
+
+    return colors
+
+
+def _hex_colors(values):
+    return np.array([f"#{value:06x}" for value in values.tolist()], dtype=object)
+
+
+def _linked(edges: EdgeList):
+    """Positions of the genes with at least one edge, as pathway_from_edges"""
+    return np.unique(np.concatenate([edges.sources, edges.targets]))
+
+
+def _write_text(path, write):
+    """Calls write(out) on a UTF-8 text file, replaced atomically"""
+
+    def write_file(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8", newline="\n") as out:
+            write(out)
+
+    cache_utils.write_atomically(path, write_file)
+
+
+def _edge_blocks(edges: EdgeList, names):
+    """Escaped source and target names, weights and correlations,
+    a block of edges at a time"""
+    for start in range(0, len(edges.sources), EDGES_BLOCK):
+        stop = start + EDGES_BLOCK
+        weights = np.asarray(edges.weights[start:stop], dtype=np.float64)
+        yield (
+            start,
+            names[edges.sources[start:stop]],
+            names[edges.targets[start:stop]],
+            np.abs(weights).tolist(),
+            weights.tolist(),
+        )
+
+
+def write_gexf(path, edges: EdgeList, colors=None):
+    """Writes the network as GEXF 1.2, edge by edge, without building it
+    in memory first. Edges are weighted by |r|, and also carry r.
+    colors maps genes to "#rrggbb" fill colors, as node_colors"""
+    colors = colors or {}
+    names = np.array([quoteattr(str(gene)) for gene in edges.genes], dtype=object)
+
+    def write(out):
+        out.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gexf xmlns="http://www.gexf.net/1.2draft" '
+            'xmlns:viz="http://www.gexf.net/1.2draft/viz" version="1.2">\n'
+            '  <graph defaultedgetype="undirected" mode="static">\n'
+            '    <attributes class="node">\n'
+            '      <attribute id="0" title="fillcolor" type="string"/>\n'
+            "    </attributes>\n"
+            '    <attributes class="edge">\n'
+            '      <attribute id="0" title="correlation" type="double"/>\n'
+            "    </attributes>\n"
+            "    <nodes>\n"
+        )
+        for i in _linked(edges).tolist():
+            gene = str(edges.genes[i])
+            fill = colors.get(gene, "#ffffff")
+            red, green, blue = (int(fill[k : k + 2], 16) for k in (1, 3, 5))
+            out.write(
+                f"      <node id={names[i]} label={names[i]}>"
+                f'<attvalues><attvalue for="0" value="{fill}"/></attvalues>'
+                f'<viz:color r="{red}" g="{green}" b="{blue}"/></node>\n'
+            )
+        out.write("    </nodes>\n    <edges>\n")
+        for start, sources, targets, weights, correlations in _edge_blocks(
+            edges, names
+        ):
+            out.write(
+                "".join(
+                    f'      <edge id="{start + k}" source={source} target={target} '
+                    f'weight="{weight:.6g}"><attvalues>'
+                    f'<attvalue for="0" value="{r:.6g}"/></attvalues></edge>\n'
+                    for k, (source, target, weight, r) in enumerate(
+                        zip(sources, targets, weights, correlations)
+                    )
+                )
+            )
+        out.write("    </edges>\n  </graph>\n</gexf>\n")
+
+    _write_text(path, write)
+
+
+def write_graphml(path, edges: EdgeList, colors=None):
+    """Writes the network as GraphML, edge by edge, like write_gexf"""
+    colors = colors or {}
+    names = np.array([quoteattr(str(gene)) for gene in edges.genes], dtype=object)
+
+    def write(out):
+        out.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '  <key id="d0" for="node" attr.name="label" attr.type="string"/>\n'
+            '  <key id="d1" for="node" attr.name="fillcolor" attr.type="string"/>\n'
+            '  <key id="d2" for="edge" attr.name="weight" attr.type="double"/>\n'
+            '  <key id="d3" for="edge" attr.name="correlation" attr.type="double"/>\n'
+            '  <graph edgedefault="undirected">\n'
+        )
+        for i in _linked(edges).tolist():
+            out.write(
+                f'    <node id={names[i]}><data key="d0">{names[i][1:-1]}</data>'
+                f'<data key="d1">{colors.get(str(edges.genes[i]), "#ffffff")}</data>'
+                "</node>\n"
+            )
+        for _, sources, targets, weights, correlations in _edge_blocks(edges, names):
+            out.write(
+                "".join(
+                    f"    <edge source={source} target={target}>"
+                    f'<data key="d2">{weight:.6g}</data>'
+                    f'<data key="d3">{r:.6g}</data></edge>\n'
+                    for source, target, weight, r in zip(
+                        sources, targets, weights, correlations
+                    )
+                )
+            )
+        out.write("  </graph>\n</graphml>\n")
+
+    _write_text(path, write)
+
+
+def save_network(path, edges: EdgeList, patient_colors=None):
+    """Saves the edge arrays, and the colors of the genes for every patient
+    of {patient: {gene: "#rrggbb"}}, to an uncompressed .npz file"""
+    patient_colors = patient_colors or {}
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as out:
+            np.savez(
+                out,
+                version=np.array(NETWORK_VERSION),
+                genes=np.asarray(edges.genes).astype(str),
+                sources=np.asarray(edges.sources, dtype=np.int32),
+                targets=np.asarray(edges.targets, dtype=np.int32),
+                weights=np.asarray(edges.weights, dtype=np.float32),
+                patients=np.array(
+                    [str(patient) for patient in patient_colors], dtype=str
+                ),
+                colors=color_columns(edges.genes, patient_colors),
+            )
+
+    cache_utils.write_atomically(path, write)
+
+
+def load_network(path) -> Network:
+    with np.load(path, allow_pickle=False) as network:
+        if int(network["version"]) != NETWORK_VERSION:
+            raise ValueError(f"{path} has an unsupported network version")
+        edges = EdgeList(
+            network["genes"].astype(object),
+            network["sources"],
+            network["targets"],
+            network["weights"],
+        )
+        return Network(edges, network["patients"].tolist(), network["colors"])
+
+
+def patient_colors(network: Network, patient) -> dict:
+    """Fill colors of the genes of a patient that are not white"""
+    column = network.colors[:, network.patients.index(patient)]
+    colored = np.flatnonzero(column != WHITE)
+    return dict(zip(network.edges.genes[colored], _hex_colors(column[colored])))
+
+
+def export_network(path, edges: EdgeList, patient_colors=None):
+    """Writes the network in the format of the extension of path.
+    GEXF and GraphML only hold the colors of the first patient"""
+    patient_colors = patient_colors or {}
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npz":
+        save_network(path, edges, patient_colors)
+        return
+
+    colors = next(iter(patient_colors.values()), {})
+    if extension == ".gexf":
+        write_gexf(path, edges, colors)
+    elif extension == ".graphml":
+        write_graphml(path, edges, colors)
+    else:
+        raise ValueError(f"Unsupported network format {extension}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the thresholded coexpression network "
+        "as GEXF, GraphML or .npz arrays, chosen by the output extension"
+    )
+    parser.add_argument("output")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="link every gene to its k most correlated genes instead of thresholding",
+    )
+    parser.add_argument(
+        "--mutual", action="store_true", help="with --top-k, keep mutual picks only"
+    )
+    parser.add_argument("--expression", default="GSE40367-stripped.txt")
+    parser.add_argument("--platform", default="GPL570-stripped.txt")
+    parser.add_argument(
+        "--sequencing",
+        default="TRIBE2_seq_res.csv",
+        help="sequencing results, whose genes make up the network",
+    )
+    parser.add_argument(
+        "--patients", nargs="+", default=[], help="color the genes of these patients"
+    )
+    args = parser.parse_args()
+
+    from coexpression import coexpression_matrix
+    from mutation_colors import node_colors
+    from mutation_store import load_mutations
+    from network_builder import make_pathway_from_thres, make_pathway_topk
+
+    log.basicConfig(level=log.INFO)
+    mutations = load_mutations(args.sequencing)
+    coexpression = coexpression_matrix(
+        args.expression, args.platform, mutations.biomarkers
+    )
+    if args.top_k is not None:
+        edges = make_pathway_topk(
+            args.top_k, coexpression, args.mutual, edges_only=True
+        )
+    else:
+        edges = make_pathway_from_thres(args.threshold, coexpression, edges_only=True)
+
+    # Same colors as the viewer
+    colors = {
+        patient: node_colors(mutations.retrieve_mutations(patient))
+        for patient in args.patients
+    }
+
+    export_network(args.output, edges, colors)
+    log.info(f"Saved {len(edges.sources)} links to {args.output}")
@@ -1,35 +1,299 @@
 #!/usr/bin/env python
 
+import argparse
+import hashlib
+import json
 import logging as log
 import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import networkx as nx
 import pandas as pd
 
-import analysis_nx as anx
-import pathways_nx as pnx
+import cache_utils
+import instrumentation
+import measure_cache
+import scoring
+from instrumentation import span, traced
+from measures import MEASURES
+from mutation_store import load_mutations
+from pathway_library import PathwayLibrary
 
 PATHWAYS_DIRECTORY = "./pathways/"
-log.basicConfig(level=log.INFO)
-
-pathways = [
-    pnx.pathway_to_nx(PATHWAYS_DIRECTORY + pw) for pw in os.listdir(PATHWAYS_DIRECTORY)
-]
-pathways.sort(key=lambda pw: pw.name)
-log.info(f"Loaded {len(pathways)} pathways from {PATHWAYS_DIRECTORY}")
-
-patients_log = pd.read_csv("TRIBE2_db.csv")
-log.info(f"Loaded {len(patients_log)} patients")
-mutations_data = pd.read_csv("TRIBE2_seq_res.csv")
-log.info("Loaded gene mutations")
-log.debug(f"Got {len(mutations_data)}")
-
-arm0_df_indeg = anx.process_patients_with_f(
-    patients_log[patients_log["arm"] == 0]["PatientFirstName"],
-    nx.in_degree_centrality,
-    pathways,
-    mutations_data,
-)
-print(arm0_df_indeg.describe())
-
-log.info("Goodbye")
+CHECKPOINT_VERSION = 1
+
+Cohort = namedtuple("Cohort", ["name", "patients_log", "sequencing"])
+# A single scoring run: one arm of a cohort, one pathway directory, one measure
+Job = namedtuple("Job", ["cohort", "arm", "pathways", "measure", "hierarchy"])
+
+# Inputs opened by a worker process, reused by all of its jobs
+_opened = {}
+
+
+def _open(kind, path):
+    if (kind, path) not in _opened:
+        if kind == "patients":
+            _opened[kind, path] = pd.read_csv(path)
+        elif kind == "mutations":
+            _opened[kind, path] = load_mutations(path)
+        else:
+            _opened[kind, path] = PathwayLibrary(path)
+
+    return _opened[kind, path]
+
+
+def job_name(job: Job) -> str:
+    # Pathway directories with the same name are told apart by their path
+    location = os.path.normcase(os.path.abspath(job.pathways))
+    digest = hashlib.sha1(location.encode()).hexdigest()[:8]
+    pathways = f"{os.path.basename(location)}-{digest}"
+    hierarchy = "complexes" if job.hierarchy else "flat"
+    return f"{job.cohort.name}-arm{job.arm}-{pathways}-{job.measure}-{hierarchy}"
+
+
+def expand_jobs(cohorts, arms, pathway_dirs, measures, hierarchies):
+    """Every combination of the requested runs, in a stable order"""
+    return [
+        Job(cohort, arm, pathways, measure, hierarchy)
+        for cohort in cohorts
+        for arm in arms
+        for pathways in pathway_dirs
+        for measure in measures
+        for hierarchy in hierarchies
+    ]
+
+
+@traced("pancan.prepare_inputs")
+def prepare_inputs(jobs):
+    """Builds the caches every job depends on, once, before fanning out:
+    the mutation stores of the cohorts and the pathway bundles.
+    Returns the digest of the inputs of every job"""
+    inputs = {}
+    for cohort in {job.cohort for job in jobs}:
+        load_mutations(cohort.sequencing)
+        inputs[cohort] = [
+            cache_utils.cached_digest(cohort.patients_log),
+            cache_utils.cached_digest(cohort.sequencing),
+        ]
+    for pathways in {job.pathways for job in jobs}:
+        inputs[pathways] = PathwayLibrary(pathways).version()
+
+    return {
+        job: hashlib.sha1(
+            json.dumps(
+                [
+                    CHECKPOINT_VERSION,
+                    inputs[job.cohort],
+                    inputs[job.pathways],
+                    job.arm,
+                    job.measure,
+                    job.hierarchy,
+                ]
+            ).encode()
+        ).hexdigest()
+        for job in jobs
+    }
+
+
+def checkpoint_path(job: Job, output_dir) -> str:
+    return os.path.join(output_dir, job_name(job) + ".csv")
+
+
+def is_done(job: Job, key, output_dir) -> bool:
+    path = checkpoint_path(job, output_dir)
+    stamp = cache_utils.read_stamp(path)
+    return os.path.exists(path) and stamp is not None and stamp.get("key") == key
+
+
+def run_job(job: Job, key, output_dir) -> str:
+    """Scores one arm of a cohort and checkpoints the result"""
+    patients_log = _open("patients", job.cohort.patients_log)
+    mutations_data = _open("mutations", job.cohort.sequencing)
+    pathways = _open("pathways", job.pathways).pathways()
+
+    measure = MEASURES.get(job.measure, job.measure)
+    config = {pw.name: scoring.PathwayConfig(measure, job.hierarchy) for pw in pathways}
+    scores = scoring.score_patients_with_config(
+        patients_log[patients_log["arm"] == job.arm]["PatientFirstName"],
+        pathways,
+        mutations_data,
+        config,
+    )
+
+    # The stamp goes last: a checkpoint without it is never trusted
+    path = checkpoint_path(job, output_dir)
+    with span("export.checkpoint", job=job_name(job)):
+        cache_utils.replace_atomically(path, scores.to_csv(index=False).encode())
+        cache_utils.write_stamp(path, {"key": key, "job": job_name(job)})
+    return path
+
+
+def run_traced_job(job: Job, key, output_dir, memory=False):
+    """Runs a job in a worker process with its own tracer,
+    returns what it recorded for the parent to merge"""
+    tracer = instrumentation.enable_tracing(memory)
+    try:
+        with span("job", job=job_name(job)):
+            run_job(job, key, output_dir)
+        return tracer.recorded()
+    finally:
+        instrumentation.disable_tracing()
+
+
+def run_jobs(jobs, keys, output_dir, max_workers=None, force=False):
+    """Runs the jobs that don't have an up to date checkpoint yet.
+    keys are the digests of prepare_inputs. Returns the jobs that failed"""
+    todo = [job for job in jobs if force or not is_done(job, keys[job], output_dir)]
+    log.info(f"{len(jobs) - len(todo)} of {len(jobs)} jobs already done")
+
+    failed = []
+    if max_workers == 1:
+        # No worker processes: inputs are opened once, and every
+        # stage shows up in the trace of this process
+        for count, job in enumerate(todo, 1):
+            try:
+                with span("job", job=job_name(job)):
+                    run_job(job, keys[job], output_dir)
+                log.info(f"[{count}/{len(todo)}] {job_name(job)} done")
+            except Exception:
+                log.exception(f"[{count}/{len(todo)}] {job_name(job)} failed")
+                failed.append(job)
+        return failed
+
+    tracer = instrumentation.active_tracer()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            (
+                pool.submit(run_job, job, keys[job], output_dir)
+                if tracer is None
+                else pool.submit(
+                    run_traced_job, job, keys[job], output_dir, tracer.memory
+                )
+            ): job
+            for job in todo
+        }
+        for count, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                result = future.result()
+                log.info(f"[{count}/{len(todo)}] {job_name(job)} done")
+            except Exception:
+                log.exception(f"[{count}/{len(todo)}] {job_name(job)} failed")
+                failed.append(job)
+                continue
+            if tracer is not None:
+                tracer.merge(result)
+
+    return failed
+
+
+@traced("pancan.collect_scores")
+def collect_scores(jobs, keys, output_dir) -> pd.DataFrame:
+    """Long table of the scores of every job with an up to date checkpoint"""
+    tables = []
+    for job in jobs:
+        path = checkpoint_path(job, output_dir)
+        if not is_done(job, keys[job], output_dir):
+            if os.path.exists(path):
+                log.warning(f"Leaving out the outdated checkpoint {path}")
+            continue
+        scores = pd.read_csv(path).melt(
+            id_vars="PatientFirstName", var_name="pathway", value_name="score"
+        )
+        scores.insert(0, "cohort", job.cohort.name)
+        scores.insert(1, "arm", job.arm)
+        scores.insert(2, "pathways", job.pathways)
+        scores.insert(3, "measure", job.measure)
+        scores.insert(4, "hierarchy", job.hierarchy)
+        tables.append(scores)
+
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def parse_cohort(value) -> Cohort:
+    try:
+        name, patients_log, sequencing = value.split(":")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not NAME:PATIENTS_CSV:SEQUENCING_CSV"
+        ) from None
+    return Cohort(name, patients_log, sequencing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score the patients of one or more cohorts, "
+        "checkpointing every job so that interrupted runs can be resumed"
+    )
+    parser.add_argument(
+        "--cohorts",
+        nargs="+",
+        type=parse_cohort,
+        default=[Cohort("TRIBE2", "TRIBE2_db.csv", "TRIBE2_seq_res.csv")],
+        metavar="NAME:PATIENTS_CSV:SEQUENCING_CSV",
+    )
+    parser.add_argument("--arms", nargs="+", type=int, default=[0])
+    parser.add_argument("--pathways", nargs="+", default=[PATHWAYS_DIRECTORY])
+    parser.add_argument(
+        "--measures",
+        nargs="+",
+        default=["indegree"],
+        choices=list(MEASURES) + [scoring.BASELINE],
+    )
+    parser.add_argument(
+        "--hierarchy",
+        nargs="+",
+        default=["flat"],
+        choices=["flat", "complexes"],
+        help="weight genes by the size of their families and complexes",
+    )
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--output", default="pancan-results")
+    parser.add_argument(
+        "--force", action="store_true", help="run again jobs already checkpointed"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="save a Chrome trace of the run (timings and cache counters)",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="also record the peak memory of every stage, slowing the run down",
+    )
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    # Workers share the measures they compute through the disk cache
+    os.environ.setdefault(
+        "CANCOL_MEASURE_CACHE", os.path.join(cache_utils.CACHE_DIRECTORY, "measures")
+    )
+    measure_cache.enable_measure_cache(os.environ["CANCOL_MEASURE_CACHE"])
+    os.makedirs(args.output, exist_ok=True)
+    if args.trace:
+        instrumentation.enable_tracing(memory=args.trace_memory)
+
+    jobs = expand_jobs(
+        args.cohorts,
+        args.arms,
+        args.pathways,
+        args.measures,
+        [hierarchy == "complexes" for hierarchy in args.hierarchy],
+    )
+    keys = prepare_inputs(jobs)
+    failed = run_jobs(jobs, keys, args.output, args.jobs, args.force)
+
+    scores = collect_scores(jobs, keys, args.output)
+    with span("export.scores", rows=len(scores)):
+        scores.to_csv(os.path.join(args.output, "scores.csv"), index=False)
+    log.info(f"Saved {len(scores)} scores to {args.output}")
+    if args.trace:
+        instrumentation.active_tracer().save(args.trace)
+        log.info(f"Saved trace to {args.trace}")
+
+    if failed:
+        log.error(f"{len(failed)} jobs failed, run again to retry them")
+        sys.exit(1)
+    log.info("Goodbye")
@@ -0,0 +1,337 @@
+import math
+import time
+import weakref
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as splinalg
+
+# Sources processed together by the BFS-based measures,
+# bounds memory to a few (nodes × block) arrays
+SOURCE_BLOCK = 256
+
+_converted = weakref.WeakKeyDictionary()
+
+
+class CSRGraph:
+    """Integer-indexed graph: the successors of node i are
+    indices[indptr[i]:indptr[i + 1]]. Undirected edges are stored both ways"""
+
+    __slots__ = ["nodes", "labels", "famcomw", "indptr", "indices", "directed"]
+
+    def __init__(self, nodes, labels, famcomw, indptr, indices, directed):
+        self.nodes = nodes
+        self.labels = labels
+        self.famcomw = famcomw
+        self.indptr = indptr
+        self.indices = indices
+        self.directed = directed
+
+    @classmethod
+    def from_nx(cls, graph):
+        nodes = list(graph.nodes)
+        position = {node: i for i, node in enumerate(nodes)}
+        edges = np.array(
+            [(position[u], position[v]) for u, v in graph.edges()], dtype=np.int64
+        ).reshape(-1, 2)
+        if not graph.is_directed():
+            loops = edges[:, 0] == edges[:, 1]
+            edges = np.concatenate([edges, edges[~loops][:, ::-1]])
+
+        adjacency = sparse.csr_matrix(
+            (np.ones(len(edges)), (edges[:, 0], edges[:, 1])),
+            shape=(len(nodes), len(nodes)),
+        )
+        adjacency.sort_indices()
+
+        labels = nx.get_node_attributes(graph, "label")
+        famcomw = nx.get_node_attributes(graph, "famcomw")
+        return cls(
+            nodes,
+            np.array([labels.get(node) for node in nodes], dtype=object),
+            np.array([famcomw.get(node, np.nan) for node in nodes], dtype=np.float64),
+            adjacency.indptr,
+            adjacency.indices,
+            graph.is_directed(),
+        )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def adjacency(self):
+        """A[i, j] = 1 for every edge i -> j"""
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices)), self.indices, self.indptr),
+            shape=(len(self), len(self)),
+        )
+
+    def self_loops(self):
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        return np.bincount(rows[rows == self.indices], minlength=len(self))
+
+    def out_degrees(self):
+        return np.diff(self.indptr)
+
+    def in_degrees(self):
+        return np.bincount(self.indices, minlength=len(self))
+
+    def degrees(self):
+        """Same as networkx: self loops count twice"""
+        if self.directed:
+            return self.out_degrees() + self.in_degrees()
+        return self.out_degrees() + self.self_loops()
+
+
+def as_csr(graph) -> CSRGraph:
+    """Accepts CSR and networkx graphs alike; conversions are remembered
+    for as long as the networkx graph is alive"""
+    if isinstance(graph, CSRGraph):
+        return graph
+    if graph not in _converted:
+        _converted[graph] = CSRGraph.from_nx(graph)
+    return _converted[graph]
+
+
+def _by_node(graph, values):
+    return dict(zip(graph.nodes, values.tolist()))
+
+
+def _degree_centrality(graph, degrees):
+    if len(graph) <= 1:
+        return {node: 1 for node in graph.nodes}
+    return _by_node(graph, degrees / (len(graph) - 1))
+
+
+def degree_centrality(graph):
+    graph = as_csr(graph)
+    return _degree_centrality(graph, graph.degrees())
+
+
+def in_degree_centrality(graph):
+    graph = as_csr(graph)
+    if not graph.directed:
+        raise nx.NetworkXNotImplemented("not implemented for undirected type")
+    return _degree_centrality(graph, graph.in_degrees())
+
+
+def out_degree_centrality(graph):
+    graph = as_csr(graph)
+    if not graph.directed:
+        raise nx.NetworkXNotImplemented("not implemented for undirected type")
+    return _degree_centrality(graph, graph.out_degrees())
+
+
+def eigenvector_centrality(graph, max_iter=50, tol=0):
+    """Same definition as networkx's eigenvector_centrality_numpy:
+    leading left eigenvector of the adjacency matrix"""
+    graph = as_csr(graph)
+    if len(graph) == 0:
+        raise nx.NetworkXPointlessConcept(
+            "cannot compute centrality for the null graph"
+        )
+
+    transposed = graph.adjacency().T
+    if len(graph) < 3:
+        # ARPACK needs k < n - 1
+        eigenvalues, eigenvectors = np.linalg.eig(transposed.toarray())
+        largest = eigenvectors[:, np.argmax(eigenvalues.real)].real
+    else:
+        # A fixed starting vector keeps results reproducible
+        # when the leading eigenvalue is degenerate (e.g. acyclic pathways)
+        _, eigenvector = splinalg.eigs(
+            transposed,
+            k=1,
+            which="LR",
+            maxiter=max_iter,
+            tol=tol,
+            v0=np.ones(len(graph)),
+        )
+        largest = eigenvector.flatten().real
+
+    norm = np.sign(largest.sum()) * np.linalg.norm(largest)
+    return _by_node(graph, largest / norm)
+
+
+def closeness_centrality(graph, wf_improved=True):
+    """Closeness from incoming distances, as in networkx.
+    BFS runs in blocks of sources to bound memory"""
+    graph = as_csr(graph)
+    nodes_count = len(graph)
+    # Incoming distances are outgoing distances on the reversed graph
+    adjacency = graph.adjacency().T.tocsr() if graph.directed else graph.adjacency()
+
+    closeness = np.zeros(nodes_count)
+    for start in range(0, nodes_count, SOURCE_BLOCK):
+        sources = np.arange(start, min(start + SOURCE_BLOCK, nodes_count))
+        distances = csgraph.shortest_path(
+            adjacency, directed=True, unweighted=True, indices=sources
+        )
+        reached = np.isfinite(distances)
+        total = np.where(reached, distances, 0).sum(axis=1)
+        reachable = reached.sum(axis=1) - 1.0
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block = np.where(total > 0, reachable / total, 0.0)
+        if wf_improved and nodes_count > 1:
+            block *= reachable / (nodes_count - 1)
+        closeness[sources] = np.where(total > 0, block, 0.0)
+
+    return _by_node(graph, closeness)
+
+
+def _accumulate_betweenness(adjacency, sources, betweenness):
+    """Brandes' algorithm for a block of sources at once,
+    expressed as sparse × dense products level by level"""
+    nodes_count = adjacency.shape[0]
+    incoming = adjacency.T.tocsr()
+
+    frontier = np.zeros((nodes_count, len(sources)))
+    frontier[sources, np.arange(len(sources))] = 1
+    sigma = frontier.copy()
+    visited = frontier > 0
+    levels = [visited.copy()]
+
+    # Forward: count shortest paths, one BFS level at a time
+    while True:
+        frontier = incoming @ frontier
+        frontier[visited] = 0
+        reached = frontier > 0
+        if not reached.any():
+            break
+        sigma += frontier
+        visited |= reached
+        levels.append(reached)
+
+    # Backward: accumulate dependencies from the deepest level up
+    delta = np.zeros_like(sigma)
+    for depth in range(len(levels) - 1, 0, -1):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights = np.where(levels[depth], (1 + delta) / sigma, 0.0)
+        contributions = adjacency @ weights
+        delta += np.where(levels[depth - 1], sigma * contributions, 0.0)
+
+    # Sources don't gain anything from their own paths
+    delta[sources, np.arange(len(sources))] = 0
+    betweenness += delta.sum(axis=1)
+
+
+def _rescale_betweenness(betweenness, nodes_count, normalized, directed, pivots):
+    if normalized:
+        scale = 1 / ((nodes_count - 1) * (nodes_count - 2)) if nodes_count > 2 else None
+    else:
+        scale = None if directed else 0.5
+
+    if scale is not None:
+        if pivots is not None:
+            scale = scale * nodes_count / pivots
+        betweenness *= scale
+    return betweenness
+
+
+def betweenness_centrality(graph, k=None, normalized=True, seed=None):
+    """Unweighted betweenness with networkx's normalization.
+    With k, only k random pivots are used as sources"""
+    graph = as_csr(graph)
+    nodes_count = len(graph)
+    adjacency = graph.adjacency()
+
+    if k is None:
+        sources = np.arange(nodes_count)
+    else:
+        sources = np.random.default_rng(seed).choice(nodes_count, k, replace=False)
+
+    betweenness = np.zeros(nodes_count)
+    for start in range(0, len(sources), SOURCE_BLOCK):
+        _accumulate_betweenness(
+            adjacency, sources[start : start + SOURCE_BLOCK], betweenness
+        )
+
+    return _by_node(
+        graph,
+        _rescale_betweenness(betweenness, nodes_count, normalized, graph.directed, k),
+    )
+
+
+def approximate_betweenness_centrality(
+    graph, epsilon=0.05, delta=0.1, time_budget=None, normalized=True, seed=None
+):
+    """Betweenness estimated from sampled pivots.
+    The number of pivots comes from a Hoeffding bound: with probability
+    1 - delta, every normalized value is within epsilon of the exact one.
+    If time_budget (seconds) runs out first, the pivots processed so far
+    are used, with a correspondingly weaker guarantee"""
+    graph = as_csr(graph)
+    nodes_count = len(graph)
+    if nodes_count == 0:
+        return {}
+
+    pivots_count = math.ceil(math.log(2 * nodes_count / delta) / (2 * epsilon**2))
+    pivots_count = min(nodes_count, pivots_count)
+    pivots = np.random.default_rng(seed).permutation(nodes_count)[:pivots_count]
+
+    adjacency = graph.adjacency()
+    betweenness = np.zeros(nodes_count)
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    done = 0
+    while done < pivots_count:
+        # Smaller blocks let the deadline be checked more often
+        block = pivots[done : done + max(1, SOURCE_BLOCK // 4)]
+        _accumulate_betweenness(adjacency, block, betweenness)
+        done += len(block)
+        if deadline is not None and time.monotonic() > deadline:
+            break
+
+    return _by_node(
+        graph,
+        _rescale_betweenness(
+            betweenness, nodes_count, normalized, graph.directed, done
+        ),
+    )
+
+
+class CSRPathway:
+    """Pathway backed by a CSRGraph, with the same scoring interface
+    as pathways_nx.Pathway. Measures receive the CSRGraph"""
+
+    __slots__ = ["name", "graph", "measures"]
+
+    def __init__(self, name, graph: CSRGraph, measures=None):
+        self.name = name
+        self.graph = graph
+        self.measures = measures if measures is not None else {}
+
+    @classmethod
+    def from_pathway(cls, pathway):
+        return cls(pathway.name, CSRGraph.from_nx(pathway.graph))
+
+    def calculate_measure(self, function, with_complexes=False):
+        """Returns a series with weights for a specific function.
+        Indexed by biomarker (*not* ID)"""
+        cached = self.measures.setdefault(function, {})
+        if with_complexes in cached:
+            return cached[with_complexes]
+
+        node_weights = function(self.graph)
+        labels = self.graph.labels
+        weights = pd.Series(
+            {labels[i]: node_weights[node] for i, node in enumerate(self.graph.nodes)}
+        )
+        if with_complexes:
+            weights = weights.mul(
+                pd.Series(
+                    {
+                        labels[i]: self.graph.famcomw[i]
+                        for i in range(len(self.graph))
+                        if not np.isnan(self.graph.famcomw[i])
+                    }
+                )
+            )
+
+        cached[with_complexes] = weights
+        return weights
+
+    def get_genes(self):
+        return self.graph.labels
@@ -0,0 +1,197 @@
+import hashlib
+import logging as log
+import os
+import pickle
+from collections import namedtuple
+
+import networkx as nx
+
+import cache_utils
+import pathways as lpw
+import pathways_nx as pnx
+from instrumentation import count, span, traced
+from pathway_parser import read_pathway, top_level_groups
+
+LIBRARY_VERSION = 1
+PATHWAYS_DIRECTORY = "./pathways/"
+
+# Everything needed to rebuild a pathway without reading its file again:
+# nodes are (ID, {label, famcomw}) pairs, edges (source, target, {label})
+CompiledPathway = namedtuple("CompiledPathway", ["name", "parsed", "nodes", "edges"])
+# Bundle entry of a pathway file. The pathway itself is kept pickled,
+# so that opening the bundle doesn't pay for pathways that are never used
+LibraryEntry = namedtuple("LibraryEntry", ["signature", "name", "genes", "blob"])
+
+
+def compile_pathway(path: str) -> CompiledPathway:
+    parsed = read_pathway(path)
+    graph = pnx.parsed_to_nx(parsed, path).graph
+    return CompiledPathway(
+        parsed.title,
+        parsed,
+        list(graph.nodes(data=True)),
+        list(graph.edges(data=True)),
+    )
+
+
+def compile_entry(path: str) -> LibraryEntry:
+    log.debug(f"Compiling pathway {path}")
+    signature = cache_utils.make_stamp(path)
+    with span("library.compile", path=path):
+        compiled = compile_pathway(path)
+    return LibraryEntry(
+        signature,
+        compiled.name,
+        frozenset(data["label"] for _, data in compiled.nodes),
+        pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+
+
+def default_bundle_path(directory: str) -> str:
+    """Bundles live in the cache folder, one per pathway directory"""
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+    return os.path.join(cache_utils.CACHE_DIRECTORY, "pathways", key + ".pickle")
+
+
+class PathwayLibrary:
+    """All the pathways of a directory, compiled into a single bundle.
+    Opening a library only checks the pathway files against the bundle:
+    files are parsed again only if their contents changed, and pathways
+    are turned into graphs only when requested by name"""
+
+    def __init__(self, directory=PATHWAYS_DIRECTORY, bundle_path=None):
+        self.directory = directory
+        self.bundle_path = bundle_path or default_bundle_path(directory)
+        # Filename -> LibraryEntry, and pathway name -> filename
+        self._entries = None
+        self._files = {}
+        # Materialized pathways keep their computed measures
+        self._pathways = {}
+        self.refresh()
+
+    def _load_bundle(self):
+        try:
+            with open(self.bundle_path, "rb") as bundle_file:
+                bundle = pickle.load(bundle_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, EOFError, AttributeError, pickle.UnpicklingError) as e:
+            log.warning(f"Ignoring unreadable pathway bundle {self.bundle_path}: {e}")
+            return {}
+
+        if bundle.get("version") != LIBRARY_VERSION:
+            return {}
+        return bundle["entries"]
+
+    def _save_bundle(self):
+        bundle = {"version": LIBRARY_VERSION, "entries": self._entries}
+        cache_utils.replace_atomically(
+            self.bundle_path, pickle.dumps(bundle, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+
+    @traced("library.refresh")
+    def refresh(self):
+        """Brings the bundle up to date with the pathway files.
+        Returns the files that had to be compiled again"""
+        previous = self._load_bundle() if self._entries is None else self._entries
+        entries = {}
+        compiled = []
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if not os.path.isfile(path):
+                continue
+
+            entry = previous.get(filename)
+            if entry is None or not cache_utils.source_unchanged(entry.signature, path):
+                entry = compile_entry(path)
+                compiled.append(filename)
+            else:
+                # Same contents, only the mtime needs to be remembered
+                signature = {**entry.signature, **cache_utils.file_signature(path)}
+                entry = entry._replace(signature=signature)
+            entries[filename] = entry
+
+        modified = compiled or entries != previous
+        self._entries = entries
+        self._files = {}
+        for filename, entry in entries.items():
+            if entry.name in self._files:
+                log.warning(
+                    f"Pathway {entry.name} is defined in both "
+                    f"{self._files[entry.name]} and {filename}, ignoring the latter"
+                )
+                continue
+            self._files[entry.name] = filename
+
+        self._pathways = {
+            name: pathway
+            for name, pathway in self._pathways.items()
+            if self._files.get(name) in entries
+            and self._files.get(name) not in compiled
+        }
+
+        count("library.compiled", len(compiled))
+        count("library.reused", len(entries) - len(compiled))
+        if compiled:
+            log.info(f"Compiled {len(compiled)} pathways from {self.directory}")
+        if modified:
+            self._save_bundle()
+        return compiled
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def names(self):
+        return sorted(self._files)
+
+    def version(self) -> str:
+        """Digest of the contents of every pathway file,
+        changes whenever a pathway is edited, added or removed"""
+        digest = hashlib.sha1(str(LIBRARY_VERSION).encode())
+        for filename, entry in sorted(self._entries.items()):
+            digest.update(f"{filename}\0{entry.signature['sha1']}\0".encode())
+        return digest.hexdigest()
+
+    def _entry(self, name) -> LibraryEntry:
+        try:
+            return self._entries[self._files[name]]
+        except KeyError:
+            raise KeyError(f"No pathway named {name} in {self.directory}") from None
+
+    def genes(self, name) -> frozenset:
+        """Genes of a pathway, without materializing it"""
+        return self._entry(name).genes
+
+    def compiled(self, name) -> CompiledPathway:
+        return pickle.loads(self._entry(name).blob)
+
+    def pathway(self, name) -> pnx.Pathway:
+        """NetworkX form of a pathway, the same object on every call"""
+        if name not in self._pathways:
+            compiled = self.compiled(name)
+            g = nx.DiGraph()
+            g.add_nodes_from(compiled.nodes)
+            g.add_edges_from(compiled.edges)
+            self._pathways[name] = pnx.Pathway(
+                compiled.name, g, groups=top_level_groups(compiled.parsed)
+            )
+
+        return self._pathways[name]
+
+    def legacy(self, name):
+        """Legacy (name, tree) form of a pathway, as returned by parse_pathway"""
+        compiled = self.compiled(name)
+        return lpw.parsed_to_tree(compiled.parsed, self._files[name])
+
+    def pathways(self, names=None):
+        """NetworkX pathways sorted by name, all of them by default"""
+        return [self.pathway(name) for name in sorted(names or self._files)]
+
+    def legacy_pathways(self, names=None):
+        return [self.legacy(name) for name in sorted(names or self._files)]
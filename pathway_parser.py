@@ -1,7 +1,11 @@
+import logging as log
+from collections import Counter, namedtuple
 from enum import Enum
 
 import networkx as nx
 
+from instrumentation import traced
+
 
 # Nodes in a pathway can be genes or clusters of genes
 # Genes inside a cluster are CHILDGENEs so that they can be treated
@@ -43,7 +47,7 @@ def pathway_to_graph(path: str):
             )
             g.add_node(toks[1], label=toks[0], ptype=ptype)
             if ptype == PathwayElement.CHILDGENE:
-                print(toks[0] + " " + toks[1] + " -> " + toks[3])
+                log.debug("%s %s -> %s", toks[0], toks[1], toks[3])
                 g.add_edge(toks[1], toks[3])
             cur_str = pwfile.readline()
 
@@ -53,7 +57,7 @@ def pathway_to_graph(path: str):
         while cur_str.strip() != "":
             toks = cur_str.split("\t")
             if toks[1] in g.nodes() and toks[2] in g.nodes():
-                print(toks[1] + " -> " + toks[2])
+                log.debug("%s -> %s", toks[1], toks[2])
                 g.add_edge(toks[1], toks[2], eid=toks[0])
 
             cur_str = pwfile.readline()
@@ -81,3 +85,82 @@ def total_genes(pathway: nx.Graph) -> int:
 
 def get_gene_names(pathway: nx.Graph):
     return nx.get_node_attributes(pathway, "label").values()
+
+
+PathwayRow = namedtuple("PathwayRow", ["name", "id", "type", "parent"])
+EdgeRow = namedtuple("EdgeRow", ["id", "source", "target", "type"])
+# nodes: ID -> PathwayRow, children: parent ID ("-1" for top-level) -> child IDs,
+# leaves: container ID -> gene IDs an edge to that container stands for
+ParsedPathway = namedtuple(
+    "ParsedPathway", ["title", "nodes", "children", "edges", "leaves"]
+)
+
+CONTAINER_TYPES = ["FAMILY", "COMPLEX"]
+
+
+class PathwayFormatError(ValueError):
+    """Raised for pathwaymapper files that can't be turned into a pathway"""
+
+
+def _section(lines):
+    """Yields tab-separated rows until an empty line"""
+    for line in lines:
+        if line.strip() == "":
+            return
+        yield line.rstrip("\n").split("\t")
+
+
+@traced("parse.read_pathway")
+def read_pathway(path: str) -> ParsedPathway:
+    """Reads a pathwaymapper file in a single pass into an indexed form,
+    shared by the legacy tree and the networkx pathway builders"""
+    with open(path) as pwfile:
+        # First line in file is pathway name
+        title = pwfile.readline().strip()
+        # Second line is empty, third line is pathway description (ignored),
+        # fourth line is empty, fifth line is genes header
+        for _ in range(4):
+            pwfile.readline()
+
+        nodes = {}
+        children = {}
+        # We are interested in the first 4 columns: NAME, ID, TYPE, PARENT_ID
+        for toks in _section(pwfile):
+            row = PathwayRow(*toks[:4])
+            if row.id in nodes:
+                raise PathwayFormatError(f"{path}: duplicate node ID {row.id}")
+            nodes[row.id] = row
+            children.setdefault(row.parent, []).append(row.id)
+
+        # Edge definitions follow the csv header after the empty line
+        pwfile.readline()
+        edges = [EdgeRow(*toks[:4]) for toks in _section(pwfile)]
+
+    orphans = set(children) - set(nodes) - {"-1"}
+    if orphans:
+        raise PathwayFormatError(
+            f"{path}: parent IDs {sorted(orphans)} don't match any node"
+        )
+
+    names = Counter(row.name for row in nodes.values() if row.type == "GENE")
+    duplicates = [name for name, count in names.items() if count > 1]
+    if duplicates:
+        # Weights are indexed by biomarker, so these genes are merged
+        log.warning(f"{path}: genes {sorted(duplicates)} appear more than once")
+
+    # Edges to a container stand for the genes it directly contains
+    leaves = {
+        nid: [child for child in children.get(nid, []) if nodes[child].type == "GENE"]
+        for nid, row in nodes.items()
+        if row.type in CONTAINER_TYPES
+    }
+
+    return ParsedPathway(title, nodes, children, edges, leaves)
+
+
+def top_level_groups(parsed: ParsedPathway) -> int:
+    """Number of top-level elements that aren't processes,
+    as counted by pathways.grouped_genes_size"""
+    return sum(
+        parsed.nodes[nid].type != "PROCESS" for nid in parsed.children.get("-1", [])
+    )
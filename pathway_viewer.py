@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
+import html
+import logging as log
+import os
 import sys
-
-import networkx as nx
-import pandas as pd
-from PyQt5.QtCore import QStringListModel, Qt, pyqtSlot
-from PyQt5.QtGui import QColor
-from PyQt5.QtWebEngineWidgets import QWebEngineView
+import tempfile
+
+from PyQt5.QtCore import (
+    QCoreApplication,
+    QStringListModel,
+    Qt,
+    QThreadPool,
+    QUrl,
+    pyqtSlot,
+)
 from PyQt5.QtWidgets import (
     QApplication,
     QComboBox,
@@ -18,75 +25,238 @@ from PyQt5.QtWidgets import (
     QLabel,
     QLineEdit,
     QListWidget,
+    QProgressBar,
     QPushButton,
+    QSpinBox,
+    QStackedLayout,
     QTabWidget,
     QVBoxLayout,
     QWidget,
     QSlider
 )
 
-from analysis_nx import retrieve_mutations
-from network_builder import make_pathway_from_thres
+from mutation_colors import node_colors
+from render_cache import RenderCache
+from viewer_tasks import (
+    DEFAULT_MAX_SVG_EDGES,
+    Task,
+    build_network_view,
+    build_pathway_view,
+)
+
+# The window comes up before the data, and before the heavy modules
+# (pandas, networkx, QtWebEngine), which are imported when first needed
 
 DEFAULT_EXP = "GSE40367-stripped.txt"
 DEFAULT_GENES = "GPL570-stripped.txt"
+DEFAULT_PATIENTS = "TRIBE2_db.csv"
+DEFAULT_SEQUENCING = "TRIBE2_seq_res.csv"
+# Filters of the export dialog, with the extension of their files
+EXPORT_FORMATS = {
+    "GEXF graph representation (*.gexf)": ".gexf",
+    "GraphML (*.graphml)": ".graphml",
+    "Network arrays (*.npz)": ".npz",
+    "Scalable Vector Graphics (SVG) (*.svg)": ".svg",
+    "Interactive web page (*.html)": ".html",
+}
+
+_page_directory = None
+
+
+def annotate_pathway(pathway, mutations):
+    """Colors the nodes of a pathway by the mutation percentage of the patient"""
+    colors = node_colors(mutations)
+
+    for node in pathway.graph.nodes:
+        pathway.graph.nodes[node]["color"] = "black"
+        pathway.graph.nodes[node]["style"] = "filled"
+
+        if node in colors:
+            pathway.graph.nodes[node]["fillcolor"] = colors[node]
+        else:
+            pathway.graph.nodes[node]["fillcolor"] = "#ffffff"
+
+    return pathway
+
+
+def style_pathway(pathway):
+    """Draws the nodes of a pathway as for a patient without mutations"""
+    return annotate_pathway(pathway, {})
 
 
-def lerp(a, b, t):
-    return a * (1 - t) + b * t
+def load_patients_log(path, progress, token):
+    import pandas as pd
 
+    progress(0, "Loading patients")
+    return pd.read_csv(path).sort_values("dpfs")
 
-def percentage_to_rgb(percentage, base_color=0xFFFFFF, target_color=0xFF0000):
-    start = QColor(base_color).toHsv()
-    end = QColor(target_color).toHsv()
 
-    h = lerp(start.hue(), end.hue(), percentage / 100)
-    s = lerp(start.saturation(), end.saturation(), percentage / 100)
-    v = lerp(start.value(), end.value(), percentage / 100)
-    rgb = QColor.fromHsv(int(h), int(s), int(v)).getRgb()
+def load_sequencing(path, progress, token):
+    from mutation_store import load_mutations
 
-    return "#%02x%02x%02x" % (rgb[0], rgb[1], rgb[2])
+    progress(0, "Loading sequencing results")
+    return load_mutations(path)
 
 
-def make_coexpression_matrix(expression_db, gene_db):
-    gpl570 = pd.read_csv(gene_db, sep="\t", low_memory=False)[["ID", "Gene Symbol"]]
-    gse = pd.read_csv(expression_db, sep="\t", low_memory=False)
+def load_coexpression(expression_db, gene_db, genes, progress, token):
+    from coexpression import coexpression_matrix
 
-    tribe2_seq = pd.read_csv("TRIBE2_seq_res.csv")
-    dataset_genes = tribe2_seq["Biomarker"].unique()
+    progress(0, f"Computing coexpression of {expression_db}")
+    return coexpression_matrix(expression_db, gene_db, genes)
 
-    gpl570 = gpl570[gpl570["Gene Symbol"].isin(dataset_genes)].set_index("ID")
-    gene_data = gpl570.join(gse.set_index("ID_REF"))
-    gene_expression = gene_data.groupby("Gene Symbol").mean()
 
-    coexpression = gene_expression.T.corr()
-    return coexpression
+def web_engine_view():
+    # Importing QtWebEngine takes long, and is only needed to show a pathway.
+    # It works after the application started thanks to AA_ShareOpenGLContexts
+    from PyQt5.QtWebEngineWidgets import QWebEngineView
 
+    return QWebEngineView()
 
-class PathwayView(QWebEngineView):
-    def __init__(self, pathway, mutations):
+
+def page_directory():
+    """Temporary directory of the pages of large pathways, removed at exit"""
+    global _page_directory
+    if _page_directory is None:
+        _page_directory = tempfile.TemporaryDirectory(prefix="pathway-viewer-")
+    return _page_directory.name
+
+
+class PathwayView(QWidget):
+    """Tab showing a pathway, or a message while there is none.
+    The web view rendering the SVG is only created for the first one.
+    Pathways too large for Graphviz are drawn by a WebGL page instead"""
+
+    def __init__(self, pathway, mutations, colors=None):
         super().__init__()
         self.mutations = mutations
+        # Fill color of the genes of the patient
+        self.colors = node_colors(mutations) if colors is None else colors
+        # Network loaded from a file, shown instead of the thresholded pathway
+        self.network = None
+        # Threshold of the pathway shown
+        self.threshold = None
+        # Edge arrays of the pathway shown
+        self.edges = None
+        # Task building the contents of this view, if any
+        self.task = None
+        # SVG or large graph page shown, with the nodes colored for the patient
+        self.svg = None
+        self.page = None
+        self.page_path = None
+        self.web_view = None
+        self.zoom = 1.0
+        self.message = QLabel()
+        self.message.setAlignment(Qt.AlignCenter)
+        self.message.setWordWrap(True)
+        self.stack = QStackedLayout()
+        self.stack.addWidget(self.message)
+        self.setLayout(self.stack)
         if pathway:
             self.active_pathway = pathway
-            self.setContent(
-                nx.nx_pydot.to_pydot(self.active_pathway.graph).create_svg(),
-                "image/svg+xml",
-            )
+            self.refresh_svg()
         else:
             self.active_pathway = None
             self.setHtml(
                 """<p style='font-family: sans-serif'>No data loaded.<br>Set a threshold and click 'Refresh' to trigger graph recreation.</p>"""
             )
 
+    def setHtml(self, text):
+        self.message.setText(text)
+        self.stack.setCurrentWidget(self.message)
+
+    def zoomFactor(self):
+        return self.zoom
+
+    def setZoomFactor(self, factor):
+        self.zoom = factor
+        if self.web_view is not None:
+            self.web_view.setZoomFactor(factor)
+
     def refresh_svg(self):
-        self.setContent(
-            nx.nx_pydot.to_pydot(self.active_pathway.graph).create_svg(),
-            "image/svg+xml",
-        )
+        import networkx as nx
+
+        self.svg_changed(nx.nx_pydot.to_pydot(self.active_pathway.graph).create_svg())
+
+    def show_web_view(self):
+        if self.web_view is None:
+            self.web_view = web_engine_view()
+            self.web_view.setZoomFactor(self.zoom)
+            self.stack.addWidget(self.web_view)
+        self.stack.setCurrentWidget(self.web_view)
+        return self.web_view
 
     def svg_changed(self, svg_data):
-        self.setContent(svg_data, "image/svg+xml")
+        self.show_web_view().setContent(svg_data, "image/svg+xml")
+
+    def page_changed(self, page):
+        """Shows a large graph page. It is loaded from a file,
+        as setContent is limited to 2 MB"""
+        self.discard_page()
+        handle, self.page_path = tempfile.mkstemp(suffix=".html", dir=page_directory())
+        with os.fdopen(handle, "wb") as page_file:
+            page_file.write(page)
+        self.show_web_view().load(QUrl.fromLocalFile(self.page_path))
+
+    def discard_page(self):
+        if self.page_path is not None:
+            os.remove(self.page_path)
+            self.page_path = None
+
+    def start_task(self, task, pool):
+        """Builds the contents of the view in the background,
+        cancelling whatever was being built before"""
+        self.cancel_task()
+        self.task = task
+        task.signals.progress.connect(self.task_progress)
+        task.signals.finished.connect(self.pathway_built)
+        task.signals.failed.connect(self.pathway_failed)
+        self.show_progress(0, "Waiting for a free worker")
+        pool.start(task)
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.token.cancel()
+            self.task = None
+
+    def _from_current_task(self):
+        # Signals of cancelled tasks may still be queued
+        return self.task is not None and self.sender() is self.task.signals
+
+    def show_progress(self, percentage, message):
+        self.setHtml(
+            f"<p style='font-family: sans-serif'>{message}... ({percentage}%)</p>"
+        )
+
+    @pyqtSlot(int, str)
+    def task_progress(self, percentage, message):
+        if self._from_current_task():
+            self.show_progress(percentage, message)
+
+    def show_error(self, message):
+        self.setHtml(
+            "<p style='font-family: sans-serif'>Could not build the pathway:</p>"
+            f"<pre>{html.escape(message)}</pre>"
+        )
+
+    @pyqtSlot(object)
+    def pathway_built(self, result):
+        if self._from_current_task():
+            self.task = None
+            # The pathway is shared by the views at the same threshold,
+            # the colors of the patient are only in the SVG or page
+            self.active_pathway, self.edges, content, content_type = result
+            if content_type == "image/svg+xml":
+                self.svg, self.page = content, None
+                self.svg_changed(self.svg)
+            else:
+                self.svg, self.page = None, content
+                self.page_changed(self.page)
+
+    @pyqtSlot(str)
+    def pathway_failed(self, message):
+        if self._from_current_task():
+            self.task = None
+            self.show_error(message)
 
 
 class Viewer(QWidget):
@@ -95,8 +265,20 @@ class Viewer(QWidget):
 
         self.exp_path = DEFAULT_EXP
         self.genes_path = DEFAULT_GENES
-        self.sequencing_data = pd.read_csv("TRIBE2_seq_res.csv")
-        self.ref_coex = make_coexpression_matrix(self.exp_path, self.genes_path)
+        # Loaded in the background once the window is up
+        self.patients_log = None
+        self.sequencing_data = None
+        self.ref_coex = None
+        self.coexpression_source = None
+        # Graphs are built and laid out in the background, several at once.
+        # Layouts are shared by every patient at the same threshold
+        self.pool = QThreadPool.globalInstance()
+        self.render_cache = RenderCache()
+        # Data loading tasks running, by name, with their last message
+        self.loading = {}
+        self.loading_status = {}
+        # Views to build once the coexpression matrix is ready
+        self.waiting_views = []
 
         # Settings -----------------------------------------------------------------------------
         settings_group = QGroupBox("Pathway generation settings")
@@ -111,16 +293,27 @@ class Viewer(QWidget):
         thrs_label = QLabel("Link threshold")
         thrs_layout.addWidget(thrs_label)
         thrs_layout.addWidget(self.thrs_box)
+        # Pathways with more links are drawn by the large graph view
+        self.max_svg_edges_box = QSpinBox()
+        self.max_svg_edges_box.setRange(0, 10**8)
+        self.max_svg_edges_box.setSingleStep(500)
+        self.max_svg_edges_box.setValue(DEFAULT_MAX_SVG_EDGES)
+        self.max_svg_edges_box.setSuffix(" links")
+        # Tabs are drawn again once a value is entered, not on every keystroke
+        self.max_svg_edges_box.setKeyboardTracking(False)
+        self.max_svg_edges_box.valueChanged.connect(self.redraw_views)
 
         genes_path = QLineEdit()
         genes_path.setReadOnly(True)
         genes_path.setText(self.genes_path)
+        self.genes_path_edit = genes_path
         genes_selection = QPushButton("Genes")
         genes_selection.clicked.connect(self.set_genes_db)
 
         expression_path = QLineEdit()
         expression_path.setReadOnly(True)
         expression_path.setText(self.exp_path)
+        self.expression_path_edit = expression_path
         expression_selection = QPushButton("Expression data")
         expression_selection.clicked.connect(self.set_expression_data)
 
@@ -136,6 +329,14 @@ class Viewer(QWidget):
         settings_layout.addWidget(genes_path, 2, 1, 1, 2)
         settings_layout.addWidget(expression_selection, 3, 0)
         settings_layout.addWidget(expression_path, 3, 1, 1, 2)
+        settings_layout.addWidget(QLabel("Large graph view above"), 4, 0)
+        settings_layout.addWidget(self.max_svg_edges_box, 4, 1, 1, 2)
+        self.status_label = QLabel()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.hide()
+        settings_layout.addWidget(self.status_label, 5, 0, 1, 2)
+        settings_layout.addWidget(self.progress_bar, 5, 2)
         settings_group.setLayout(settings_layout)
 
         # Patient selection --------------------------------------------------------------------
@@ -145,9 +346,10 @@ class Viewer(QWidget):
 
         self.patients_dropdown = QComboBox()
         self.patients_dropdown.setEditable(True)
-        self.init_patients_list()
         self.add_patient_button = QPushButton("Add patient ↓")
         self.add_patient_button.clicked.connect(self.add_patient)
+        # Patients can be added once their mutations are loaded
+        self.add_patient_button.setEnabled(False)
         self.remove_patient_button = QPushButton("Remove patient ↑")
         self.remove_patient_button.clicked.connect(self.remove_patient)
         self.observed_patients = QListWidget()
@@ -162,18 +364,21 @@ class Viewer(QWidget):
 
         export_button = QPushButton("Save current view...")
         export_button.clicked.connect(self.export_gexf)
-        
+        open_network_button = QPushButton("Open network...")
+        open_network_button.clicked.connect(self.open_network)
+
         right_layout = QVBoxLayout()
         right_layout.addWidget(settings_group)
         right_layout.addWidget(patients_group)
         right_layout.addWidget(export_button)
+        right_layout.addWidget(open_network_button)
         right_pane = QWidget()
         right_pane.setMaximumWidth(400)
         right_pane.setLayout(right_layout)
 
         mainlayout = QGridLayout()
         self.tabs = QTabWidget()
-        self.tabs.tabCloseRequested.connect(lambda index: self.tabs.removeTab(index))
+        self.tabs.tabCloseRequested.connect(self.close_tab)
         self.tabs.addTab(
             PathwayView(None, []),
             "Baseline",
@@ -197,58 +402,208 @@ class Viewer(QWidget):
 
         self.setLayout(mainlayout)
 
-    def init_patients_list(self):
-        self.patients_log = pd.read_csv("TRIBE2_db.csv")
-        self.patients_log.sort_values("dpfs", inplace=True)
+        self.start_loading(
+            "patients",
+            Task(load_patients_log, DEFAULT_PATIENTS),
+            self.init_patients_list,
+        )
+        self.start_loading(
+            "sequencing",
+            Task(load_sequencing, DEFAULT_SEQUENCING),
+            self.sequencing_loaded,
+        )
+
+    def start_loading(self, name, task, finished):
+        """Runs a data loading task, reporting it in the status line.
+        A task with the same name still running is cancelled"""
+        if name in self.loading:
+            self.loading[name].token.cancel()
+        self.loading[name] = task
+        self.loading_status[name] = ""
+        task.signals.progress.connect(self.loading_progress)
+        task.signals.finished.connect(finished)
+        task.signals.failed.connect(self.loading_failed)
+        self.update_status()
+        self.pool.start(task)
+
+    def _loading_name(self):
+        # Signals of replaced tasks may still be queued
+        for name, task in self.loading.items():
+            if self.sender() is task.signals:
+                return name
+        return None
+
+    def finish_loading(self):
+        """Name of the loading task that sent the signal, which is done.
+        None for tasks replaced in the meantime"""
+        name = self._loading_name()
+        if name is not None:
+            del self.loading[name]
+            del self.loading_status[name]
+            self.update_status()
+        return name
+
+    def update_status(self):
+        self.status_label.setText(
+            "\n".join(message for message in self.loading_status.values() if message)
+        )
+        self.progress_bar.setVisible(bool(self.loading))
+
+    @pyqtSlot(int, str)
+    def loading_progress(self, percentage, message):
+        name = self._loading_name()
+        if name is not None:
+            self.loading_status[name] = message
+            self.update_status()
+
+    @pyqtSlot(str)
+    def loading_failed(self, message):
+        name = self.finish_loading()
+        if name is None:
+            return
+        log.error(f"Could not load the {name} data: {message}")
+        self.status_label.setText(f"Could not load the {name} data")
+        if name in ["sequencing", "coexpression"]:
+            for view in self.take_waiting_views():
+                view.show_error(message)
+
+    @pyqtSlot(object)
+    def init_patients_list(self, patients_log):
+        if self.finish_loading() is None:
+            return
+        self.patients_log = patients_log
         patients_list = self.patients_log["PatientFirstName"].to_list()
         model = QStringListModel(patients_list)
         self.patients_dropdown.setModel(model)
 
+    @pyqtSlot(object)
+    def sequencing_loaded(self, sequencing_data):
+        if self.finish_loading() is None:
+            return
+        self.sequencing_data = sequencing_data
+        self.add_patient_button.setEnabled(True)
+        self.update_coexpression()
+
     def remove_patient(self):
         removelist = self.observed_patients.selectedItems()
 
         for idx in removelist:
             to_close = idx.data(Qt.DisplayRole)
-            self.tabs.removeTab(self.tabs.indexOf(self.tabs.findChild(QWidget, to_close)))
+            self.close_tab(self.tabs.indexOf(self.tabs.findChild(QWidget, to_close)))
             self.observed_patients.takeItem(self.observed_patients.row(idx))
 
+    def close_tab(self, index):
+        view = self.tabs.widget(index)
+        if view is not None:
+            view.cancel_task()
+            view.discard_page()
+        self.tabs.removeTab(index)
+
     def add_patient(self):
+        from analysis_nx import retrieve_mutations
+
         new_id = self.patients_dropdown.currentText()
         new_idx = self.patients_dropdown.currentIndex()
 
         if not self.observed_patients.findItems(new_id, Qt.MatchFlag.MatchExactly):
             mutations = retrieve_mutations(new_id, self.sequencing_data)
-            pathway = self.make_annotated_pathway(mutations)
 
-            new_view = PathwayView(pathway, mutations)
+            new_view = PathwayView(None, mutations)
             new_view.setObjectName(new_id)
             tab_idx = self.tabs.addTab(new_view, new_id)
             self.tabs.setCurrentIndex(tab_idx)
             self.observed_patients.addItem(new_id)
             self.patients_dropdown.setCurrentIndex(new_idx + 1)
+            self.build_view(new_view)
+
+    def build_view(self, view, threshold=None):
+        """Starts building the pathway of a tab, at the current threshold
+        unless another one is given.
+        Views are built once the coexpression matrix is ready"""
+        if threshold is None:
+            threshold = round(self.thrs_box.value(), 10)
+        view.threshold = threshold
+        if view.network is not None:
+            self.build_network_view(view)
+            return
 
-    def make_annotated_pathway(self, mutations):
-        thres = self.thrs_box.value()
-        pathway = make_pathway_from_thres(thres, self.ref_coex)
-        muts = mutations.copy()
+        if self.ref_coex is None or "coexpression" in self.loading:
+            view.cancel_task()
+            view.show_progress(0, "Waiting for the coexpression matrix")
+            if view not in self.waiting_views:
+                self.waiting_views.append(view)
+            return
 
-        colors = {}
-        if "NGS_PercentMutated" in muts:
-            muts["NGS_PercentMutated"] = muts["NGS_PercentMutated"].map(
-                percentage_to_rgb
-            )
-            colors = muts.set_index("Biomarker").to_dict()["NGS_PercentMutated"]
+        view.start_task(
+            Task(
+                build_pathway_view,
+                view.threshold,
+                self.ref_coex,
+                view.colors,
+                self.render_cache,
+                self.coexpression_source,
+                style_pathway,
+                self.max_svg_edges_box.value(),
+            ),
+            self.pool,
+        )
 
-        for node in pathway.graph.nodes:
-            pathway.graph.nodes[node]["color"] = "black"
-            pathway.graph.nodes[node]["style"] = "filled"
+    def build_network_view(self, view):
+        """Lays out a network loaded from a file, whatever the threshold"""
+        name, edges, source = view.network
+        view.start_task(
+            Task(
+                build_network_view,
+                name,
+                edges,
+                view.colors,
+                self.render_cache,
+                source,
+                style_pathway,
+                self.max_svg_edges_box.value(),
+            ),
+            self.pool,
+        )
 
-            if node in colors:
-                pathway.graph.nodes[node]["fillcolor"] = colors[node]
-            else:
-                pathway.graph.nodes[node]["fillcolor"] = "#ffffff"
+    def update_coexpression(self):
+        """Recomputes the coexpression matrix of the genes of the dataset
+        in the background. Views being built with the previous one are
+        built again"""
+        if self.sequencing_data is None:
+            # Computed as soon as the dataset is loaded
+            return
 
-        return pathway
+        self.start_loading(
+            "coexpression",
+            Task(
+                load_coexpression,
+                self.exp_path,
+                self.genes_path,
+                self.sequencing_data.biomarkers,
+            ),
+            self.coexpression_ready,
+        )
+        for i in range(self.tabs.count()):
+            view = self.tabs.widget(i)
+            if view.task is not None and view.network is None:
+                self.build_view(view)
+
+    @pyqtSlot(object)
+    def coexpression_ready(self, coexpression):
+        if self.finish_loading() is None:
+            return
+        self.ref_coex = coexpression
+        self.coexpression_source = (self.exp_path, self.genes_path)
+        # The files may have changed since their layouts were cached
+        self.render_cache.discard(self.coexpression_source)
+        for view in self.take_waiting_views():
+            self.build_view(view)
+
+    def take_waiting_views(self):
+        # Tabs closed in the meantime are forgotten
+        views = [view for view in self.waiting_views if self.tabs.indexOf(view) >= 0]
+        self.waiting_views = []
+        return views
 
     @pyqtSlot()
     def set_genes_db(self):
@@ -257,8 +612,9 @@ class Viewer(QWidget):
             return
         else:
             self.genes_path = path
+            self.genes_path_edit.setText(path)
 
-        self.ref_coex = make_coexpression_matrix(self.exp_path, self.genes_path)
+        self.update_coexpression()
 
     @pyqtSlot()
     def set_expression_data(self):
@@ -267,8 +623,9 @@ class Viewer(QWidget):
             return
         else:
             self.exp_path = path
+            self.expression_path_edit.setText(path)
 
-        self.ref_coex = make_coexpression_matrix(self.exp_path, self.genes_path)
+        self.update_coexpression()
 
     @pyqtSlot()
     def export_gexf(self):
@@ -277,27 +634,93 @@ class Viewer(QWidget):
         if not active_pathway:
             return
 
+        # Large graphs are saved as their page rather than laid out by Graphviz
+        skipped = ".svg" if pw_view.page is not None else ".html"
         path, ext = QFileDialog.getSaveFileName(
             self,
             "Export graph information",
             self.tabs.tabText(self.tabs.currentIndex()),
-            "GEXF graph representation (*.gexf);;Scalable Vector Graphics (SVG) (*.svg)",
+            ";;".join(
+                name for name, extension in EXPORT_FORMATS.items()
+                if extension != skipped
+            ),
         )
         if not path:
             return
 
-        if ext == "GEXF graph representation (*.gexf)":
-            nx.write_gexf(active_pathway.graph, path + ".gexf")
-        else:
-            nx.nx_pydot.to_pydot(active_pathway.graph).write_svg(path + ".svg")
+        import network_export
+
+        if EXPORT_FORMATS[ext] == ".html":
+            with open(path + ".html", "wb") as page_file:
+                page_file.write(pw_view.page)
+            return
+
+        if EXPORT_FORMATS[ext] == ".svg":
+            if pw_view.svg is not None:
+                with open(path + ".svg", "wb") as svg_file:
+                    svg_file.write(pw_view.svg)
+            else:
+                import networkx as nx
+
+                nx.nx_pydot.to_pydot(active_pathway.graph).write_svg(path + ".svg")
+            return
+
+        # Written straight from the edge arrays, which stay small
+        # for networks too large to go through networkx
+        edges = pw_view.edges
+        if edges is None:
+            edges = network_export.edge_list(active_pathway.graph)
+        network_export.export_network(
+            path + EXPORT_FORMATS[ext],
+            edges,
+            {self.tabs.tabText(self.tabs.currentIndex()): pw_view.colors},
+        )
+
+    @pyqtSlot()
+    def open_network(self):
+        """Shows a network saved as .npz, with a tab for every patient
+        whose colors it holds"""
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Open network", "", "Network arrays (*.npz)"
+        )
+        if not path:
+            return
+
+        from network_export import load_network, patient_colors
+
+        network = load_network(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        # Every tab of the file shares its layout
+        source = ("network", path, os.path.getmtime(path))
+        tabs = {
+            f"{name}: {patient}": patient_colors(network, patient)
+            for patient in network.patients
+        } or {name: {}}
+        for title, colors in tabs.items():
+            view = PathwayView(None, [], colors)
+            view.network = (name, network.edges, source)
+            view.setObjectName(title)
+            self.tabs.setCurrentIndex(self.tabs.addTab(view, title))
+            self.build_view(view)
 
     def refresh_view(self):
-        pw_view = self.tabs.currentWidget()
-        pw_view.active_pathway = self.make_annotated_pathway(pw_view.mutations)
-        pw_view.refresh_svg()
+        self.build_view(self.tabs.currentWidget())
+
+    @pyqtSlot()
+    def redraw_views(self):
+        """Builds every tab again at its threshold, when the size of the
+        large graph view changed. Only the pathways that switch between
+        Graphviz and the large graph view are laid out again"""
+        for i in range(self.tabs.count()):
+            view = self.tabs.widget(i)
+            # Tabs never built stay empty
+            if view.threshold is not None:
+                self.build_view(view, view.threshold)
 
 
 if __name__ == "__main__":
+    # Lets QtWebEngine be imported after the application is created
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication([])
     window = Viewer()
     window.show()
@@ -2,6 +2,8 @@ import logging
 from collections import namedtuple
 from enum import Enum
 
+from pathway_parser import ParsedPathway, PathwayFormatError, read_pathway
+
 Node = namedtuple("Node", ["name", "parent", "children", "type"])
 
 
@@ -14,106 +16,51 @@ class PType(Enum):
     PROCESS = 3
 
 
-def __construct_node(toks):
-    parent = None if toks[3] == "-1" else toks[3]
-    return Node(toks[0], parent, {}, PType[toks[2]])
-
-
-def __attempt_add_child(g, parent, nid, node):
-    if parent in g:
-        g[parent][0].children[nid] = [node, []]
-        logging.debug(f"Added {node} to {g[parent]}")
-        return True
-
-    for subg in g:
-        if __attempt_add_child(g[subg][0].children, parent, nid, node):
-            return True
-
-    return False
-
-
-def __process_stash(g, stash):
-    # This is not particularly efficient due to the stash copy..
-    for toks in stash[:]:
-        logging.debug(f"{toks[0]} :looking for parent in stash {toks[3]}")
-        if toks[3] in g:
-            g[toks[3]][0].children[toks[1]] = [__construct_node(toks), []]
-            stash.remove(toks)
-        else:
-            if __attempt_add_child(g, toks[3], toks[1], __construct_node(toks)):
-                stash.remove(toks)
-
-
-def __find_node(g, nid):
-    if not g:
-        return {}
-
-    logging.debug(f"Looking for node {nid}")
-    logging.debug(f"Graph is {g}")
-    if nid in g:
-        logging.debug("Element located")
-        return g[nid]
-
-    logging.debug(f"Choices: {g.keys()}")
-    for node in g:
-        logging.debug(f"Now looking at {node}")
-        res = __find_node(g[node][0].children, nid)
-        if res:
-            return res
-
-    return {}
-
-
 # Transforms a pathwaymapper file into a graph
 def parse_pathway(path: str):
     """Parses a pathwaymapper file, returning a tree-like graph structure"""
-    g = {}
+    return parsed_to_tree(read_pathway(path), path)
+
+
+def parsed_to_tree(parsed: ParsedPathway, path="<pathway>"):
+    """Builds the tree-like structure of an already parsed pathway"""
+
+    # Every element is [Node, [edge targets]], children are attached by ID
+    elements = {
+        nid: [
+            Node(
+                row.name,
+                None if row.parent == "-1" else row.parent,
+                {},
+                PType[row.type],
+            ),
+            [],
+        ]
+        for nid, row in parsed.nodes.items()
+    }
 
-    with open(path) as pwfile:
-        # First line in file is pathway name
-        title = pwfile.readline().strip()
-        # Second line is empty
-        pwfile.readline()
-        # Third line is pathway description, ignore for now
-        pwfile.readline()
-        # Fourth line is empty, fifth line is genes header
-        pwfile.readline()
-        pwfile.readline()
-
-        # Now parse the genes
-        cur_str = pwfile.readline()
-        stash = []
-        while cur_str.strip() != "":
-            toks = cur_str.split("\t")
-
-            # We are interested in the first 4 columns:
-            # NAME, ID, TYPE, PARENT_ID
-
-            # In the first pass, add top-level nodes
-            if toks[3] == "-1":
-                g[toks[1]] = [__construct_node(toks), []]
-            else:
-                stash.append(toks)
-
-            cur_str = pwfile.readline()
-
-        # Now that all the toplevel nodes have been added,
-        # attach their children
-        while len(stash) > 0:
-            __process_stash(g, stash)
-
-        # Hit an empty line, edge definitions should follow after the csv header
-        pwfile.readline()
-        cur_str = pwfile.readline()
-        while cur_str.strip() != "":
-            toks = cur_str.split("\t")
-
-            __find_node(g, toks[1])[1].append(toks[2])
-            logging.debug(f"Edge added: {toks[1]}  ->{toks[2]}")
-
-            cur_str = pwfile.readline()
-
-    return (title, g)
+    g = {}
+    for nid, row in parsed.nodes.items():
+        siblings = g if row.parent == "-1" else elements[row.parent][0].children
+        siblings[nid] = elements[nid]
+
+    # Parent chains that loop on themselves never reach the top level
+    reachable = 0
+    pending = list(g.values())
+    while pending:
+        element = pending.pop()
+        reachable += 1
+        pending.extend(element[0].children.values())
+    if reachable != len(elements):
+        raise PathwayFormatError(f"{path}: cyclic parent IDs")
+
+    for edge in parsed.edges:
+        if edge.source not in elements:
+            raise PathwayFormatError(f"{path}: edge from unknown node {edge.source}")
+        elements[edge.source][1].append(edge.target)
+        logging.debug("Edge added: %s  ->%s", edge.source, edge.target)
+
+    return (parsed.title, g)
 
 
 def grouped_genes_size(pathway):
@@ -5,6 +5,15 @@ from dataclasses import dataclass, field
 import networkx as nx
 import pandas as pd
 
+import measure_cache
+from instrumentation import count, span
+from pathway_parser import (
+    ParsedPathway,
+    PathwayFormatError,
+    read_pathway,
+    top_level_groups,
+)
+
 AliasItem = namedtuple("AliasItem", ["parent", "genes"])
 GeneElem = namedtuple("GeneElem", ["name", "id", "parent"])
 
@@ -14,152 +23,151 @@ class Pathway:
     name: str
     graph: nx.DiGraph
     measures: dict = field(default_factory=dict)
+    # Top-level elements, the denominator of the baseline score
+    groups: int = None
 
     def calculate_measure(self, function, with_complexes=False):
         """Returns a series with weights for a specific function.
         Indexed by biomarker (*not* ID)"""
-        # Cache results
-        if function in self.measures and with_complexes in self.measures[function]:
-            return self.measures[function][with_complexes]
-
+        weights = self.cached_measure(function, with_complexes)
+        if weights is None:
+            count("measure.miss")
+            name = getattr(function, "__name__", repr(function))
+            with span("measure", pathway=self.name, measure=name):
+                node_weights = function(self.graph)
+            weights = self.store_measure(function, node_weights, with_complexes)
+
+        return weights
+
+    def cached_measure(self, function, with_complexes=False):
+        """Returns weights computed earlier, from memory or the on-disk cache"""
+        cached = self.measures.get(function, {})
+        if with_complexes in cached:
+            count("measure.memory_hit")
+            return cached[with_complexes]
+
+        disk_cache = measure_cache.active_cache()
+        if not disk_cache:
+            return None
+
+        weights = disk_cache.get(self.graph, function, with_complexes)
+        if weights is not None:
+            count("measure.disk_hit")
+            self.measures.setdefault(function, {})[with_complexes] = weights
+        return weights
+
+    def store_measure(self, function, node_weights, with_complexes=False):
+        """Caches the per-node results of a function, returns them as weights"""
+        weights = self.label_weights(node_weights, with_complexes)
+
+        disk_cache = measure_cache.active_cache()
+        if disk_cache:
+            disk_cache.put(self.graph, function, with_complexes, weights)
+
+        self.measures.setdefault(function, {})[with_complexes] = weights
+        return weights
+
+    def label_weights(self, weights, with_complexes=False):
+        """Indexes per-node weights by biomarker, optionally scaled
+        by the family/complex weight of every gene"""
         gene_names = nx.get_node_attributes(self.graph, "label")
-        weights = function(self.graph)
-        # Index by biomarker
         weights = {gene_names[k]: weights[k] for k, _ in weights.items()}
 
         # Separate paths as optimization
-        self.measures[function] = {}
         if not with_complexes:
-            self.measures[function][with_complexes] = pd.Series(weights)
-            return self.measures[function][with_complexes]
+            return pd.Series(weights)
         else:
             gene_weights = nx.get_node_attributes(self.graph, "famcomw")
-            self.measures[function][with_complexes] = pd.Series(weights).mul(
+            return pd.Series(weights).mul(
                 pd.Series(
                     {gene_names[k]: gene_weights[k] for k, v in gene_weights.items()}
                 )
             )
-            return self.measures[function][with_complexes]
+
+    def baseline_weights(self):
+        """Weights of the baseline score: every gene counts the same,
+        and scores are divided by the number of top-level groups.
+        Graphs not coming from a pathway file only have top-level genes"""
+        groups = self.groups if self.groups is not None else len(self.graph)
+        genes = pd.Index(self.get_genes()).drop_duplicates()
+        return pd.Series(1.0, index=genes) / groups
 
     def get_genes(self):
         return nx.get_node_attributes(self.graph, "label").values()
 
 
-def __make_node_aliases(data: list[str]):
+def __make_node_aliases(parsed: ParsedPathway):
     """Alias a genes ID to their families
     in order to build edges between them"""
     famcom = {}
-    elems = [tokens for tokens in data if tokens[2] in ["FAMILY", "COMPLEX"]]
-    # Add all (gene) containers first
-    for tokens in elems:
-        famcom[tokens[1]] = AliasItem(tokens[3], [])
+    for nid, leaves in parsed.leaves.items():
+        famcom[nid] = AliasItem(
+            parsed.nodes[nid].parent,
+            [GeneElem(parsed.nodes[gid].name, gid, nid) for gid in leaves],
+        )
 
     log.debug(famcom)
-    elems = [tokens for tokens in data if tokens[2] == "GENE"]
-    for tokens in elems:
-        # Add gene to its parent
-        famcom[tokens[3]].genes.append(GeneElem(tokens[0], tokens[1], tokens[3]))
-
     return famcom
 
 
 def pathway_to_nx(path: str) -> Pathway:
     """Parses a pathwaymapper file, returning a NetworkX graph"""
+    return parsed_to_nx(read_pathway(path), path)
+
+
+def parsed_to_nx(parsed: ParsedPathway, path="<pathway>") -> Pathway:
+    """Builds the NetworkX graph of an already parsed pathway"""
     g = nx.DiGraph()
 
-    with open(path) as pwfile:
-        # First line in file is pathway name
-        title = pwfile.readline().strip()
-        # Second line is empty
-        pwfile.readline()
-        # Third line is pathway description, ignore for now
-        pwfile.readline()
-        # Fourth line is empty, fifth line is genes header
-        pwfile.readline()
-        pwfile.readline()
-
-        # Now parse the genes
-        cur_str = pwfile.readline()
-        stash = []
-        while cur_str.strip() != "":
-            toks = cur_str.split("\t")
-
-            # We are interested in the first 4 columns:
-            # NAME, ID, TYPE, PARENT_ID
-
-            # In the first pass, add top-level nodes by id;
-            # store their name for convenience
-            if toks[3] == "-1" and toks[2] == "GENE":
-                g.add_node(toks[1], label=toks[0], famcomw=1)
-                log.debug(f"Node added: {toks[0]}, {toks[1]}")
-            else:
-                stash.append(toks)
-                log.debug(f"Process later: {toks[0]}, {toks[1]}")
-
-            cur_str = pwfile.readline()
-
-        aliases = __make_node_aliases(stash)
-        # Add all genes to the top-level graph
-        for item in aliases:
-            to_add = [g for g in aliases[item].genes if not g.id in aliases]
-            for gene in to_add:
-                parent = aliases[gene.parent]
-                famcomsize = len(parent.genes)
-                # Take into account the size of all the ancestor containers
-                # e.g.: if gene A is in a complex of size 2 inside of a complex of size 3,
-                # it should have a final weight of 1/6
-                while parent.parent != "-1":
-                    parent = aliases[parent.parent]
-                    famcomsize *= len(parent.genes)
-                g.add_node(
-                    gene.id,
-                    label=gene.name,
-                    famcomw=(1 if famcomsize == 0 else 1 / famcomsize),
-                )
-                log.debug(f"Node added: {gene.name}, {gene.id}, 1/{famcomsize}")
-
-        # Hit an empty line, edge definitions should follow after the csv header
-        pwfile.readline()
-        cur_str = pwfile.readline()
-        while cur_str.strip() != "":
-            toks = cur_str.split("\t")
-
-            source_nodes = []
-            if toks[1] in aliases:
-                deepen = [toks[1]]
-                while deepen:
-                    gid = deepen.pop(0)
-                    if gid in aliases:
-                        deepen.extend([g.id for g in aliases[gid].genes])
-                    else:
-                        source_nodes.append(gid)
-            else:
-                source_nodes = [toks[1]]
-
-            target_nodes = []
-            if toks[2] in aliases:
-                deepen = [toks[2]]
-                while deepen:
-                    gid = deepen.pop(0)
-                    if gid in aliases:
-                        deepen.extend([g.id for g in aliases[gid].genes])
-                    else:
-                        target_nodes.append(gid)
-            else:
-                target_nodes = [toks[2]]
-
-            for source in source_nodes:
-                if source not in g:
-                    continue
+    # Add top-level nodes by id; store their name for convenience
+    for row in parsed.nodes.values():
+        if row.parent == "-1" and row.type == "GENE":
+            g.add_node(row.id, label=row.name, famcomw=1)
+            log.debug("Node added: %s, %s", row.name, row.id)
+
+    aliases = __make_node_aliases(parsed)
+    # Add all genes to the top-level graph
+    for item in aliases:
+        for gene in aliases[item].genes:
+            parent = aliases[gene.parent]
+            famcomsize = len(parent.genes)
+            # Take into account the size of all the ancestor containers
+            # e.g.: if gene A is in a complex of size 2 inside of a complex of size 3,
+            # it should have a final weight of 1/6
+            while parent.parent != "-1":
+                if parent.parent not in aliases:
+                    raise PathwayFormatError(
+                        f"{path}: container {gene.parent} is not inside a family or complex"
+                    )
+                parent = aliases[parent.parent]
+                famcomsize *= len(parent.genes)
+            g.add_node(
+                gene.id,
+                label=gene.name,
+                famcomw=(1 if famcomsize == 0 else 1 / famcomsize),
+            )
+            log.debug("Node added: %s, %s, 1/%s", gene.name, gene.id, famcomsize)
+
+    for row in parsed.nodes.values():
+        if row.type == "GENE" and row.parent != "-1" and row.parent not in aliases:
+            raise PathwayFormatError(
+                f"{path}: gene {row.name} is inside a {parsed.nodes[row.parent].type}"
+            )
+
+    for edge in parsed.edges:
+        source_nodes = parsed.leaves.get(edge.source, [edge.source])
+        target_nodes = parsed.leaves.get(edge.target, [edge.target])
 
-                for target in target_nodes:
-                    # Don't link to processes for now
-                    if target not in g:
-                        continue
-                    g.add_edge(source, target, label=toks[3])
+        for source in source_nodes:
+            if source not in g:
+                continue
 
-            log.debug(f"Edge added: {source_nodes}-{toks[3]}->{target_nodes}")
+            for target in target_nodes:
+                # Don't link to processes for now
+                if target not in g:
+                    continue
+                g.add_edge(source, target, label=edge.type)
 
-            cur_str = pwfile.readline()
+        log.debug("Edge added: %s-%s->%s", source_nodes, edge.type, target_nodes)
 
-    return Pathway(title, g)
+    return Pathway(parsed.title, g, groups=top_level_groups(parsed))
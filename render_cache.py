@@ -0,0 +1,126 @@
+import html
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, TimeoutError
+
+# Layouts and edge lists kept in memory, the least recently used ones
+# are dropped
+DEFAULT_MAX_ENTRIES = 16
+# How often (seconds) a task waiting for a layout checks for cancellation
+WAIT_POLL = 0.1
+
+# Fill of the shape drawn by Graphviz for every node: <g class="node">,
+# then its <title> (the node name), then the first shape with a fill,
+# without leaving the group of the node
+NODE_FILL = re.compile(
+    r'<g id="[^"]*" class="node">\s*<title>(?P<name>[^<]*)</title>'
+    r'(?:(?!</g>).)*?<(?:ellipse|polygon|path)\b[^>]*?\bfill="(?P<fill>[^"]*)"',
+    re.DOTALL,
+)
+
+# A thresholded pathway, with its edges and the template of its layout,
+# an SvgTemplate or a GraphPage for large ones
+RenderedPathway = namedtuple("RenderedPathway", ["pathway", "template", "edges"])
+
+
+class _Abandoned(Exception):
+    """The task building a layout gave up on it"""
+
+
+class SvgTemplate:
+    """SVG laid out by Graphviz, cut around the fill color of every node.
+    Coloring the nodes for a patient is then a single join"""
+
+    content_type = "image/svg+xml"
+
+    def __init__(self, svg: bytes):
+        text = svg.decode()
+        self.parts = []
+        self.names = []
+        self.fills = []
+        start = 0
+        for match in NODE_FILL.finditer(text):
+            self.parts.append(text[start : match.start("fill")])
+            self.names.append(html.unescape(match.group("name")))
+            self.fills.append(match.group("fill"))
+            start = match.end("fill")
+        self.parts.append(text[start:])
+
+    def render(self, colors) -> bytes:
+        """SVG with nodes filled with colors[name], or left as laid out"""
+        pieces = [self.parts[0]]
+        for name, fill, part in zip(self.names, self.fills, self.parts[1:]):
+            pieces.append(colors.get(name, fill))
+            pieces.append(part)
+        return "".join(pieces).encode()
+
+
+class RenderCache:
+    """Layouts of the thresholded pathways of the viewer, and their edges,
+    keyed by (coexpression source, threshold, ...): their topology is the
+    same for every patient. Tasks asking for an entry being computed by
+    another one wait for it instead of computing it again"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build, token=None):
+        """Cached entry for key, or the one returned by build()"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                owner = entry is None
+                if owner:
+                    entry = self._entries[key] = Future()
+                else:
+                    self._entries.move_to_end(key)
+
+            if owner:
+                return self._build(key, entry, build)
+
+            try:
+                return self._wait(entry, token)
+            except _Abandoned:
+                # The task building it was cancelled or failed: build it here
+                continue
+
+    def _build(self, key, entry, build):
+        try:
+            rendered = build()
+        except BaseException:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry.set_exception(_Abandoned())
+            raise
+
+        entry.set_result(rendered)
+        self._evict()
+        return rendered
+
+    def _wait(self, entry, token):
+        while True:
+            try:
+                return entry.result(timeout=WAIT_POLL)
+            except TimeoutError:
+                if token is not None:
+                    token.check()
+
+    def _evict(self):
+        with self._lock:
+            done = [key for key, entry in self._entries.items() if entry.done()]
+            for key in done[: max(0, len(done) - self.max_entries)]:
+                del self._entries[key]
+
+    def discard(self, source):
+        """Forgets the layouts of a coexpression source"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == source]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
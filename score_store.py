@@ -0,0 +1,164 @@
+import logging as log
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import cache_utils
+import scoring
+from measure_cache import measure_name
+from measures import MEASURES
+from mutation_store import relevant_mutations
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient TEXT NOT NULL,
+    library TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    hierarchy INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (patient, library, measure, hierarchy)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scores (
+    patient TEXT NOT NULL,
+    library TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    hierarchy INTEGER NOT NULL,
+    pathway TEXT NOT NULL,
+    score REAL,
+    PRIMARY KEY (library, measure, hierarchy, patient, pathway)
+) WITHOUT ROWID;
+"""
+
+
+def patient_fingerprints(mutations_data, patients=None) -> pd.Series:
+    """Digest of the relevant mutation rows of every patient.
+    Rows are hashed one by one and summed, so the order of the rows
+    in the sequencing results doesn't matter"""
+    data = relevant_mutations(mutations_data)
+    if patients is not None:
+        data = data[data["PatientFirstName"].isin(patients)]
+
+    rows = pd.util.hash_pandas_object(
+        data[["Biomarker", "NGS_PercentMutated"]].astype(
+            {"Biomarker": str, "NGS_PercentMutated": np.float64}
+        ),
+        index=False,
+    )
+    grouped = rows.groupby(data["PatientFirstName"].astype(str).to_numpy())
+    # Sums wrap around, the row count tells apart rows that cancel out
+    return grouped.sum().map("{:016x}".format) + "-" + grouped.size().astype(str)
+
+
+def measure_key(measure) -> str:
+    """Name under which the scores of a measure are stored"""
+    if isinstance(measure, str):
+        measure = MEASURES.get(measure, measure)
+    return measure if isinstance(measure, str) else measure_name(measure)
+
+
+class ScoreStore:
+    """Patient scores kept in SQLite across runs, keyed by patient, pathway
+    library version, measure and hierarchy flag. Every patient also has the
+    fingerprint of the mutations it was scored with, so that only new or
+    changed patients are scored again"""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_utils.CACHE_DIRECTORY, "scores.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fingerprints(self, library_version, measure, hierarchy) -> pd.Series:
+        """Fingerprints of the patients already scored"""
+        rows = self._connection.execute(
+            "SELECT patient, fingerprint FROM patients "
+            "WHERE library = ? AND measure = ? AND hierarchy = ?",
+            (library_version, measure_key(measure), int(hierarchy)),
+        ).fetchall()
+        return pd.Series(dict(rows), dtype=object)
+
+    def update(self, patients, library, measure, hierarchy, mutations_data):
+        """Scores the patients whose mutations or pathways changed since
+        they were last stored. Returns the patients scored again"""
+        key = (library.version(), measure_key(measure), int(hierarchy))
+        patients = pd.Index(patients).drop_duplicates().astype(str)
+
+        current = patient_fingerprints(mutations_data, patients)
+        stored = self.fingerprints(*key)
+        stale = current[current.ne(stored.reindex(current.index))].index
+        # Patients left without relevant mutations aren't scored anymore
+        removed = stored.index.intersection(patients).difference(current.index)
+        log.debug(f"{len(stale)} patients to score, {len(removed)} to remove")
+
+        scores = pd.DataFrame()
+        if not stale.empty:
+            pathways = library.pathways()
+            measure = MEASURES.get(measure, measure)
+            scores = scoring.score_patients_with_config(
+                stale,
+                pathways,
+                mutations_data,
+                {pw.name: scoring.PathwayConfig(measure, hierarchy) for pw in pathways},
+            )
+
+        with self._connection:
+            self._delete(key, stale.union(removed))
+            self._connection.executemany(
+                "INSERT INTO patients VALUES (?, ?, ?, ?, ?)",
+                [(patient, *key, current[patient]) for patient in stale],
+            )
+            if not scores.empty:
+                long = scores.melt(
+                    id_vars="PatientFirstName", var_name="pathway", value_name="score"
+                )
+                self._connection.executemany(
+                    "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (patient, *key, pathway, float(score))
+                        for patient, pathway, score in long.itertuples(index=False)
+                    ],
+                )
+
+        return stale.tolist()
+
+    def _delete(self, key, patients):
+        for table in ["patients", "scores"]:
+            self._connection.executemany(
+                f"DELETE FROM {table} WHERE patient = ? "
+                "AND library = ? AND measure = ? AND hierarchy = ?",
+                [(patient, *key) for patient in patients],
+            )
+
+    def query(self, library_version, measure, hierarchy, patients=None):
+        """Stored scores as a patient × pathway frame,
+        laid out like analysis_nx.process_patients_with_f.
+        Scores are always floats"""
+        scores = pd.read_sql_query(
+            "SELECT patient, pathway, score FROM scores "
+            "WHERE library = ? AND measure = ? AND hierarchy = ?",
+            self._connection,
+            params=(library_version, measure_key(measure), int(hierarchy)),
+        )
+        if patients is not None:
+            scores = scores[scores["patient"].isin(pd.Index(patients).astype(str))]
+
+        wide = scores.pivot(index="patient", columns="pathway", values="score")
+        wide.columns.name = None
+        return wide.rename_axis("PatientFirstName").reset_index()
+
+    def score(self, patients, library, measure, hierarchy, mutations_data):
+        """Brings the stored scores up to date, then returns the full cohort"""
+        self.update(patients, library, measure, hierarchy, mutations_data)
+        return self.query(library.version(), measure, hierarchy, patients)
@@ -0,0 +1,223 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import traced
+from mutation_store import relevant_mutations
+
+MutationMatrix = namedtuple("MutationMatrix", ["values", "patients", "genes"])
+# Measure and hierarchy flag used to score a pathway.
+# The measure can also be BASELINE, every gene weighing the same
+PathwayConfig = namedtuple("PathwayConfig", ["measure", "hierarchy"])
+
+BASELINE = "baseline"
+
+
+@traced("score.mutation_matrix")
+def mutation_matrix(patients, seq_data, genes):
+    """Builds a sparse patient × gene matrix holding the highest
+    NGS_PercentMutated of every (patient, gene) pair.
+    Patients without any relevant mutation are left out"""
+    # scipy.sparse is slow to import, and analysis_nx imports this module
+    from scipy import sparse
+
+    patients = pd.Index(patients).drop_duplicates()
+    genes = pd.Index(genes).drop_duplicates()
+
+    patient_data = relevant_mutations(seq_data)
+    patient_data = patient_data[patient_data["PatientFirstName"].isin(patients)]
+    # Keep the order in which patients were requested
+    patients = patients[patients.isin(patient_data["PatientFirstName"])]
+
+    patient_data = patient_data[patient_data["Biomarker"].isin(genes)]
+    max_mutations = (
+        pd.DataFrame(
+            {
+                "row": patients.get_indexer(patient_data["PatientFirstName"]),
+                "col": genes.get_indexer(patient_data["Biomarker"]),
+                "value": patient_data["NGS_PercentMutated"].to_numpy(),
+            }
+        )
+        .groupby(["row", "col"])["value"]
+        .max()
+        # Missing percentages don't contribute to the score, but still count
+        # as a mutation inside of the pathway
+        .fillna(0.0)
+    )
+
+    values = sparse.csr_matrix(
+        (
+            max_mutations.to_numpy(dtype=np.float64),
+            (
+                max_mutations.index.get_level_values("row"),
+                max_mutations.index.get_level_values("col"),
+            ),
+        ),
+        shape=(len(patients), len(genes)),
+    )
+    # Explicit zeros are kept on purpose, see pathway_presence()
+    return MutationMatrix(values, patients, genes)
+
+
+def pathway_presence(mutations, pathways):
+    """Returns a boolean patient × pathway matrix, True where a patient
+    has at least one mutation in the genes of a pathway"""
+    membership = np.zeros((len(mutations.genes), len(pathways)))
+    for j, pw in enumerate(pathways):
+        membership[mutations.genes.get_indexer(list(pw.get_genes())), j] = 1
+
+    mutated = mutations.values.copy()
+    mutated.data = np.ones_like(mutated.data)
+    return (mutated @ membership) > 0
+
+
+def normalized_weights(pw, measure, hierarchy=False):
+    """Weights of a pathway divided by their total, None if they sum up to zero.
+    The baseline weights are normalized by the pathway's top-level groups"""
+    if measure == BASELINE:
+        return pw.baseline_weights()
+
+    weights = pw.calculate_measure(measure, hierarchy)
+    total_weights = weights.sum()
+    if total_weights == 0:
+        return None
+    return weights / total_weights
+
+
+def weight_matrix(pathways, genes, f, factor_famcom=False):
+    """Builds a dense gene × pathway matrix of normalized measure weights.
+    Also returns a mask of the pathways whose weights sum up to zero"""
+    return configured_weight_matrix(
+        pathways, genes, [PathwayConfig(f, factor_famcom)] * len(pathways)
+    )
+
+
+@traced("score.weight_matrix")
+def configured_weight_matrix(pathways, genes, configs):
+    """Same as weight_matrix, with a PathwayConfig for every pathway"""
+    weights = np.zeros((len(genes), len(pathways)))
+    zero_weights = np.zeros(len(pathways), dtype=bool)
+    for j, (pw, config) in enumerate(zip(pathways, configs)):
+        pw_weights = normalized_weights(pw, config.measure, config.hierarchy)
+        if pw_weights is None:
+            zero_weights[j] = True
+            continue
+
+        rows = genes.get_indexer(pw_weights.index)
+        found = rows >= 0
+        weights[rows[found], j] = np.nan_to_num(
+            pw_weights.to_numpy(dtype=np.float64)[found]
+        )
+
+    return weights, zero_weights
+
+
+def scores_to_frame(mutations, pathways, scores, zero_weights):
+    """Packs a patient × pathway score matrix into the same
+    DataFrame returned by analysis_nx.process_patients_with_f"""
+    if mutations.patients.empty:
+        return (
+            pd.DataFrame.from_dict({}, orient="index")
+            .rename_axis("PatientFirstName")
+            .reset_index()
+        )
+
+    result = pd.DataFrame(
+        scores, index=mutations.patients, columns=[pw.name for pw in pathways]
+    )
+
+    # The reference implementation returns an integer 0 for pathways with
+    # null weights, which only survives if every patient hits that branch
+    if zero_weights.any():
+        presence = pathway_presence(mutations, pathways)
+        for j in np.flatnonzero(zero_weights & presence.all(axis=0)):
+            result[pathways[j].name] = result[pathways[j].name].astype(np.int64)
+
+    return result.rename_axis("PatientFirstName").reset_index()
+
+
+@traced("score.patients")
+def score_patients_with_f(patients, f, pathways, mutations_data, complexes=False):
+    """Vectorized equivalent of analysis_nx.process_patients_with_f"""
+    genes = pd.Index(
+        [gene for pw in pathways for gene in pw.get_genes()]
+    ).drop_duplicates()
+    mutations = mutation_matrix(patients, mutations_data, genes)
+    weights, zero_weights = weight_matrix(pathways, genes, f, complexes)
+
+    scores = mutations.values @ weights
+    return scores_to_frame(mutations, pathways, scores, zero_weights)
+
+
+@traced("score.patients")
+def score_patients_with_config(patients, pathways, mutations_data, config):
+    """Vectorized equivalent of analysis_nx.process_patients_with_config.
+    config maps every pathway name to a PathwayConfig"""
+    genes = pd.Index(
+        [gene for pw in pathways for gene in pw.get_genes()]
+    ).drop_duplicates()
+    mutations = mutation_matrix(patients, mutations_data, genes)
+    weights, zero_weights = configured_weight_matrix(
+        pathways, genes, [config[pw.name] for pw in pathways]
+    )
+
+    scores = mutations.values @ weights
+    return scores_to_frame(mutations, pathways, scores, zero_weights)
+
+
+Evaluation = namedtuple("Evaluation", ["scores", "correlations"])
+
+
+@traced("score.evaluate_measures")
+def evaluate_measures(
+    patients_log,
+    mutations_data,
+    pathways,
+    measures,
+    group_by="arm",
+    complexes=False,
+    outcome="dpfs",
+):
+    """Scores every patient of every group under every measure in one pass.
+    measures maps a name to a measure function.
+    Returns a long (patient, group, pathway, measure, score) frame and,
+    per group, the pathway × measure correlation of the scores with outcome"""
+    patients_log = patients_log.drop_duplicates("PatientFirstName").set_index(
+        "PatientFirstName"
+    )
+    genes = pd.Index(
+        [gene for pw in pathways for gene in pw.get_genes()]
+    ).drop_duplicates()
+    mutations = mutation_matrix(patients_log.index, mutations_data, genes)
+
+    # One product for all the measures: weights are stacked side by side
+    weights = np.hstack(
+        [weight_matrix(pathways, genes, f, complexes)[0] for f in measures.values()]
+    )
+    columns = pd.MultiIndex.from_product(
+        [list(measures), [pw.name for pw in pathways]], names=["measure", "pathway"]
+    )
+    wide = pd.DataFrame(
+        mutations.values @ weights, index=mutations.patients, columns=columns
+    ).rename_axis("PatientFirstName")
+
+    groups = patients_log.loc[wide.index, group_by]
+    scores = (
+        wide.melt(value_name="score", ignore_index=False)
+        .reset_index()
+        .merge(groups.reset_index(), on="PatientFirstName")
+    )
+    scores = scores[["PatientFirstName", group_by, "pathway", "measure", "score"]]
+
+    outcomes = patients_log.loc[wide.index, outcome]
+    correlations = pd.concat(
+        {
+            group: wide[groups == group].corrwith(outcomes[groups == group])
+            for group in sorted(groups.unique())
+        },
+        names=[group_by],
+    )
+    correlations = correlations.unstack("measure")[list(measures)]
+
+    return Evaluation(scores, correlations)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+import argparse
+import logging as log
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import cache_utils
+from coexpression import (
+    DEFAULT_CHUNKSIZE,
+    coexpression_key,
+    gene_expression,
+    probe_symbols,
+    standardize,
+)
+from instrumentation import count, traced
+from network_builder import TOPK_BYTES, TOPK_PICK_BYTES, EdgeList, topk_pairs
+from network_export import load_network, save_network
+
+# Memory (bytes) for the correlation: the standardization of the
+# expression, then the standardized expression, the tiles being computed
+# or waiting to be written, and the edges being sorted
+DEFAULT_MAX_MEMORY = 2**30
+# Bytes per value of the expression while it is standardized: float64
+# copy, missing mask and float32 result. Spearman first copies float64 ranks
+STANDARDIZE_BYTES = 8 + 1 + 4
+SPEARMAN_BYTES = 8 + 8
+# Bytes per correlation of a tile being computed: float32 product and
+# |r| > t masks, then if every pair is kept, the int64 positions of
+# np.nonzero and the edges
+TILE_BYTES = 8 + 16 + 12
+# Bytes per edge of a finished tile: int32 source and target, float32 r
+EDGE_BYTES = 4 + 4 + 4
+# Bytes per edge sorted when a block of rows is written: the edges read
+# back, their order (int64) and the sorted edges
+MERGE_BYTES = EDGE_BYTES + 8 + EDGE_BYTES
+MIN_BLOCK = 64
+PARTS = ["sources", "targets", "weights"]
+PART_TYPES = [np.int32, np.int32, np.float32]
+
+
+def block_size(genes, samples, max_memory, workers, method="pearson"):
+    """Largest tile side keeping the correlation within max_memory.
+    Standardizing the expression comes first, then up to 2 * workers tiles
+    are in flight (workers of them computed) while the edges of a block of
+    rows are sorted, at most a tile or a row of edges at a time"""
+    cells = genes * samples
+    per_value = SPEARMAN_BYTES if method == "spearman" else STANDARDIZE_BYTES
+    available = max_memory - cells * np.dtype(np.float32).itemsize - genes * MERGE_BYTES
+    per_correlation = workers * (TILE_BYTES + 2 * EDGE_BYTES) + MERGE_BYTES
+    block = int(np.sqrt(max(available, 0) / per_correlation))
+    if cells * per_value > max_memory or block < min(MIN_BLOCK, genes):
+        raise ValueError(
+            f"{max_memory} bytes are not enough to correlate {genes} genes "
+            f"with {workers} workers"
+        )
+    return min(block, genes)
+
+
+def _tile_edges(values, valid, rows, columns, threshold):
+    """Pairs of a tile of the correlation matrix with |r| > threshold,
+    above the diagonal, sorted by row then column"""
+    corr = values[rows] @ values[columns].T
+    linked = (corr > threshold) | (corr < -threshold)
+    linked &= valid[rows, None]
+    linked &= valid[None, columns]
+    if rows.start == columns.start:
+        linked = np.triu(linked, k=1)
+
+    sources, targets = np.nonzero(linked)
+    weights = np.clip(corr[sources, targets], -1, 1)
+    count("coexpression.tiles")
+    return (
+        (sources + rows.start).astype(np.int32),
+        (targets + columns.start).astype(np.int32),
+        weights.astype(np.float32),
+    )
+
+
+def _open_parts(directory):
+    return {name: open(os.path.join(directory, name), "wb") for name in PARTS}
+
+
+def _mapped_parts(directory, edges):
+    """Edge arrays written by _open_parts, memory-mapped"""
+    return [
+        (
+            np.memmap(os.path.join(directory, name), dtype=dtype, mode="r")
+            if edges
+            else np.array([], dtype=dtype)
+        )
+        for name, dtype in zip(PARTS, PART_TYPES)
+    ]
+
+
+def _write_edges(outputs, edges):
+    for name, values in zip(PARTS, edges):
+        values.tofile(outputs[name])
+
+
+def _merge_tiles(directory, tiles, rows, max_edges, outputs):
+    """Writes the edges of the tiles of a block of rows, each sorted by row
+    then column and stored one after the other, sorted as a whole. Rows are
+    sorted a group at a time, of at most max_edges edges or a single row"""
+    sources, targets, weights = _mapped_parts(directory, tiles[-1][1])
+    # Where every row starts in every tile
+    starts = np.array(
+        [
+            start
+            + np.searchsorted(sources[start:stop], np.arange(rows.start, rows.stop + 1))
+            for start, stop in tiles
+        ]
+    )
+    ends = np.cumsum(np.diff(starts, axis=1).sum(axis=0))
+    first = 0
+    while first < len(ends):
+        done = ends[first - 1] if first else 0
+        last = max(first + 1, np.searchsorted(ends, done + max_edges, side="right"))
+        group = [
+            np.concatenate([part[tile[first] : tile[last]] for tile in starts])
+            for part in (sources, targets, weights)
+        ]
+        # Tiles come by increasing column: a stable sort by row is enough
+        order = np.argsort(group[0], kind="stable")
+        _write_edges(outputs, [part[order] for part in group])
+        first = last
+
+
+@traced("coexpression.sparse_edges")
+def correlation_edges(
+    expression,
+    threshold,
+    path,
+    method="pearson",
+    max_memory=DEFAULT_MAX_MEMORY,
+    workers=None,
+):
+    """Correlates the genes of a gene × sample table tile by tile and writes
+    the pairs with |r| > threshold to a network file (see save_network), in
+    the order of threshold_edges. Tiles are written to disk as they come,
+    then sorted a block of rows at a time, all within max_memory (see
+    block_size). Returns the EdgeList"""
+    workers = workers or os.cpu_count() or 1
+    genes, samples = expression.shape
+    if genes == 0:
+        empty = [np.array([], dtype=dtype) for dtype in PART_TYPES]
+        save_network(path, EdgeList(expression.index.to_numpy(), *empty))
+        return load_network(path).edges
+
+    block = block_size(genes, samples, max_memory, workers, method)
+    values, valid = standardize(expression, method)
+    starts = range(0, genes, block)
+    tiles = [
+        (slice(i, min(i + block, genes)), slice(j, min(j + block, genes)))
+        for i in starts
+        for j in starts
+        if j >= i
+    ]
+    log.info(
+        f"Correlating {genes} genes in {len(tiles)} tiles of {block} "
+        f"with {workers} workers"
+    )
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or ".") as parts:
+        network_parts = os.path.join(parts, "network")
+        block_parts = os.path.join(parts, "block")
+        os.makedirs(network_parts)
+        outputs = _open_parts(network_parts)
+        edges = 0
+        # Tiles of the block of rows being collected, written to block_parts:
+        # their rows, and where their edges are
+        block_outputs = None
+        block_rows = None
+        block_tiles = []
+
+        def write_block():
+            nonlocal edges
+            for output in block_outputs.values():
+                output.close()
+            if block_tiles[-1][1] > 0:
+                _merge_tiles(
+                    block_parts, block_tiles, block_rows, block * block, outputs
+                )
+                edges += block_tiles[-1][1]
+            block_tiles.clear()
+
+        def collect(rows, tile):
+            nonlocal block_outputs, block_rows
+            if block_tiles and rows != block_rows:
+                write_block()
+            if not block_tiles:
+                os.makedirs(block_parts, exist_ok=True)
+                block_outputs = _open_parts(block_parts)
+                block_rows = rows
+            tile_edges = tile.result()
+            _write_edges(block_outputs, tile_edges)
+            start = block_tiles[-1][1] if block_tiles else 0
+            block_tiles.append((start, start + len(tile_edges[0])))
+
+        # Tiles are collected in order, with a few running ahead: at most
+        # workers tiles are being computed, and 2 * workers results kept
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            for rows, columns in tiles:
+                pending.append(
+                    (
+                        rows,
+                        pool.submit(
+                            _tile_edges, values, valid, rows, columns, threshold
+                        ),
+                    )
+                )
+                if len(pending) >= 2 * workers:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        if block_tiles:
+            write_block()
+
+        for output in outputs.values():
+            output.close()
+
+        # Written straight from the files of the parts
+        save_network(
+            path,
+            EdgeList(expression.index.to_numpy(), *_mapped_parts(network_parts, edges)),
+        )
+
+    log.info(f"Saved {edges} links with |r| > {threshold} to {path}")
+    return load_network(path).edges
+
+
+@traced("coexpression.topk_edges")
+def topk_correlation_edges(
+    expression, k, mutual=False, method="pearson", max_memory=DEFAULT_MAX_MEMORY
+) -> EdgeList:
+    """network_builder.topk_edges from a gene × sample table, without the
+    dense matrix: correlations are computed and ranked a block of rows at a
+    time, so memory is O(n·k) besides the standardized expression and the
+    block, all within max_memory"""
+    genes, samples = expression.shape
+    cells = genes * samples
+    per_value = SPEARMAN_BYTES if method == "spearman" else STANDARDIZE_BYTES
+    available = (
+        max_memory
+        - cells * np.dtype(np.float32).itemsize
+        - genes * min(k, genes) * TOPK_PICK_BYTES
+    )
+    # Rows correlated and ranked at once, see TOPK_BYTES
+    rows = available // (genes * TOPK_BYTES) if genes else 1
+    if cells * per_value > max_memory or rows < 1:
+        raise ValueError(
+            f"{max_memory} bytes are not enough to rank the correlations "
+            f"of {genes} genes"
+        )
+
+    values, valid = standardize(expression, method)
+
+    def block_correlations(rows):
+        corr = values[rows] @ values.T
+        corr[~valid[rows]] = np.nan
+        corr[:, ~valid] = np.nan
+        return corr
+
+    sources, targets, weights = topk_pairs(
+        k, genes, block_correlations, int(rows), mutual
+    )
+    np.clip(weights, -1, 1, out=weights)
+    return EdgeList(expression.index.to_numpy(), sources, targets, weights)
+
+
+def coexpression_edges(
+    expression_db,
+    gene_db,
+    genes,
+    threshold,
+    method="pearson",
+    chunksize=DEFAULT_CHUNKSIZE,
+    cache_dir=cache_utils.CACHE_DIRECTORY,
+    max_memory=DEFAULT_MAX_MEMORY,
+    workers=None,
+) -> EdgeList:
+    """Sparse counterpart of coexpression_matrix: the pairs of genes with
+    |r| > threshold, without ever building the dense matrix. genes=None
+    takes every gene of the platform. Cached like the matrix; the edges of
+    any higher threshold come from threshold_edges on the result"""
+    key = coexpression_key(expression_db, gene_db, genes, method, np.float32)
+    path = os.path.join(cache_dir, "coexpression", f"{key}-edges-{threshold}.npz")
+    if os.path.exists(path):
+        log.debug(f"Loading cached coexpression edges {path}")
+        return load_network(path).edges
+
+    log.info(f"Building coexpression edges for {expression_db}, {gene_db}")
+    probes = probe_symbols(gene_db, genes, chunksize)
+    expression = gene_expression(expression_db, probes, chunksize)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return correlation_edges(expression, threshold, path, method, max_memory, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the coexpression links with |r| above a threshold, "
+        "for a whole platform, to a network file (.npz)"
+    )
+    parser.add_argument("output")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--expression", default="GSE40367-stripped.txt")
+    parser.add_argument("--platform", default="GPL570-stripped.txt")
+    parser.add_argument(
+        "--sequencing",
+        help="only correlate the genes of these sequencing results, "
+        "instead of every gene of the platform",
+    )
+    parser.add_argument("--method", choices=["pearson", "spearman"], default="pearson")
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=DEFAULT_MAX_MEMORY / 2**30,
+        help="memory cap of the correlation, in GiB",
+    )
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    genes = None
+    if args.sequencing:
+        from mutation_store import load_mutations
+
+        genes = load_mutations(args.sequencing).biomarkers
+
+    probes = probe_symbols(args.platform, genes)
+    expression = gene_expression(args.expression, probes)
+    correlation_edges(
+        expression,
+        args.threshold,
+        args.output,
+        args.method,
+        int(args.max_memory * 2**30),
+        args.workers,
+    )
@@ -0,0 +1,211 @@
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Permutations are drawn in chunks with their own random streams,
+# so that results only depend on the seed, not on the number of jobs
+PERMUTATION_CHUNK = 5000
+# Permuted or resampled outcome vectors multiplied at once
+BLOCK_SIZE = 500
+
+
+def _seed_sequence(seed):
+    """Seeds can be given as ints, or as streams spawned by the caller"""
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def _standardize(values):
+    """Centers columns and scales them to unit norm: the correlation
+    of two standardized columns is then just their dot product"""
+    values = values - values.mean(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return values / np.linalg.norm(values, axis=0)
+
+
+def _prepare(scores, outcome, method):
+    if method == "spearman":
+        scores = scores.rank()
+        outcome = outcome.rank()
+    elif method != "pearson":
+        raise ValueError(f"Unsupported correlation method {method}")
+
+    return scores.to_numpy(dtype=np.float64), outcome.to_numpy(dtype=np.float64)
+
+
+def _exceedances(standardized, outcome, observed, permutations, seed):
+    """Counts how many permuted correlations are at least as extreme
+    as the observed ones, a block of permutations per matrix product"""
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(standardized.shape[1], dtype=np.int64)
+    threshold = np.abs(observed) - 1e-12
+    for start in range(0, permutations, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, permutations - start)
+        permuted = rng.permuted(np.tile(outcome, (count, 1)), axis=1)
+        correlations = standardized.T @ permuted.T
+        exceed += (np.abs(correlations) >= threshold[:, None]).sum(axis=1)
+
+    return exceed
+
+
+def permutation_pvalues(scores, outcome, observed, permutations, seed=None, jobs=1):
+    """Two-sided permutation p-values of the correlations of every
+    column of scores with outcome. Both are already standardized"""
+    chunks = [
+        min(PERMUTATION_CHUNK, permutations - start)
+        for start in range(0, permutations, PERMUTATION_CHUNK)
+    ]
+    seeds = _seed_sequence(seed).spawn(len(chunks))
+    arguments = ([scores] * len(chunks), [outcome] * len(chunks))
+    arguments += ([observed] * len(chunks), chunks, seeds)
+
+    if jobs == 1 or len(chunks) == 1:
+        exceed = sum(map(_exceedances, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            exceed = sum(pool.map(_exceedances, *arguments))
+
+    pvalues = (1 + exceed) / (1 + permutations)
+    return np.where(np.isnan(observed), np.nan, pvalues)
+
+
+def bootstrap_intervals(scores, outcome, resamples, confidence=0.95, seed=None):
+    """Percentile confidence intervals of the correlations, resampling
+    patients with replacement. Every block of resamples is a matrix of
+    patient counts, so correlations come from weighted sums"""
+    rng = np.random.default_rng(seed)
+    patients = len(outcome)
+    correlations = []
+    for start in range(0, resamples, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, resamples - start)
+        picks = rng.integers(0, patients, (count, patients))
+        weights = np.zeros((patients, count))
+        np.add.at(weights, (picks, np.arange(count)[:, None]), 1)
+
+        sum_x = scores.T @ weights
+        sum_xx = (scores**2).T @ weights
+        sum_y = outcome @ weights
+        sum_yy = (outcome**2) @ weights
+        sum_xy = scores.T @ (weights * outcome[:, None])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlations.append(
+                (patients * sum_xy - sum_x * sum_y)
+                / np.sqrt(
+                    (patients * sum_xx - sum_x**2) * (patients * sum_yy - sum_y**2)
+                )
+            )
+
+    correlations = np.hstack(correlations)
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        # Resamples where a column is constant don't have a correlation,
+        # columns that are always constant don't have an interval
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return (
+            np.nanpercentile(correlations, tail, axis=1),
+            np.nanpercentile(correlations, 100 - tail, axis=1),
+        )
+
+
+def adjust_pvalues(pvalues, method="fdr_bh"):
+    """Multiple testing correction: Benjamini-Hochberg false discovery
+    rate, or Bonferroni family-wise error rate. Missing values are ignored"""
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = np.full_like(pvalues, np.nan)
+    tested = ~np.isnan(pvalues)
+    values = pvalues[tested]
+
+    if method == "bonferroni":
+        adjusted[tested] = np.minimum(values * len(values), 1)
+    elif method == "fdr_bh":
+        order = np.argsort(values)
+        ranked = values[order] * len(values) / np.arange(1, len(values) + 1)
+        # Adjusted p-values can't decrease with the rank
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        adjusted[np.flatnonzero(tested)[order]] = np.minimum(ranked, 1)
+    else:
+        raise ValueError(f"Unsupported correction {method}")
+
+    return adjusted
+
+
+def correlation_tests(
+    scores,
+    outcome,
+    method="pearson",
+    permutations=10000,
+    resamples=1000,
+    confidence=0.95,
+    seed=None,
+    jobs=1,
+):
+    """Correlation of every column of scores with the outcome series,
+    with its permutation p-value and bootstrap confidence interval.
+    Patients without an outcome are left out"""
+    outcome = outcome.reindex(scores.index)
+    known = outcome.notna().to_numpy()
+    scores, outcome = scores[known], outcome[known]
+    if scores.isna().any().any():
+        raise ValueError("Scores must not have missing values")
+
+    values, outcomes = _prepare(scores, outcome, method)
+    standardized, outcomes_std = _standardize(values), _standardize(outcomes)
+    observed = standardized.T @ outcomes_std
+
+    permutation_seed, bootstrap_seed = _seed_sequence(seed).spawn(2)
+    pvalues = permutation_pvalues(
+        standardized, outcomes_std, observed, permutations, permutation_seed, jobs
+    )
+    low, high = bootstrap_intervals(
+        values, outcomes, resamples, confidence, bootstrap_seed
+    )
+
+    return pd.DataFrame(
+        {
+            "r": observed,
+            "p_value": pvalues,
+            "ci_low": low,
+            "ci_high": high,
+            "n": len(scores),
+        },
+        index=scores.columns,
+    )
+
+
+def score_significance(
+    scores,
+    patients_log,
+    group_by="arm",
+    outcome="dpfs",
+    correction="fdr_bh",
+    seed=None,
+    **kwargs,
+):
+    """Tests every group × pathway × measure of the long score table
+    returned by scoring.evaluate_measures. p-values are corrected
+    across all the tests at once"""
+    outcomes = patients_log.drop_duplicates("PatientFirstName").set_index(
+        "PatientFirstName"
+    )[outcome]
+    wide = scores.pivot(
+        index=[group_by, "PatientFirstName"],
+        columns=["pathway", "measure"],
+        values="score",
+    )
+
+    groups = sorted(wide.index.get_level_values(group_by).unique())
+    seeds = _seed_sequence(seed).spawn(len(groups))
+    results = pd.concat(
+        {
+            group: correlation_tests(
+                wide.loc[group], outcomes, seed=group_seed, **kwargs
+            )
+            for group, group_seed in zip(groups, seeds)
+        },
+        names=[group_by],
+    )
+    results.insert(2, "p_adjusted", adjust_pvalues(results["p_value"], correction))
+    return results
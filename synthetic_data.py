@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import argparse
+import logging as log
+import os
+
+import numpy as np
+import pandas as pd
+
+TECHNOLOGIES = ["NGS Q3", "IHC", "FISH"]
+TEST_RESULTS = ["variantdetected", "Mutated, Pathogenic", "Wild type", "Not detected"]
+# Patients written to the sequencing results at once
+PATIENTS_BLOCK = 10000
+
+
+def gene_names(count):
+    return [f"SYN{i:05d}" for i in range(count)]
+
+
+def _element_id(rng):
+    alphabet = np.array(
+        list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+    )
+    return "".join(rng.choice(alphabet, 12))
+
+
+def write_patients_log(path, patients, seed=0):
+    """Clinical table shaped like TRIBE2_db.csv"""
+    rng = np.random.default_rng(seed)
+    log_table = pd.DataFrame(
+        {
+            "PatientFirstName": [f"PT{i:06d}" for i in range(patients)],
+            "arm": rng.integers(0, 2, patients),
+            "dpfs": rng.gamma(2.0, 200.0, patients).round().astype(int),
+            "tstag": rng.integers(1, 5, patients),
+            "nstag": rng.integers(0, 3, patients),
+            "ras": rng.integers(0, 2, patients),
+            "braf": rng.integers(0, 2, patients),
+            "liver": rng.integers(0, 2, patients),
+            "lung": rng.integers(0, 2, patients),
+            "peritoneum": rng.integers(0, 2, patients),
+            "nodes": rng.integers(0, 2, patients),
+            "other": rng.integers(0, 2, patients),
+        }
+    )
+    log_table.to_csv(path, index=False)
+    return log_table
+
+
+def write_sequencing_results(path, patients, genes, tests_per_patient=20, seed=0):
+    """Sequencing results shaped like TRIBE2_seq_res.csv, rows grouped by
+    patient. Written a block of patients at a time, so that the size of
+    the file is not bounded by memory"""
+    rng = np.random.default_rng(seed)
+    genes = np.asarray(genes)
+    # A few genes are mutated much more often than the others
+    frequencies = rng.zipf(1.5, len(genes)).astype(np.float64)
+    frequencies /= frequencies.sum()
+
+    with open(path, "w") as results:
+        header = True
+        for start in range(0, patients, PATIENTS_BLOCK):
+            block = np.arange(start, min(start + PATIENTS_BLOCK, patients))
+            tests = rng.poisson(tests_per_patient, len(block)) + 1
+            rows = tests.sum()
+            table = pd.DataFrame(
+                {
+                    "PatientFirstName": np.repeat([f"PT{i:06d}" for i in block], tests),
+                    "Biomarker": rng.choice(genes, rows, p=frequencies),
+                    "Technology": rng.choice(TECHNOLOGIES, rows, p=[0.8, 0.15, 0.05]),
+                    "TestResult": rng.choice(
+                        TEST_RESULTS, rows, p=[0.25, 0.15, 0.45, 0.15]
+                    ),
+                    "NGS_PercentMutated": np.where(
+                        rng.random(rows) < 0.1,
+                        np.nan,
+                        (rng.beta(2, 5, rows) * 100).round(2),
+                    ),
+                }
+            )
+            table.to_csv(results, index=False, header=header)
+            header = False
+
+
+def write_expression_tables(
+    expression_path, platform_path, genes, samples=100, probes_per_gene=2, seed=0
+):
+    """GSE series matrix and GPL570-like platform table. Genes share a
+    few latent factors, so that their coexpression has structure"""
+    rng = np.random.default_rng(seed)
+    genes = np.asarray(genes)
+    probes = np.repeat(genes, probes_per_gene)
+    probe_ids = [f"{i}_at" for i in range(len(probes))]
+    # Probes of genes outside of the pathways, as in the real platform
+    extra = len(probes) // 4
+
+    platform = pd.DataFrame(
+        {
+            "ID": probe_ids + [f"{i}_x_at" for i in range(extra)],
+            "Gene Symbol": np.concatenate(
+                [probes, [f"OTHER{i}" for i in range(extra)]]
+            ),
+        }
+    )
+    platform.to_csv(platform_path, sep="\t", index=False)
+
+    factors = rng.normal(size=(8, samples))
+    loadings = rng.normal(size=(len(genes), 8)) * (rng.random((len(genes), 1)) < 0.5)
+    expression = loadings @ factors + rng.normal(size=(len(genes), samples))
+    values = np.repeat(expression, probes_per_gene, axis=0)
+    values = np.vstack(
+        [
+            values + rng.normal(scale=0.3, size=values.shape),
+            rng.normal(size=(extra, samples)),
+        ]
+    )
+    values[rng.random(values.shape) < 0.001] = np.nan
+
+    table = pd.DataFrame(values.round(4), columns=[f"GSM{i}" for i in range(samples)])
+    table.insert(0, "ID_REF", platform["ID"])
+    table.to_csv(expression_path, sep="\t", index=False)
+
+
+def write_pathway(path, name, genes, seed=0, containers=3, edges_per_gene=1.5):
+    """PathwayMapper file with top-level genes, families and complexes
+    (possibly nested), a process, and edges between all of them"""
+    rng = np.random.default_rng(seed)
+    nodes = []
+    containers_ids = []
+    for i in range(containers):
+        nid = _element_id(rng)
+        # Some containers are nested in the previous one
+        parent = containers_ids[-1] if containers_ids and rng.random() < 0.3 else "-1"
+        kind = "FAMILY" if rng.random() < 0.5 else "COMPLEX"
+        nodes.append((f"{name} {kind.lower()} {i}", nid, kind, parent))
+        containers_ids.append(nid)
+
+    for gene in genes:
+        parent = "-1"
+        if containers_ids and rng.random() < 0.5:
+            parent = containers_ids[rng.integers(len(containers_ids))]
+        nodes.append((gene, _element_id(rng), "GENE", parent))
+    process = _element_id(rng)
+    nodes.append((f"{name} process", process, "PROCESS", "-1"))
+
+    linkable = [nid for _, nid, _, _ in nodes]
+    edge_count = int(len(genes) * edges_per_gene)
+    sources = rng.choice(linkable, edge_count)
+    targets = rng.choice(linkable + [process] * 3, edge_count)
+    kinds = rng.choice(["ACTIVATES", "INHIBITS", "BINDS", "NONE"], edge_count)
+
+    with open(path, "w") as pwfile:
+        pwfile.write(f"{name}\n\nSynthetic pathway\n\n")
+        pwfile.write(
+            "--NODE_NAME\tNODE_ID\tNODE_TYPE\tPARENT_ID\tPOSX\tPOSY\tWIDTH\tHEIGHT--\n"
+        )
+        for node_name, nid, kind, parent in nodes:
+            posx, posy = rng.integers(0, 1000, 2)
+            pwfile.write(
+                f"{node_name}\t{nid}\t{kind}\t{parent}\t{posx}\t{posy}\t150\t52\n"
+            )
+        pwfile.write("\n")
+        pwfile.write(
+            "--EDGE_ID\tSOURCE\tTARGET\tEDGE_TYPE\tINTERACTION_PUBMED_ID"
+            "\tEDGE_NAME\tEDGE_BENDS\n"
+        )
+        for source, target, kind in zip(sources, targets, kinds):
+            if source != target:
+                pwfile.write(f"{_element_id(rng)}\t{source}\t{target}\t{kind}\t\t\t\n")
+        pwfile.write("\n")
+
+
+def generate_dataset(
+    directory,
+    patients=500,
+    pathways=10,
+    genes_per_pathway=30,
+    samples=100,
+    seed=0,
+):
+    """Writes a complete synthetic dataset, with the file names of the
+    real one. Returns the paths of the files written"""
+    os.makedirs(os.path.join(directory, "pathways"), exist_ok=True)
+    rng = np.random.default_rng(seed)
+    seeds = rng.integers(0, 2**32, 4 + pathways)
+    genes = gene_names(pathways * genes_per_pathway)
+
+    paths = {
+        "patients_log": os.path.join(directory, "TRIBE2_db.csv"),
+        "sequencing": os.path.join(directory, "TRIBE2_seq_res.csv"),
+        "expression": os.path.join(directory, "GSE_series_matrix.txt"),
+        "platform": os.path.join(directory, "GPL570.txt"),
+        "pathways": os.path.join(directory, "pathways"),
+    }
+    write_patients_log(paths["patients_log"], patients, seeds[0])
+    # Some mutations fall outside of every pathway
+    write_sequencing_results(
+        paths["sequencing"],
+        patients,
+        genes + gene_names(len(genes) + 50)[-50:],
+        seed=seeds[1],
+    )
+    write_expression_tables(
+        paths["expression"], paths["platform"], genes, samples, seed=seeds[2]
+    )
+    for i in range(pathways):
+        # Pathways overlap a bit, like the real ones
+        members = rng.choice(
+            genes,
+            min(len(genes), genes_per_pathway + genes_per_pathway // 5),
+            replace=False,
+        )
+        write_pathway(
+            os.path.join(paths["pathways"], f"SYN{i}.txt"),
+            f"SYN{i}",
+            sorted(set(members)),
+            seeds[4 + i],
+        )
+
+    log.info(f"Synthetic dataset with {patients} patients written to {directory}")
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset with the layout of TRIBE2"
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--pathways", type=int, default=10)
+    parser.add_argument("--genes-per-pathway", type=int, default=30)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    generate_dataset(
+        args.directory,
+        args.patients,
+        args.pathways,
+        args.genes_per_pathway,
+        args.samples,
+        args.seed,
+    )
@@ -0,0 +1,197 @@
+import subprocess
+import threading
+import traceback
+
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+from render_cache import RenderedPathway, SvgTemplate
+
+# How often (seconds) a running Graphviz layout checks for cancellation
+RENDER_POLL = 0.1
+# Above this many links, pathways are drawn by a GraphPage instead of Graphviz
+DEFAULT_MAX_SVG_EDGES = 2000
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """Shared between a task and the GUI: the GUI cancels it,
+    the task checks it between steps and gives up"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled()
+
+
+class TaskSignals(QObject):
+    # Percentage and description of the current step
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class Task(QRunnable):
+    """Runs function(*args, progress=..., token=...) on a thread pool.
+    Results, errors and progress come back through signals, which Qt
+    delivers on the GUI thread. Nothing is emitted but cancelled once
+    the token is cancelled, so stale results never reach the GUI"""
+
+    def __init__(self, function, *args, token=None, **kwargs):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.token = token or CancelToken()
+        self.signals = TaskSignals()
+
+    def report(self, percentage, message):
+        if not self.token.cancelled:
+            self.signals.progress.emit(percentage, message)
+
+    def run(self):
+        try:
+            self.token.check()
+            result = self.function(
+                *self.args, progress=self.report, token=self.token, **self.kwargs
+            )
+            self.token.check()
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            if self.token.cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.failed.emit(traceback.format_exc())
+        else:
+            self.signals.finished.emit(result)
+
+
+def render_svg(graph, token=None, prog="dot") -> bytes:
+    """Lays out a graph with Graphviz. Unlike pydot's create_svg,
+    the layout is killed as soon as the token is cancelled"""
+    # Imported by the first task, so that the viewer starts faster
+    import networkx as nx
+
+    source = nx.nx_pydot.to_pydot(graph).to_string().encode()
+    process = subprocess.Popen(
+        [prog, "-Tsvg"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    data = source
+    while True:
+        try:
+            svg, errors = process.communicate(data, timeout=RENDER_POLL)
+            break
+        except subprocess.TimeoutExpired:
+            # The input was sent, later calls just wait for the output
+            data = None
+            if token is not None and token.cancelled:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+                process.stderr.close()
+                raise Cancelled() from None
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{prog} failed: {errors.decode(errors='replace')}")
+    return svg
+
+
+def render_edges(name, edges, style, max_svg_edges, progress, token) -> RenderedPathway:
+    """Lays out the pathway of an edge list, with the nodes styled
+    for no patient in particular. Above max_svg_edges links, Graphviz
+    would take too long: the pathway is drawn by a GraphPage instead"""
+    from graph_renderer import GraphPage
+    from network_builder import pathway_from_edges
+
+    pathway = style(pathway_from_edges(name, edges))
+    if large_graph(edges, max_svg_edges):
+        progress(30, f"Preparing {len(edges.sources)} links for the large graph view")
+        return RenderedPathway(pathway, GraphPage(edges), edges)
+
+    progress(30, f"Laying out {len(edges.sources)} links")
+    return RenderedPathway(
+        pathway, SvgTemplate(render_svg(pathway.graph, token)), edges
+    )
+
+
+def large_graph(edges, max_svg_edges) -> bool:
+    """Whether a pathway is drawn by a GraphPage rather than Graphviz"""
+    return len(edges.sources) > max_svg_edges
+
+
+def build_pathway_view(
+    threshold,
+    coexpression,
+    colors,
+    cache,
+    source,
+    style,
+    max_svg_edges,
+    progress,
+    token,
+):
+    """Colors the layout of a thresholded pathway for a patient, taking
+    the edges and layout from the cache when another patient already
+    needed them. Layouts are keyed by how they are drawn, so changing
+    max_svg_edges only lays out again the pathways it moves across.
+    Returns the uncolored pathway, its edges, and the patient's page
+    (SVG or HTML) with its content type"""
+    from network_builder import make_pathway_from_thres
+
+    def threshold_coexpression():
+        progress(0, f"Linking genes with |r| > {threshold}")
+        return make_pathway_from_thres(threshold, coexpression, edges_only=True)
+
+    edges = cache.get((source, threshold), threshold_coexpression, token)
+    token.check()
+    rendered = cache.get(
+        (source, threshold, large_graph(edges, max_svg_edges)),
+        lambda: render_edges(
+            f"GPL570-{threshold}", edges, style, max_svg_edges, progress, token
+        ),
+        token,
+    )
+
+    progress(90, "Coloring mutated genes")
+    return (
+        rendered.pathway,
+        rendered.edges,
+        rendered.template.render(colors),
+        rendered.template.content_type,
+    )
+
+
+def build_network_view(
+    name, edges, colors, cache, source, style, max_svg_edges, progress, token
+):
+    """Same as build_pathway_view, for a network loaded from a file"""
+    rendered = cache.get(
+        (source, None, large_graph(edges, max_svg_edges)),
+        lambda: render_edges(name, edges, style, max_svg_edges, progress, token),
+        token,
+    )
+
+    progress(90, "Coloring mutated genes")
+    return (
+        rendered.pathway,
+        rendered.edges,
+        rendered.template.render(colors),
+        rendered.template.content_type,
+    )